@@ -6,11 +6,8 @@ Appends SLD information to output CSV files in network traffic processing pipeli
 
 import argparse
 import sys
-import tldextract
 import unicodecsv as csv
-
-def _get_second_level_domain_from_tld(url_tld):
-    return url_tld.domain + "." + url_tld.suffix
+from utils import domains
 
 csv_key_hostname = "hostname"
 csv_key_sld_label = "second_level_domain"
@@ -37,9 +34,7 @@ if __name__ == '__main__':
 
             # turn hostname into sld
             if hostname not in hostname_to_sld:
-                tldresult = tldextract.extract(hostname)
-                sld_new = _get_second_level_domain_from_tld(tldresult)
-                hostname_to_sld[hostname] = sld_new
+                hostname_to_sld[hostname] = domains.get_second_level_domain(hostname)
 
     # read in the file again to do the second time to label each row, and write it out as well
     with open(args.in_csv, "rb") as in_csv_file:
@@ -61,3 +56,5 @@ if __name__ == '__main__':
                 data_row.append(sld)
                 # write row
                 csv_writer.writerow(data_row)
+
+    domains.print_cache_stats()
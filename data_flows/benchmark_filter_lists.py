@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+
+'''
+Benchmarks the filter list matchers of filter_list_checker_mult_dirs.py (HostsListMatcher for hosts lists, and
+TokenIndexMatcher for the other lists) against AdblockRules, on the URLs of recorded traffic (the *-nomoads.json files
+in the given directories). Checks that the block decisions are the same, and reports the time to build each matcher and
+its throughput in URLs per second.
+'''
+
+import argparse
+import glob
+import json
+import os
+import time
+from adblockparser import AdblockRules
+import filter_list_checker_mult_dirs
+from utils import records, utils
+
+
+def load_urls(nomoads_dirs):
+    '''
+    :param nomoads_dirs: Directories that contain *-nomoads.json files (in any subdirectory).
+    :return: The unique (URL, options) pairs of the packets, as matched by fl_matcher_controller.
+    '''
+    urls = {}
+    for nomoads_dir in nomoads_dirs:
+        for nomoads_file in sorted(glob.glob(os.path.join(nomoads_dir, "**", "*-nomoads.json"), recursive=True)):
+            for pkt in records.read_records(nomoads_file).values():
+                if utils.json_key_host not in pkt:
+                    continue
+                url, options = filter_list_checker_mult_dirs.get_url_and_options(pkt)
+                urls.setdefault(url + json.dumps(options, sort_keys=True), (url, options))
+    return list(urls.values())
+
+
+def get_filter_list_files(paths):
+    # The filter list files, and the files of the filter list directories
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(sorted(os.path.join(path, f) for f in os.listdir(path) if "DS_Store" not in f))
+        else:
+            files.append(path)
+    return files
+
+
+def time_matcher(matcher, urls):
+    start = time.perf_counter()
+    decisions = [matcher.should_block(url, options) for url, options in urls]
+    return decisions, time.perf_counter() - start
+
+
+if __name__ == '__main__':
+    ap = argparse.ArgumentParser(description="Benchmarks the filter list matchers against AdblockRules on recorded URLs")
+    ap.add_argument('filter_lists', nargs='+', help='Filter list files, or directories of filter lists')
+    ap.add_argument('--nomoads_dir', action='append', required=True, help='Directory with *-nomoads.json files (can be repeated)')
+    ap.add_argument('--max_urls', type=int, default=None, help='Only match the first N URLs (default: all)')
+    args = ap.parse_args()
+
+    urls = load_urls(args.nomoads_dir)[:args.max_urls]
+    print("[.] %d unique URLs (and options)" % len(urls))
+    if not urls:
+        exit(1)
+
+    mismatches = 0
+    for fl_file in get_filter_list_files(args.filter_lists):
+        with open(fl_file, "r") as f:
+            lines = f.readlines()
+        start = time.perf_counter()
+        rules = AdblockRules(lines)
+        rules_build = time.perf_counter() - start
+        start = time.perf_counter()
+        matcher = filter_list_checker_mult_dirs.init_rule_checker(fl_file)
+        matcher_build = time.perf_counter() - start
+
+        expected, rules_time = time_matcher(rules, urls)
+        decisions, matcher_time = time_matcher(matcher, urls)
+        different = [urls[i] for i in range(len(urls)) if expected[i] != decisions[i]]
+        for url, options in different[:10]:
+            print("ERROR: %s decision differs from AdblockRules for %s %s" % (type(matcher).__name__, url, options))
+        mismatches += len(different)
+
+        print("[%s] %s: %d blocked, AdblockRules %.2f s to build, %.0f URLs/s, %s %.2f s to build, %.0f URLs/s (%.1fx)" %
+              ("+" if not different else "-", os.path.basename(fl_file), sum(expected), rules_build,
+               len(urls) / max(rules_time, 1e-9), type(matcher).__name__, matcher_build,
+               len(urls) / max(matcher_time, 1e-9), rules_time / max(matcher_time, 1e-9)))
+
+    if mismatches > 0:
+        print("ERROR: %d decisions differ from AdblockRules" % mismatches)
+        exit(1)
+    print("[+] Same decisions as AdblockRules")
@@ -0,0 +1,356 @@
+#!/usr/bin/env python3
+
+'''
+Benchmarks the key-value pair extraction (extract_key_val_pairs.py) on synthetic analytics batch payloads (e.g., Firebase
+or other SDKs that upload batches of events, with JSON-encoded strings nested in the events). Checks that the output is
+the same as with the original implementations, and reports the time and memory allocated by each:
+1) check_all_kv_pairs, which walks the decoded JSON objects.
+2) find_json, which finds the JSON objects in the payloads (also checked on a corpus of truncated, malformed, and
+   random payloads).
+3) process_separated_text, which splits the ampersand-separated and semicolon-separated payloads (on the request URLs,
+   headers, and bodies of HAR files, if given, or else on synthetic query strings, form bodies, and cookies). It also
+   extracts the pairs of percent-encoded JSON values, so the original pairs must be a subset of its pairs.
+'''
+
+import argparse
+import json
+import os
+import random
+import re
+import time
+import tracemalloc
+from collections import Counter
+from copy import deepcopy
+from urllib.parse import quote, urlencode, urlparse
+import extract_key_val_pairs
+
+
+def check_all_kv_pairs_deepcopy(root_obj, init_level=()):
+    # Original implementation, which copies the object so that the namespaces can be popped from it
+    def handle_namespace(d):
+        if isinstance(d.get("header"), dict):
+            d = d["header"]
+
+        if "namespace" in d:
+            return f"<{d.pop('namespace')}>"
+        else:
+            return None
+
+    def go(obj, level):
+        if isinstance(obj, list):
+            for item in obj:
+                yield from go(item, level + ("[]",))
+        elif isinstance(obj, dict):
+            if (addtional_label := handle_namespace(obj)) is not None:
+                level = (addtional_label,)  # restart path from the namespace
+
+            for k, v in obj.items():
+                yield from go(v, level + (k,))
+        else:
+            yield level, obj
+
+    yield from go(deepcopy(root_obj), init_level)
+
+
+def find_json_slicing(text):
+    # Original implementation, which decodes a copy of the rest of the text at every candidate
+    json_decoder = json.JSONDecoder()
+    last_ending = 0
+
+    for m in re.finditer(r'(?:"[^"]+":|[{\[])', text):
+        if m.start() < last_ending:
+            continue
+
+        if m[0] in '{[':
+            key = None
+            startpos = m.start()
+        else:
+            key = m[0][1:-2]
+            startpos = m.end()
+
+        part = text[startpos:]
+
+        try:
+            obj, endoffset = json_decoder.raw_decode(part)
+        except json.decoder.JSONDecodeError:
+            continue
+
+        yield {key: obj} if key is not None else obj
+        last_ending = startpos + endoffset
+
+
+def process_ampersand_separated_text(payload):
+    # Original implementation, which yields the pairs of all the JSON values found so far with each JSON value
+    split_text = payload.split("&")
+    json_kvs = []
+    for subtext in split_text:
+        kv_pair = subtext.split("=")
+        if len(kv_pair) > 1:
+            if kv_pair[1].startswith('[') or kv_pair[1].startswith('{'):
+                json_kvs.extend(extract_key_val_pairs.recursive_find_json_items(kv_pair[1]))
+                yield kv_pair[0], kv_pair[1], tuple(json_kvs)
+            else:
+                yield kv_pair[0], kv_pair[1], ''
+        elif len(kv_pair) == 1:
+            yield kv_pair[0], '', ''
+
+
+def process_semicolon_separated_text(payload):
+    # Original implementation, same as process_ampersand_separated_text
+    split_text = payload.split(";")
+    json_kvs = []
+    for subtext in split_text:
+        kv_pair = subtext.split("=")
+        if len(kv_pair) > 1:
+            if kv_pair[1].startswith('[') or kv_pair[1].startswith('{'):
+                json_kvs.extend(extract_key_val_pairs.recursive_find_json_items(kv_pair[1]))
+                yield kv_pair[0], kv_pair[1], tuple(json_kvs)
+            else:
+                yield kv_pair[0], kv_pair[1], ''
+        elif len(kv_pair) == 1:
+            yield kv_pair[0], '', ''
+
+
+def process_separated_text_two_passes(payload):
+    # Original use of the two functions above (convert_har.extract_kv_pairs), with the pairs flattened
+    def flatten(separated_kvs):
+        kvs = []
+        for k, v, v_dict in separated_kvs:
+            kvs.append((k, v))
+            kvs.extend((tup[0], tup[1]) for tup in v_dict)
+        return kvs
+
+    return flatten(process_ampersand_separated_text(payload)), flatten(process_semicolon_separated_text(payload))
+
+
+def make_event(rng, event_index, depth):
+    params = {"param_%d" % i: rng.choice([rng.randint(0, 1 << 20), "value_%d" % rng.randint(0, 999), rng.random(), None, True])
+              for i in range(8)}
+    event = {
+        "name": "event_%d" % event_index,
+        "timestamp_millis": 1700000000000 + event_index,
+        "params": params,
+        "items": [{"item_id": "sku_%d" % i, "price": i * 1.5} for i in range(3)]
+    }
+    if event_index % 4 == 0:
+        event["header"] = {"namespace": "analytics.v%d" % (event_index % 3), "sequence": event_index}
+    elif event_index % 4 == 1:
+        event["namespace"] = "logging"
+    if depth > 0:
+        # Some SDKs JSON-encode nested batches in string values
+        event["payload"] = json.dumps(make_batch(rng, 4, depth - 1))
+    return event
+
+
+def make_batch(rng, num_events, depth):
+    return {
+        "batch": {
+            "app_instance_id": "%032x" % rng.getrandbits(128),
+            "platform": "android",
+            "user_properties": {"first_open_time": 1700000000000, "ga_session_number": rng.randint(1, 100)},
+            "events": [make_event(rng, i, depth) for i in range(num_events)]
+        }
+    }
+
+
+def make_payloads(num_payloads, num_events, depth, seed=0):
+    rng = random.Random(seed)
+    return [json.dumps(make_batch(rng, num_events, depth)) for _ in range(num_payloads)]
+
+
+def make_find_json_corpus(payloads, num_random, seed=0):
+    # Payloads as sent, truncated (e.g., cut off by the capture), with broken brackets, embedded in form-encoded or
+    # JavaScript-like text, and random strings made of JSON characters
+    rng = random.Random(seed)
+    corpus = []
+    for payload in payloads:
+        cut = rng.randint(1, len(payload) - 1)
+        corpus += [
+            payload,
+            payload[:cut],
+            payload[cut:],
+            payload.replace("]", "}", 1),
+            "data=" + payload[:cut] + "&ts=1&json=" + payload,
+            "var config = {a: 1, b: [1, 2, {c: 'x'}]}; window.init(" + payload + ");",
+            # Minified JavaScript: many brackets, but no JSON
+            "".join("function f%d(a){return {x:a,y:[1,2],z:{w:a}};}" % i for i in range(len(payload) // 200))
+        ]
+    alphabet = '{}[]":,\\ abc01.-\n\t\rtruefalsnNaIy'
+    for _ in range(num_random):
+        corpus.append("".join(rng.choice(alphabet) for _ in range(rng.randint(0, 200))))
+    corpus += ['', '"a":', '{"a": 1}', '"a":{"b":[1,2]}', '["x\\"]", 1]', '{"a": "}"', '{"a": "\\', '[{]}', '{"k":"v"}{x":1}',
+               '[NaN, Infinity, -Infinity]', '"a":[ \t\r\n1]', '{ \t"a": {\n}}', 'f(){return {x:[a,1]}}', '{\\"a\\": 1}']
+    return corpus
+
+
+def make_separated_payloads(num_payloads, seed=0):
+    # Query strings, form-urlencoded bodies, and cookies, some with JSON values
+    rng = random.Random(seed)
+    payloads = []
+    for i in range(num_payloads):
+        params = ["%s=%s" % ("param_%d" % j, rng.choice(["value_%d" % j, str(rng.getrandbits(32)), "", "a%3Db",
+                                                            json.dumps({"id": j, "tags": ["x", "y"]}, separators=(",", ":")),
+                                                            quote(json.dumps({"id": j, "event": "e_%d" % j}), safe="")]))
+                  for j in range(rng.randint(1, 30))]
+        if i % 4 == 0:
+            # Form and query encoders write spaces as "+"
+            params.append(urlencode({"data": json.dumps({"event": "open app", "screen": "home %d" % i})}))
+        payloads.append("/api/v1/collect?" + "&".join(params))
+        payloads.append("&".join(params))
+        payloads.append("; ".join(params))
+        payloads.append("/static/app.%d.js" % i)
+    return payloads
+
+
+def load_har_payloads(har_dir):
+    # Same payloads as convert_har.process_packet: the request URL without the domain, headers, and body
+    payloads = []
+    for root, _, files in os.walk(har_dir):
+        for file_name in files:
+            if not file_name.endswith(".har"):
+                continue
+            with open(os.path.join(root, file_name), "r", encoding="utf-8-sig") as har_file:
+                entries = json.load(har_file).get("log", {}).get("entries", [])
+            for entry in entries:
+                request = entry.get("request", {})
+                url_raw = request.get("url", "")
+                url = urlparse(url_raw, scheme="Unknown", allow_fragments=False)
+                payloads.append(url_raw.replace(url.scheme + "://", "").replace(url.netloc, ""))
+                payloads.append(json.dumps({str(pair["name"]): str(pair["value"]) for pair in request.get("headers", [])}))
+                if request.get("postData", {}).get("text", ""):
+                    payloads.append(str(request["postData"]["text"]))
+    return payloads
+
+
+def count_missing_pairs(old_kvs, new_kvs):
+    # Number of pairs of old_kvs (with repetitions) that are not in new_kvs (the values can be JSON lists or objects)
+    def counts(kvs):
+        return Counter(json.dumps(kv, sort_keys=True) for kv in kvs)
+    return sum((counts(old_kvs) - counts(new_kvs)).values())
+
+
+def time_separated_text(process, payloads, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for payload in payloads:
+            process(payload)
+    return (time.perf_counter() - start) / repeat
+
+
+def time_find_json(find_json, corpus, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for text in corpus:
+            for _ in find_json(text):
+                pass
+    return (time.perf_counter() - start) / repeat
+
+
+def extract_all(payloads):
+    return [list(extract_key_val_pairs.recursive_find_json_items(payload)) for payload in payloads]
+
+
+def measure(payloads, repeat):
+    # Time without tracemalloc (it slows down allocations), then the memory allocated by one run
+    start = time.perf_counter()
+    for _ in range(repeat):
+        extract_all(payloads)
+    elapsed = (time.perf_counter() - start) / repeat
+
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    result = extract_all(payloads)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, elapsed, peak
+
+
+def measure_traversal_memory(payloads):
+    # Sum, over the decoded JSON objects, of the memory allocated on top of the object while walking it
+    tracemalloc.start()
+    allocated = 0
+    for payload in payloads:
+        for item in extract_key_val_pairs.find_json(payload):
+            tracemalloc.reset_peak()
+            current_before = tracemalloc.get_traced_memory()[0]
+            for _ in extract_key_val_pairs.check_all_kv_pairs(item):
+                pass
+            allocated += tracemalloc.get_traced_memory()[1] - current_before
+    tracemalloc.stop()
+    return allocated
+
+
+if __name__ == '__main__':
+    ap = argparse.ArgumentParser(description="Benchmarks the key-value pair extraction on synthetic analytics batch payloads")
+    ap.add_argument('--num_payloads', type=int, default=50, help='Number of payloads (default: 50)')
+    ap.add_argument('--num_events', type=int, default=100, help='Number of events per batch (default: 100)')
+    ap.add_argument('--depth', type=int, default=2, help='Levels of JSON-encoded batches nested in the events (default: 2)')
+    ap.add_argument('--repeat', type=int, default=3, help='Number of timed runs (default: 3)')
+    ap.add_argument('--num_random', type=int, default=20000, help='Number of random payloads in the find_json corpus (default: 20000)')
+    ap.add_argument('--har_dir', type=str, default=None, help='Directory with HAR files to benchmark process_separated_text on (default: synthetic payloads)')
+    args = ap.parse_args()
+
+    payloads = make_payloads(args.num_payloads, args.num_events, args.depth)
+    print("[.] %d payloads, %.1f MB" % (len(payloads), sum(len(p) for p in payloads) / 1e6))
+
+    # 1) check_all_kv_pairs
+    results = {}
+    check_all_kv_pairs = extract_key_val_pairs.check_all_kv_pairs
+    for name, impl in [("deepcopy", check_all_kv_pairs_deepcopy), ("copy-free", check_all_kv_pairs)]:
+        extract_key_val_pairs.check_all_kv_pairs = impl
+        result, elapsed, peak = measure(payloads, args.repeat)
+        walk_bytes = measure_traversal_memory(payloads)
+        results[name] = result
+        print("[.] %-10s %8.3f s per run, peak memory %8.1f MB, traversal memory %8.1f MB" %
+              (name, elapsed, peak / 1e6, walk_bytes / 1e6))
+    extract_key_val_pairs.check_all_kv_pairs = check_all_kv_pairs
+
+    if results["deepcopy"] != results["copy-free"]:
+        print("ERROR: the extracted key-value pairs differ between the implementations")
+        exit(1)
+    print("[+] Same key-value pairs extracted (%d)" % sum(len(r) for r in results["copy-free"]))
+
+    # 2) find_json
+    corpus = make_find_json_corpus(payloads, args.num_random)
+    for text in corpus:
+        if list(find_json_slicing(text)) != list(extract_key_val_pairs.find_json(text)):
+            print("ERROR: find_json output differs from the original implementation for: %r" % text[:200])
+            exit(1)
+    print("[+] Same JSON objects found in the %d payloads of the find_json corpus" % len(corpus))
+    for name, find_json in [("slicing", find_json_slicing), ("in-place", extract_key_val_pairs.find_json)]:
+        print("[.] %-10s find_json %8.3f s per run on the corpus" % (name, time_find_json(find_json, corpus, args.repeat)))
+
+    # 3) process_separated_text
+    if args.har_dir is not None:
+        separated_payloads = load_har_payloads(args.har_dir)
+    else:
+        separated_payloads = make_separated_payloads(args.num_payloads * 100)
+    separated_payloads += corpus
+    # Percent-encoded JSON values, with "+" or "%20" as spaces
+    for payload, expected_kv in [(urlencode({"data": json.dumps({"event": "open app"}), "v": "1"}), (("event",), "open app")),
+                                 ("data=" + quote(json.dumps({"event": "open app"}), safe=""), (("event",), "open app")),
+                                 ("data=" + quote(json.dumps({"a+b": "1+1"}), safe=""), (("a+b",), "1+1"))]:
+        if expected_kv not in extract_key_val_pairs.process_separated_text(payload)[0]:
+            print("ERROR: process_separated_text does not extract %r from: %r" % (expected_kv, payload))
+            exit(1)
+    added_pairs = 0
+    for payload in separated_payloads:
+        old_kvs = process_separated_text_two_passes(payload)
+        new_kvs = extract_key_val_pairs.process_separated_text(payload)
+        for old, new in zip(old_kvs, new_kvs):
+            if count_missing_pairs(old, new) > 0:
+                print("ERROR: process_separated_text misses key-value pairs of the original implementation for: %r" % payload[:200])
+                exit(1)
+            added_pairs += len(new) - len(old)
+    separated_mb = sum(len(p) for p in separated_payloads) / 1e6
+    print("[+] All the original key-value pairs extracted from the %d separated payloads (%.1f MB), and %d pairs of percent-encoded JSON values" %
+          (len(separated_payloads), separated_mb, added_pairs))
+    # The payloads with percent-encoded JSON values are timed apart, as only the one-pass split searches these values
+    encoded_payloads = [p for p in separated_payloads if "%7" in p or "%5" in p]
+    other_payloads = [p for p in separated_payloads if "%7" not in p and "%5" not in p]
+    for payloads_name, payloads in [("without encoded JSON", other_payloads), ("with encoded JSON", encoded_payloads)]:
+        payloads_mb = sum(len(p) for p in payloads) / 1e6
+        for name, process in [("two passes", process_separated_text_two_passes), ("one pass", extract_key_val_pairs.process_separated_text)]:
+            elapsed = time_separated_text(process, payloads, args.repeat)
+            print("[.] %-10s process_separated_text %8.3f s per run, %8.1f MB/s (%d payloads %s)" %
+                  (name, elapsed, payloads_mb / max(elapsed, 1e-9), len(payloads), payloads_name))
@@ -12,6 +12,7 @@ import unicodedata
 import unicodecsv as csv
 import glob
 from utils import utils
+from utils import records
 
 json_key_protocol = "protocol"
 json_key_src_ip = "src_ip"   #not in har
@@ -21,7 +22,7 @@ json_key_tcp_stream = "tcp.stream"
 json_key_pii_found = "pii_types"
 json_key_package_name = "package_name"   #not in har
 json_key_http_body = "http.file_data"
-overall_block_decision = "overall_block_decision" # 1 if at least one block decision is 1
+overall_block_decision = utils.json_key_overall_block_decision # 1 if at least one block decision is 1
 
 
 DIFFAUDIT = "diffaudit"
@@ -29,64 +30,63 @@ ACCEPTED_FILE_NAMING_FORMATS = [DIFFAUDIT]
 
 
 def write_block_decisions_to_csv(app_id, filter_list_names, full_path, csv_writer, include_http_body=False, website=False):
-    with open(full_path, "r") as jf:
-        data = json.load(jf)
-        for key, value in data.items():
-            if website:
-                pkt = value
-                protocol = pkt.get(json_key_protocol, "")
-                dst_ip = pkt[json_key_dst_ip]
-                dst_port = pkt[json_key_dst_port]
-                host = pkt.get(utils.json_key_host, "")
-                path = pkt.get(utils.json_key_uri, "")
-                piis_found = pkt.get(json_key_pii_found, "[]")
-                package_name = pkt.get(json_key_package_name, "")
-                headers = json.dumps(pkt[utils.json_key_headers]) if utils.json_key_headers in pkt else ""
-                src_ip = ""
-                tcp_stream = pkt[json_key_tcp_stream]
+    # The annotated NoMoAds file is read one packet at a time
+    for key, value in records.iter_records(full_path):
+        if website:
+            pkt = value
+            protocol = pkt.get(json_key_protocol, "")
+            dst_ip = pkt[json_key_dst_ip]
+            dst_port = pkt[json_key_dst_port]
+            host = pkt.get(utils.json_key_host, "")
+            path = pkt.get(utils.json_key_uri, "")
+            piis_found = pkt.get(json_key_pii_found, "[]")
+            package_name = pkt.get(json_key_package_name, "")
+            headers = json.dumps(pkt[utils.json_key_headers]) if utils.json_key_headers in pkt else ""
+            src_ip = ""
+            tcp_stream = pkt[json_key_tcp_stream]
 
-            else:
-                pkt = value
-                protocol = pkt.get(json_key_protocol, "")
-                src_ip = pkt[json_key_src_ip]
-                dst_ip = pkt[json_key_dst_ip]
-                dst_port = pkt[json_key_dst_port]
-                tcp_stream = pkt[json_key_tcp_stream]
-                host = pkt.get(utils.json_key_host, "")
-                path = pkt.get(utils.json_key_uri, "")
-                piis_found = pkt.get(json_key_pii_found, "[]")
-                package_name = pkt.get(json_key_package_name, "")
-                headers = json.dumps(pkt[utils.json_key_headers]) if utils.json_key_headers in pkt else ""
-
-            row = [app_id,
-                key,
-                protocol,
-                src_ip,
-                dst_ip,
-                dst_port,
-                tcp_stream,
-                host,
-                path,
-                headers,
-                piis_found,
-                package_name]
-
-            if include_http_body:
-                data = pkt.get(json_key_http_body, "").split()
-                temp = [i.replace('\x00','') for i in data]
-                data = "".join(temp)
-                cleaned_data = unicodedata.normalize('NFKD', data).encode('ascii', 'ignore').decode('ascii')
-                row.append(cleaned_data)
-
-            overall_block_flag = 0
-            for fl in filter_list_names:
-                row.append(pkt[fl])
-                if pkt[fl] == 1:
-                    overall_block_flag = 1
-            # add overall block decision based on all the block lists (if any are 1, ats block)
-            row.append(overall_block_flag)  # 0 if all the block lists gave 0, otherwise 1
-
-            csv_writer.writerow(row)
+        else:
+            pkt = value
+            protocol = pkt.get(json_key_protocol, "")
+            src_ip = pkt[json_key_src_ip]
+            dst_ip = pkt[json_key_dst_ip]
+            dst_port = pkt[json_key_dst_port]
+            tcp_stream = pkt[json_key_tcp_stream]
+            host = pkt.get(utils.json_key_host, "")
+            path = pkt.get(utils.json_key_uri, "")
+            piis_found = pkt.get(json_key_pii_found, "[]")
+            package_name = pkt.get(json_key_package_name, "")
+            headers = json.dumps(pkt[utils.json_key_headers]) if utils.json_key_headers in pkt else ""
+
+        row = [app_id,
+            key,
+            protocol,
+            src_ip,
+            dst_ip,
+            dst_port,
+            tcp_stream,
+            host,
+            path,
+            headers,
+            piis_found,
+            package_name]
+
+        if include_http_body:
+            data = pkt.get(json_key_http_body, "").split()
+            temp = [i.replace('\x00','') for i in data]
+            data = "".join(temp)
+            cleaned_data = unicodedata.normalize('NFKD', data).encode('ascii', 'ignore').decode('ascii')
+            row.append(cleaned_data)
+
+        overall_block_flag = 0
+        for fl in filter_list_names:
+            row.append(pkt[fl])
+            if pkt[fl] == 1:
+                overall_block_flag = 1
+        # add overall block decision based on all the block lists (if any are 1, ats block)
+        row.append(overall_block_flag)  # 0 if all the block lists gave 0, otherwise 1
+
+        csv_writer.writerow(row)
 
 
 def file_naming_format(format):
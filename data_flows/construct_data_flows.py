@@ -18,6 +18,7 @@ import time
 import subprocess
 import shutil
 from utils import utils
+from utils import records
 
 DATASET_ROOT_DIR = 'dataset_root_dir'
 TRACKER_RADAR_DIR = 'tracker-radar-main'
@@ -37,12 +38,38 @@ ATS_FLAG = "overall_block_decision"
 csv.field_size_limit(sys.maxsize)
 
 
+def get_key_paths(kv_record):
+    ## Key paths of the pairs extracted from a packet, from a full or a keys-only (--keys_only) file. The values are not needed
+    if utils.extracted_keys in kv_record:
+        return kv_record[utils.extracted_keys]
+    if utils.all_extracted_kvs in kv_record:
+        return [tup[0] for tup in kv_record[utils.all_extracted_kvs]]
+    return None
+
+
+def read_key_paths(input_json_file):
+    ## Key paths and template id of each packet. Packets with the same template (request shape) have the same set of key
+    ## paths, so they share the key paths of the first one
+    extracted_key_paths = {}
+    template_key_paths = {}
+    for pkt_id, kv_record in records.iter_records(input_json_file):
+        template = kv_record.get(utils.template_id)
+        if template is None:
+            extracted_key_paths[pkt_id] = (None, get_key_paths(kv_record))
+        else:
+            if template not in template_key_paths:
+                template_key_paths[template] = get_key_paths(kv_record)
+            extracted_key_paths[pkt_id] = (template, template_key_paths[template])
+    print(f"[.] {len(extracted_key_paths)} packets, {len(template_key_paths)} request templates")
+    return extracted_key_paths
+
+
 def helper_extract(input_csv_file, input_json_file):
     ## Extracts key-value pairs for each trace data file (JSON structures were previously extracted from packet payloads in process_pcaps.py pipeline)
     in_csv_file = open(input_csv_file, 'r')
     csv_reader = csv.DictReader(in_csv_file, delimiter=',', quotechar='"')
-    with open(input_json_file, "r") as infile:
-        extracted_kv_data = json.load(infile)
+    # Only keep the key paths (and template id) of each packet in memory
+    extracted_key_paths = read_key_paths(input_json_file)
     
     # output name for profile category
     out_name = input_csv_file[:-4].split('/')[-1]
@@ -53,14 +80,16 @@ def helper_extract(input_csv_file, input_json_file):
         # payload = in_row[json_keys.http_body]
         pkt_id = in_row[utils.id]
         row = {}
-        if utils.all_extracted_kvs in extracted_kv_data[pkt_id].keys():
+        template, key_paths = extracted_key_paths[pkt_id]
+        if key_paths is not None:
             row[pkt_id] = {
                 HOST: in_row[HOST], 
                 utils.dst_ip: in_row[utils.dst_ip],
                 PARTY_LABEL: in_row[PARTY_LABEL],
                 ESLD: in_row[ESLD],
-                JSON_FIELD_KVS: extracted_kv_data[pkt_id][utils.all_extracted_kvs],
-                ATS_FLAG: in_row[ATS_FLAG]
+                JSON_FIELD_KVS: key_paths,
+                ATS_FLAG: in_row[ATS_FLAG],
+                utils.template_id: template
             }
             out_dict.append(row)
 
@@ -69,11 +98,11 @@ def helper_extract(input_csv_file, input_json_file):
 
 
 
-def clean_keys(kv_pairs_tuples):
+def clean_keys(key_paths):
     ## Cleans up punctuation from extracted keys to prepare for labeling
     clean_keys_set = set() 
-    for tup in kv_pairs_tuples:
-        for i in tup[0]:
+    for key_path in key_paths:
+        for i in key_path:
             if isinstance(i, list):
                 for j in i:
                     if (j != '[]') and (j != '~') and (len(j) > 1):
@@ -83,6 +112,22 @@ def clean_keys(kv_pairs_tuples):
     return list(clean_keys_set)
 
 
+def normalize_keys(key_paths):
+    ## Cleans up the extracted keys and normalizes them (punctuation, case) for labeling, skipping file names, domains, and numbers
+    new_list = set()
+    for i in clean_keys(key_paths):
+        # remove puncutation
+        new_text = i.replace("_", " ")
+        new_text = new_text.replace("-", " ")
+        new_text = new_text.replace("/", " ")
+        new_text = (new_text.strip(" ")).lower()
+        if '.min.js' in new_text or '.css' in new_text or '.png' in new_text or '.jpg' in new_text or '.js' in new_text or '.svg' in new_text or '.com' in new_text or '.net' in new_text:
+            continue
+        if (not new_text.isnumeric()) and (len(new_text) > 1) and (new_text != '[]'):
+            new_list.add(new_text)
+    return list(new_list)
+
+
 def read_from_csvs(platform, trace_select=""):
     ## Reads data from CSV files for specified platform (generated prior from process_pcapspy script)
     traces_dict = {
@@ -95,6 +140,9 @@ def read_from_csvs(platform, trace_select=""):
     all_unique_keys_per_plt = {}
     overall_data_dict = {}
     overall_data_dict_sld = {}
+    # Normalized keys of each request template, so that the keys of the packets with the same request shape are only
+    # cleaned once
+    template_keys = {}
 
     # process each trace directory
     trace_dir_path = traces_dict[trace_select]
@@ -126,26 +174,21 @@ def read_from_csvs(platform, trace_select=""):
                     overall_data_dict[filename] = []
                     overall_data_dict_sld[filename] = []
                     for pkt_id_obj in data:    
-                        for k, v in pkt_id_obj.items():  # v has host, dst_ip, party_label, and kv_pairs
+                        for k, v in pkt_id_obj.items():  # v has host, dst_ip, party_label, and kv_pairs (key paths only)
                             host = v[HOST]
                             party = v[PARTY_LABEL]
                             kvs = v[JSON_FIELD_KVS]
                             sld = v[ESLD]
                             ats_flag = v[ATS_FLAG]
-                            cleaned_keys_list = clean_keys(kvs)
-                            new_list = set()
-                            for i in cleaned_keys_list:
-                                # remove puncutation
-                                new_text = i.replace("_", " ")
-                                new_text = new_text.replace("-", " ")
-                                new_text = new_text.replace("/", " ")
-                                new_text = (new_text.strip(" ")).lower()
-                                if '.min.js' in new_text or '.css' in new_text or '.png' in new_text or '.jpg' in new_text or '.js' in new_text or '.svg' in new_text or '.com' in new_text or '.net' in new_text:
-                                    continue
-                                if (not new_text.isnumeric()) and (len(new_text) > 1) and (new_text != '[]'):
-                                    all_unique_keys_cross_plat.add(new_text)
-                                    all_unique_keys_per_plt[app_name].add(new_text)
-                                    new_list.add(new_text)
+                            template = v[utils.template_id]
+                            if template is None:
+                                new_list = normalize_keys(kvs)
+                            else:
+                                if template not in template_keys:
+                                    template_keys[template] = normalize_keys(kvs)
+                                new_list = template_keys[template]
+                            all_unique_keys_cross_plat.update(new_list)
+                            all_unique_keys_per_plt[app_name].update(new_list)
                             overall_data_dict[filename].append((host, party, list(new_list)))
                             overall_data_dict_sld[filename].append((sld, party, list(new_list), ats_flag, host)) # format: <sld, party, list of keys, ats_flag, HOST>
     return overall_data_dict, all_unique_keys_cross_plat, all_unique_keys_per_plt, overall_data_dict_sld
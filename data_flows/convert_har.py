@@ -8,10 +8,14 @@ import json
 from urllib.parse import urlparse
 import os
 import argparse
-import uuid
+from concurrent.futures import ProcessPoolExecutor
 from tqdm import tqdm
 import extract_key_val_pairs
 from utils import utils
+from utils import records
+from utils import kv_cache
+from utils import kv_telemetry
+from utils import json_stream
 
 OUTPUTS_DIR_NAME = "outputs"
 age_dict = {
@@ -19,57 +23,81 @@ age_dict = {
 	"2": "adult (>=16)",
 	"3": "teen (13-15)"
 } 
+# Fields of the HAR entries used by process_packet, the others (e.g., the responses and their bodies) are skipped
+HAR_ENTRY_KEYS = ("request", "serverIPAddress", "connection")
+# Limits on the work done to extract the key-value pairs of each payload (URL, headers, body), 0 for no limit. See extract_key_val_pairs.ExtractionBudget
+kv_limits = {
+	"max_depth": 0,
+	"max_bytes": 0,
+	"max_pairs": 0
+}
+
+def extract_kv_pairs(payload):
+	# Extract the key-value pairs of the payload, or reuse them if the same payload was seen before (shared with extract_from_tshark.py)
+	budget = extract_key_val_pairs.ExtractionBudget(**kv_limits)
+	budget_used = []
+	def extract(payload):
+		budget_used.append(True)
+		return extract_kv_pairs_uncached(payload, budget)
+	kv_pairs = kv_cache.get_or_extract(payload, extract)
+	kv_telemetry.add_payload_cost(payload, kv_pairs, budget if budget_used else None)
+	return kv_pairs
+
+
+def add_template_id(packet, kv_dict):
+	# Fingerprint the request by its host, path, and key set, so that later stages can process each request shape once (see utils.make_template_id)
+	if utils.all_extracted_kvs in kv_dict:
+		key_paths = (kv_pair[0] for kv_pair in kv_dict[utils.all_extracted_kvs])
+		kv_dict[utils.template_id] = utils.make_template_id(packet.get(utils.host), packet.get(utils.uri), key_paths)
+	return kv_dict
+
+
+def count_templates(extracted_kvs_dict):
+	# Number of requests per template id
+	template_counts = {}
+	for kv_dict in extracted_kvs_dict.values():
+		if utils.template_id in kv_dict:
+			template_counts[kv_dict[utils.template_id]] = template_counts.get(kv_dict[utils.template_id], 0) + 1
+	return template_counts
+
+
+def print_template_stats(extracted_kvs_dict):
+	template_counts = count_templates(extracted_kvs_dict)
+	print("[.] Request templates: %d requests with key-value pairs, %d templates" % (sum(template_counts.values()), len(template_counts)))
 
-def extract_kv_pairs(payload):        
-	json_kvs = tuple()
-	ampersand_kvs = tuple()
-	semicolon_kvs = tuple()
+
+def to_keys_only(kv_dict):
+	# Keep only the unique key paths of all the extracted pairs, in order of first appearance (the values are not used by construct_data_flows.py)
+	if utils.all_extracted_kvs not in kv_dict:
+		return {}
+	keys_only_dict = {utils.extracted_keys: list(dict.fromkeys(kv_pair[0] for kv_pair in kv_dict[utils.all_extracted_kvs]))}
+	if utils.template_id in kv_dict:
+		keys_only_dict[utils.template_id] = kv_dict[utils.template_id]
+	return keys_only_dict
+
+
+def extract_kv_pairs_uncached(payload, budget=None):
+	json_kvs = []
+	ampersand_kvs = []
+	semicolon_kvs = []
 	# Check if this is JSON or ampersand/semicolon-separated structure
 	if payload.startswith('[') or payload.startswith('{'):
-		for k, v in extract_key_val_pairs.recursive_find_json_items(payload):
-			json_kvs += ((k, v),)
+		for k, v in extract_key_val_pairs.recursive_find_json_items(payload, budget=budget):
+			json_kvs.append((k, v))
 			if isinstance(v, str) and ("&" in v or ";" in v):
 				## value may also contain ampersand or semicolon separated structure, so process v as well
-				for subk, subv, v_dict in extract_key_val_pairs.process_ampersand_separated_text(v):
-					if v_dict == '':
-						ampersand_kvs += ((subk, subv),)
-					else:
-						ampersand_kvs += ((subk, subv),)
-						for tup in v_dict:
-							ampersand_kvs += ((tup[0], tup[1]), )  #add the kvs from the sub json structure of the amp separated text
-				for subk, subv, v_dict in extract_key_val_pairs.process_semicolon_separated_text(v):
-					if v_dict == '':
-						semicolon_kvs += ((subk, subv),)
-					else:
-						semicolon_kvs += ((subk, subv),)
-						for tup in v_dict:
-							semicolon_kvs += ((tup[0], tup[1]), )  #add the kvs from the sub json structure of the amp separated text
+				value_ampersand_kvs, value_semicolon_kvs = extract_key_val_pairs.process_separated_text(v, budget)
+				ampersand_kvs.extend(value_ampersand_kvs)
+				semicolon_kvs.extend(value_semicolon_kvs)
 	## otherwise, the overall structure is not json, so process ampersand or semicolon strucutre
 	else:
-		for k, v, v_dict in extract_key_val_pairs.process_ampersand_separated_text(payload):
-			if v_dict == '':
-				ampersand_kvs += ((k, v),)
-			else:
-				ampersand_kvs += ((k, v),)
-				for tup in v_dict:
-					ampersand_kvs += ((tup[0], tup[1]), )  #add the kvs from the sub json structure of the amp separated text
-		for k, v, v_dict in extract_key_val_pairs.process_semicolon_separated_text(payload):
-			if v_dict == '':
-				semicolon_kvs += ((k, v),)
-			else:
-				semicolon_kvs += ((k, v),)
-				for tup in v_dict:
-					semicolon_kvs += ((tup[0], tup[1]), )  #add the kvs from the sub json structure of the amp separated text
+		ampersand_kvs, semicolon_kvs = extract_key_val_pairs.process_separated_text(payload, budget)
 
 	# Merge all kv pairs found
-	kv_pairs = []
-	for t in json_kvs:
-		kv_pairs.append((t[0], t[1]))
-	for t in ampersand_kvs:
-		kv_pairs.append((t[0], t[1]))
-	for t in semicolon_kvs:
-		kv_pairs.append((t[0], t[1]))
-	
+	kv_pairs = json_kvs + ampersand_kvs + semicolon_kvs
+	if budget is not None and budget.max_pairs and len(kv_pairs) > budget.max_pairs:
+		budget.limits_hit.add(extract_key_val_pairs.LIMIT_PAIRS)
+		del kv_pairs[budget.max_pairs:]
 	return kv_pairs
 
 
@@ -143,119 +171,221 @@ def process_packet(entry):
 		return entry_dict, kv_dict
 
 
-def extract_from_har(har_path, show_progress=False, har_parsed_dict={}, extraced_kvs_parsed_dict={}):
+def find_har_entries(har_reader):
+	# Move the reader to the start of the log.entries array of the HAR file, skipping the fields before it without decoding them
+	# Returns False if the HAR file has no log.entries
+	for key in har_reader.iter_object_keys():
+		if key == 'log':
+			for log_key in har_reader.iter_object_keys():
+				if log_key == 'entries':
+					return True
+				har_reader.skip_value()
+			return False
+		har_reader.skip_value()
+	return False
+
+
+def read_har_entry(har_reader):
+	# Read the next HAR entry, with only the fields in HAR_ENTRY_KEYS (the response content is never decoded, and can be much larger than the request)
+	entry = {}
+	for key in har_reader.iter_object_keys():
+		if key in HAR_ENTRY_KEYS:
+			entry[key] = har_reader.decode_value()
+		else:
+			har_reader.skip_value()
+	return entry
+
+
+def extract_from_har(har_path, show_progress=False, har_parsed_dict=None, extraced_kvs_parsed_dict=None, keys_only=False):
 	# Extracts only the needed information from provided HAR file and outputs a JSON dictionary
+	# The entries are added to har_parsed_dict and extraced_kvs_parsed_dict if given, or else to new dicts
+	if har_parsed_dict is None:
+		har_parsed_dict = {}
+	if extraced_kvs_parsed_dict is None:
+		extraced_kvs_parsed_dict = {}
 
-	# Read and open HAR file
+	# Read and open HAR file, the entries are read one at a time so that the whole file (with the response bodies) is never in memory
 	with open (har_path, 'r', encoding='utf-8-sig') as har_file:
-		har_raw = json.load(har_file)
-
-	if 'log' not in har_raw.keys():
-		# if no "log" in the har file keys, then it is malformed somehow
-		# continue parsing the rest of the files and just skip malformed ones
-		print("### ERROR: malformed HAR file. Skipped {har_path}.")
-		return har_parsed_dict 
-
-	num_entries = len(har_raw['log']['entries'])		
-	with tqdm(total=num_entries, disable=(not show_progress)) as pbar:
-		for entry in har_raw['log']['entries']:
-			processed_packet, extracted_kvs_dict = process_packet(entry)
-			if processed_packet != {}: # don't save the non-post messages (which are returned as empty dictionary from process_packet)
-				# Make unique ID for each entry and store in dictionary format
-				uid = str(uuid.uuid1())
-				har_parsed_dict[uid] = processed_packet
-				extraced_kvs_parsed_dict[uid] = extracted_kvs_dict
-			pbar.update(1)
+		har_reader = json_stream.JSONStreamReader(har_file)
+		if not find_har_entries(har_reader):
+			# if no "log" in the har file keys, then it is malformed somehow
+			# continue parsing the rest of the files and just skip malformed ones
+			print(f"### ERROR: malformed HAR file. Skipped {har_path}.")
+			return har_parsed_dict, extraced_kvs_parsed_dict
+
+		with tqdm(disable=(not show_progress)) as pbar:
+			for entry_index in har_reader.iter_array_items():
+				entry = read_har_entry(har_reader)
+				kv_telemetry.start_packet()
+				processed_packet, extracted_kvs_dict = process_packet(entry)
+				if processed_packet != {}: # don't save the non-post messages (which are returned as empty dictionary from process_packet)
+					add_template_id(processed_packet, extracted_kvs_dict)
+					# Make unique ID for each entry (from the HAR file and entry index, stable across runs) and store in dictionary format
+					uid = utils.make_packet_id(har_path, entry_index)
+					har_parsed_dict[uid] = processed_packet
+					extraced_kvs_parsed_dict[uid] = to_keys_only(extracted_kvs_dict) if keys_only else extracted_kvs_dict
+					kv_telemetry.end_packet(uid, os.path.basename(har_path))
+				pbar.update(1)
 
 	return har_parsed_dict, extraced_kvs_parsed_dict
 
 
-def write_data(data, file_out, permission):
+def write_data(data, file_out, intermediate_format=records.DEFAULT_FORMAT):
     # Write the new data
-    with open(file_out, permission) as jsonfile:
-        jsonfile.seek(0)
-        jsonfile.write(json.dumps(data, sort_keys=True, indent=4))
-        jsonfile.truncate()
+    records.write_records(data, file_out, intermediate_format)
 
 
-def controller(input_dir, output_file_name, trace_select, show_progress=False):
-	# Extracts only the needed information from provided HAR files and outputs one unified JSON file for each website.
+def init_worker(limits, log_cost):
+	# Initializer of the worker processes: same extraction limits as the parent process, which also writes the extraction cost of the entries
+	kv_limits.update(limits)
+	if log_cost:
+		kv_telemetry.open_buffer()
+
+
+def convert_har_file(har_path, keys_only=False):
+	# Convert one HAR file in a worker process, and return its entries with the extraction cost rows and kv cache lookups to merge in the parent process
+	stats_before = kv_cache.get_cache_stats()
+	har_parsed_dict, extracted_kvs_dict = extract_from_har(har_path, keys_only=keys_only)
+	stats = kv_cache.get_cache_stats()
+	cache_counts = {key: stats[key] - stats_before[key] for key in ("hits", "misses", "bytes_saved")}
+	return har_parsed_dict, extracted_kvs_dict, kv_telemetry.take_rows(), cache_counts
+
+
+def iter_converted_har_files(har_file_paths, show_progress=False, keys_only=False, workers=1):
+	# Convert the HAR files, on a pool of worker processes if workers > 1, and yield the (har_parsed_dict, extracted_kvs_dict) of each file in the order of har_file_paths
+	# Each worker has its own kv_cache, so the pairs extracted from a file are only reused for the files of the same worker (of any website, see convert_websites)
+	if workers <= 1 or len(har_file_paths) <= 1:
+		for har_path in har_file_paths:
+			if show_progress: print(f"Extracting data from {har_path}...")
+			yield extract_from_har(har_path, show_progress, keys_only=keys_only)
+		return
+
+	workers = min(workers, len(har_file_paths))
+	if show_progress: print(f"Extracting data from {len(har_file_paths)} HAR files using {workers} workers...")
+	kv_telemetry.flush_log()
+	with ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(dict(kv_limits), kv_telemetry.is_enabled())) as executor:
+		results = executor.map(convert_har_file, har_file_paths, [keys_only] * len(har_file_paths))
+		for har_path, (har_parsed_dict, extracted_kvs_dict, cost_rows, cache_counts) in zip(har_file_paths, results):
+			if show_progress: print(f"Extracted data from {har_path}")
+			kv_telemetry.write_rows(cost_rows)
+			kv_cache.add_cache_counts(**cache_counts)
+			yield har_parsed_dict, extracted_kvs_dict
+
+
+def get_website_outputs(input_dir, output_file_name, trace_select, show_progress=False):
+	# The (HAR files, output file, output kvs file) of each unified JSON file of a website, or None if the website cannot be converted
 
 	if not os.path.isdir(input_dir):
 		print("### ERROR: input directory missing or incorrectly named")
-		return False
+		return None
 	
+	# (HAR files, output file, output kvs file) of each unified JSON file
+	outputs = []
 	if trace_select == "logged_in_trace" or trace_select == "full_trace":
 		if show_progress: print(f"\nInput Directory: {input_dir}")
-		age_category_dirs = [i for i in os.listdir(input_dir) if i != '.DS_Store' and i != 'csv_files' and i != 'outputs']
+		age_category_dirs = sorted(i for i in os.listdir(input_dir) if i != '.DS_Store' and i != 'csv_files' and i != 'outputs')
 		for age_category_dir in age_category_dirs:
-			har_file_paths = [ (input_dir + os.sep + age_category_dir + os.sep + i) for i in (os.listdir(input_dir + os.sep + age_category_dir)) if i != ".DS_Store" and ".har" in i ]
+			har_file_paths = sorted( (input_dir + os.sep + age_category_dir + os.sep + i) for i in (os.listdir(input_dir + os.sep + age_category_dir)) if i != ".DS_Store" and ".har" in i )
 			# Verify that age profile har files match the enclosing directory
 			for path in har_file_paths:
 				age_cat = path.split("_")[-3][-1]
 				if age_cat != age_category_dir:
 					print("### ERROR: har file age category in file name does not match the enclosing directory age category")
-					return False
-
-			# Iterate over each HAR file in input directory and convert data to one unified JSON 
-			output_dict, extracted_kvs_dict = {}, {}
-			for har_path in har_file_paths:
-				# Extract from har and update the output_dict for each file in the directory
-				age_category = har_path.split("_")[-3][-1]
-				if show_progress: print(f"Extracting data from {har_path} (age category {age_category}: {age_dict[age_category]})...")
-				output_dict, extracted_kvs_dict = extract_from_har(har_path, show_progress, output_dict, extracted_kvs_dict)
+					return None
+			if show_progress: print(f"Age category {age_category_dir} ({age_dict.get(age_category_dir, 'unknown')}): {len(har_file_paths)} HAR files")
 
-			#  Write dict to output JSON files, and save into the corresponding age category directory
+			#  Output JSON files, saved into the corresponding age category directory
 			output_file_split = output_file_name.split("-") 
 			output_file_split.insert(1, age_category_dir)
 			output_file_join = '-'.join([str(i) for i in output_file_split]) 
 			output_file = input_dir + os.sep + age_category_dir + os.sep + output_file_join 
-			write_data(output_dict, output_file, 'w')
-
-			if not os.path.exists(input_dir + os.sep + OUTPUTS_DIR_NAME):
-				os.makedirs(input_dir + os.sep + OUTPUTS_DIR_NAME)
 			output_kvs_file = input_dir + os.sep + OUTPUTS_DIR_NAME + os.sep + (output_file_join.replace('-out-nomoads.json', '-extracted_kv_pairs.json')) # i.e., website/Roblox/outputs/Roblox-1-extracted_kv_pairs.json
-			write_data(extracted_kvs_dict, output_kvs_file, 'w')
-
-			if show_progress: print(f"[Info] Length of output dictionary: {len(output_dict)}")
-			if show_progress: print(f"[Info] Wrote JSON data to {output_file}")
-			if show_progress: print(f"[Info] Wrote extracted key-value pairs data to {output_kvs_file}\n")
+			outputs.append((har_file_paths, output_file, output_kvs_file))
 	
 	elif trace_select == "logged_out_trace":
 		if show_progress: print(f"\nInput Directory: {input_dir}")		
-		har_file_paths = [ (input_dir + os.sep + i) for i in (os.listdir(input_dir)) if i != ".DS_Store" and ".har" in i ]
-
-		# Iterate over each HAR file in input directory and convert data to one unified JSON
-		output_dict, extracted_kvs_dict = {}, {}
-		for har_path in har_file_paths:
-			# Extract from har and update the output_dict for each file in the directory
-			if show_progress: print(f"Extracting data from {har_path}...")
-			output_dict, extracted_kvs_dict = extract_from_har(har_path, show_progress, output_dict, extracted_kvs_dict)
-
-		#  Write dict to output JSON files, and save into the corresponding age category directory
+		har_file_paths = sorted( (input_dir + os.sep + i) for i in (os.listdir(input_dir)) if i != ".DS_Store" and ".har" in i )
 		output_file = input_dir + os.sep + output_file_name 
-		write_data(output_dict, output_file, 'w')
-
-		if not os.path.exists(input_dir + os.sep + OUTPUTS_DIR_NAME):
-			os.makedirs(input_dir + os.sep + OUTPUTS_DIR_NAME)
 		output_kvs_file = input_dir + os.sep + OUTPUTS_DIR_NAME + os.sep + (output_file_name.replace('-out-nomoads.json', '-extracted_kv_pairs.json')) # i.e., website/Roblox/outputs/Roblox-extracted_kv_pairs.json
-		write_data(extracted_kvs_dict, output_kvs_file, 'w')
-		if show_progress: print(f"[Info] Length of output dictionary: {len(output_dict)}")
-		if show_progress: print(f"[Info] Wrote JSON data to {output_file}")
-		if show_progress: print(f"[Info] Wrote extracted key-value pairs data to {output_kvs_file}\n")
+		outputs.append((har_file_paths, output_file, output_kvs_file))
 
 	else:
 		print(f"### ERROR: invalid trace select {trace_select}\n")
-		return False
+		return None
+
+	return outputs
+
+
+def convert_websites(websites, show_progress=False, intermediate_format=records.DEFAULT_FORMAT, keys_only=False, workers=1):
+	# Extracts only the needed information from the HAR files of the websites and outputs one unified JSON file for each website (and age category).
+	# websites is a list of (input_dir, output_file_name, trace_select, kv_cost_file) tuples, kv_cost_file can be None.
+	# The HAR files of all the websites are converted on one pool of worker processes if workers > 1
+	# Returns False if a website could not be converted (the other websites are still converted)
+
+	all_converted = True
+	website_outputs = []
+	for input_dir, output_file_name, trace_select, kv_cost_file in websites:
+		outputs = get_website_outputs(input_dir, output_file_name, trace_select, show_progress)
+		if outputs is None:
+			print(f"### ERROR: skipped the HAR files of {input_dir}")
+			all_converted = False
+			continue
+		website_outputs.append((input_dir, kv_cost_file, outputs))
+
+	# Convert the HAR files of all the outputs, and merge the entries of each file in the order of the files, so that the outputs do not depend on the number of workers
+	converted_har_files = iter_converted_har_files([path for _, _, outputs in website_outputs for har_file_paths, _, _ in outputs for path in har_file_paths], show_progress, keys_only, workers)
+	for input_dir, kv_cost_file, outputs in website_outputs:
+		# The extraction cost of the entries is logged as they are merged, to the file of their website
+		if kv_cost_file is not None:
+			kv_telemetry.close_log()
+			kv_telemetry.open_log(kv_cost_file)
+		for har_file_paths, output_file, output_kvs_file in outputs:
+			output_dict, extracted_kvs_dict = {}, {}
+			for _ in har_file_paths:
+				har_parsed_dict, har_extracted_kvs_dict = next(converted_har_files)
+				output_dict.update(har_parsed_dict)
+				extracted_kvs_dict.update(har_extracted_kvs_dict)
+
+			#  Write dict to output JSON files
+			write_data(output_dict, output_file, intermediate_format)
+
+			if not os.path.exists(input_dir + os.sep + OUTPUTS_DIR_NAME):
+				os.makedirs(input_dir + os.sep + OUTPUTS_DIR_NAME)
+			write_data(extracted_kvs_dict, output_kvs_file, intermediate_format)
+			if show_progress: print_template_stats(extracted_kvs_dict)
+			if show_progress: print(f"[Info] Length of output dictionary: {len(output_dict)}")
+			if show_progress: print(f"[Info] Wrote JSON data to {output_file}")
+			if show_progress: print(f"[Info] Wrote extracted key-value pairs data to {output_kvs_file}\n")
+	kv_telemetry.close_log()
+
+	return all_converted
 
-	return True
+
+def controller(input_dir, output_file_name, trace_select, show_progress=False, intermediate_format=records.DEFAULT_FORMAT, keys_only=False, workers=1):
+	# Extracts only the needed information from provided HAR files and outputs one unified JSON file for each website.
+	# The HAR files of all the age categories are converted on a pool of worker processes if workers > 1
+	return convert_websites([(input_dir, output_file_name, trace_select, None)], show_progress, intermediate_format, keys_only, workers)
 
 if __name__ == '__main__':
 	ap = argparse.ArgumentParser(description="Converts HAR files into JSON")
-	ap.add_argument('--har_dir', required=True, help='Directory where the HAR files for one website are located')
-	ap.add_argument('--data_out_file_name', required=True, help='Output file name for the resulting JSON file')
-	ap.add_argument('--trace_select', required=True, type=str, help="String to select the traces to process, based on the directory name or all of them within a platform")
+	ap.add_argument('--har_dir', required=True, action='append', help='Directory where the HAR files for one website are located (repeat for each website, all the HAR files are converted on one pool of processes)')
+	ap.add_argument('--data_out_file_name', required=True, action='append', help='Output file name for the resulting JSON file (one per --har_dir)')
+	ap.add_argument('--trace_select', required=True, action='append', type=str, help="String to select the traces to process, based on the directory name or all of them within a platform (one per --har_dir)")
 	ap.add_argument('--show_progress', action="store_true", help='Show progress bars and prints statements')
+	ap.add_argument('--keys_only', action="store_true", help='Only store the unique key paths of the extracted key-value pairs of each entry')
+	ap.add_argument('--max_kv_depth', type=int, default=0, help='Maximum nesting depth of JSON strings in JSON string values to extract key-value pairs from (default: 0, no limit)')
+	ap.add_argument('--max_kv_bytes', type=int, default=0, help='Maximum number of characters scanned for JSON in each payload (default: 0, no limit)')
+	ap.add_argument('--max_kv_pairs', type=int, default=0, help='Maximum number of key-value pairs extracted from each payload (default: 0, no limit)')
+	ap.add_argument('--kv_cost_file', action='append', help='CSV file to log the extraction cost (time, bytes scanned, pairs) of each entry to (none, or one per --har_dir)')
+	ap.add_argument('--intermediate_format', choices=records.INTERMEDIATE_FORMATS, default=records.DEFAULT_FORMAT, help='Format of the output files (default: ' + records.DEFAULT_FORMAT + ')')
+	ap.add_argument('--workers', type=int, default=None, help='Number of worker processes that convert HAR files in parallel (default: number of cores)')
 	args = ap.parse_args()
 
-	controller(args.har_dir, args.data_out_file_name, args.trace_select, show_progress=args.show_progress)
+	kv_cost_files = args.kv_cost_file or [None] * len(args.har_dir)
+	if not (len(args.har_dir) == len(args.data_out_file_name) == len(args.trace_select) == len(kv_cost_files)):
+		ap.error("--data_out_file_name, --trace_select, and --kv_cost_file (if any) must be given once per --har_dir")
+
+	kv_limits.update(max_depth=args.max_kv_depth, max_bytes=args.max_kv_bytes, max_pairs=args.max_kv_pairs)
+	convert_websites(list(zip(args.har_dir, args.data_out_file_name, args.trace_select, kv_cost_files)), show_progress=args.show_progress,
+		intermediate_format=args.intermediate_format, keys_only=args.keys_only, workers=args.workers or os.cpu_count() or 1)
+	if args.show_progress: kv_cache.print_cache_stats()
@@ -18,12 +18,17 @@ Script used to extract only the needed information from JSON packet traces gener
 
 import os
 import json
-import uuid
+import heapq
 import argparse
-from convert_har import extract_kv_pairs
+from decimal import Decimal
+from convert_har import extract_kv_pairs, add_template_id, to_keys_only, print_template_stats, kv_limits
 from collections import OrderedDict
-import tldextract
 from utils import utils
+from utils import records
+from utils import kv_cache
+from utils import kv_telemetry
+from utils import domains
+from utils import json_stream
 
 # set of tuples (src port, dst IP) of decrypted connections
 decrypted_tuples = set()
@@ -48,14 +53,179 @@ def parse_object_pairs(pairs):
     return dct
 
 
-def get_tcp_stream_number(pkt):
+def has_projected_layer(fields, protocol):
+    # A protocol is present if either the protocol itself or one of its fields was exported
+    prefix = protocol + "."
+    for field in fields:
+        if field == protocol or field.startswith(prefix):
+            return True
+    return False
+
+
+def projected_to_layers(fields):
+    '''
+    Rebuild the nested _source.layers structure read by the extract_* functions from a packet of a projected tshark
+    export (see merge_cap.py --projected), where each exported field maps to the list of its values.
+    :param fields: the _source.layers object of a packet exported with tshark -T json -e <field> ...
+    :return: The packet layers in the same shape as a full tshark -T json export (restricted to the projected fields).
+    '''
+    def first(field):
+        values = fields.get(field)
+        return values[0] if values else None
+
+    layers = OrderedDict()
+
+    layers[utils.frame] = OrderedDict()
+    for field in [utils.frame_num, utils.frame_ts]:
+        if first(field) is not None:
+            layers[utils.frame][field] = first(field)
+
+    if has_projected_layer(fields, utils.ip):
+        layers[utils.ip] = OrderedDict()
+        for field in [utils.ip + ".src", utils.ip + ".dst"]:
+            layers[utils.ip][field] = first(field)
+
+    if has_projected_layer(fields, utils.tcp):
+        layers[utils.tcp] = OrderedDict()
+        for field in [utils.tcp + ".srcport", utils.tcp + ".dstport", utils.tcpstream]:
+            if first(field) is not None:
+                layers[utils.tcp][field] = first(field)
+
+    if has_projected_layer(fields, utils.http):
+        http_data = OrderedDict()
+        # Method and URI are nested under the request line object in the full export
+        request = OrderedDict()
+        for field in [utils.http_req_method, utils.http_req_uri]:
+            if first(field) is not None:
+                request[field] = first(field)
+        if request:
+            http_data[utils.http + ".request"] = request
+        for line in fields.get(utils.http_req_line, []):
+            http_data[make_unique(utils.http_req_line, http_data)] = line
+        if first(utils.http_body) is not None:
+            http_data[utils.http_body] = first(utils.http_body)
+        layers[utils.http] = http_data
+
+    if has_projected_layer(fields, utils.http2):
+        http_data = OrderedDict()
+        names = fields.get(utils.http2_header_name, [])
+        values = fields.get(utils.http2_header_value, [])
+        uris = fields.get(utils.http2_req_uri, [])
+        # Header names/values of all streams in the frame are flattened into one list, split them by header count
+        counts = [int(count) for count in fields.get(utils.http2_header_count, [])]
+        offset = 0
+        for stream_index, count in enumerate(counts):
+            count = max(0, min(count, len(names) - offset, len(values) - offset))
+            stream = OrderedDict()
+            stream[utils.http2_header_count] = str(count)
+            for i in range(count):
+                key_name = utils.http2_header_first if i == 0 else utils.http2_header_num + str(i)
+                stream[key_name] = OrderedDict([(utils.http2_header_name, names[offset + i]),
+                                                (utils.http2_header_value, values[offset + i])])
+            offset += count
+            if stream_index < len(uris):
+                stream[utils.http2_req_uri] = uris[stream_index]
+            http_data[make_unique(utils.http2_stream, http_data)] = stream
+        if utils.http2_stream not in http_data:
+            http_data[utils.http2_stream] = OrderedDict()
+        if first(utils.http2_body) is not None:
+            http_data[utils.http2_body] = first(utils.http2_body)
+        layers[utils.http2] = http_data
+
+    if has_projected_layer(fields, utils.ssl):
+        tls_layer = OrderedDict()
+        srv_name_key = utils.ssl + ".handshake.extensions_server_name"
+        if first(srv_name_key) is not None:
+            sni_ext_obj = OrderedDict([(srv_name_key, first(srv_name_key))])
+            handshake = OrderedDict([("Extension: server_name", OrderedDict([("Server Name Indication extension", sni_ext_obj)]))])
+            tls_layer[utils.ssl + ".record"] = OrderedDict([(utils.ssl + ".handshake", handshake)])
+        layers[utils.ssl] = tls_layer
+
+    if has_projected_layer(fields, utils.websocket):
+        layers[utils.websocket] = OrderedDict()
+        text = fields.get(utils.websocket + ".payload.text", [])
+        if text or utils.websocketdata in fields:
+            # Line-based text data is keyed by the text lines themselves in the full export
+            data_lines = OrderedDict()
+            for payload in text:
+                for line in payload.splitlines():
+                    data_lines[make_unique(line + "\n", data_lines)] = ""
+            layers[utils.websocketdata] = data_lines
+
+    if has_projected_layer(fields, utils.irc):
+        irc_data = OrderedDict()
+        for field in [utils.irc + ".request", utils.irc + ".response"]:
+            for value in fields.get(field, []):
+                irc_data[make_unique(field, irc_data)] = value
+        layers[utils.irc] = irc_data
+
+    return layers
+
+
+def get_frame_time(layers):
+    # Decimal keeps the nanosecond precision of the epoch timestamps, which a float would lose
+    if utils.frame in layers and utils.frame_ts in layers[utils.frame]:
+        return Decimal(layers[utils.frame][utils.frame_ts])
+    return Decimal(0)
+
+
+def iter_merged_tshark_layers(dir_path, projected=False):
+    '''
+    Merge the packets of the per-file tshark JSON files in a directory (see merge_cap.py --per_file) by timestamp,
+    like mergecap does before dissection. Packets with the same timestamp keep the order of the files.
+    TCP stream numbers are assigned per file by tshark, so they are renumbered in order of first appearance, as
+    tshark does on a merged capture.
+    :param dir_path: Directory of JSON files generated by tshark (-T json), one per PCAP file.
+    :return: A generator of (name of the file the packet comes from, packet layers) tuples.
+    '''
+    json_files = sorted(fn for fn in os.listdir(dir_path) if fn.endswith(".json"))
+    packet_iters = [iter_tshark_layers(os.path.join(dir_path, fn), projected=projected) for fn in json_files]
+
+    stream_numbers = {}
+    for source_name, layers in heapq.merge(*packet_iters, key=lambda item: get_frame_time(item[1])):
+        if utils.tcp in layers and utils.tcpstream in layers[utils.tcp]:
+            file_stream = (source_name, layers[utils.tcp][utils.tcpstream])
+            if file_stream not in stream_numbers:
+                stream_numbers[file_stream] = str(len(stream_numbers))
+            layers[utils.tcp][utils.tcpstream] = stream_numbers[file_stream]
+        yield source_name, layers
+
+
+def iter_tshark_layers(full_path, projected=False):
+    '''
+    Incrementally read a tshark JSON file and yield the _source.layers object of one packet at a time, so that
+    memory use does not grow with the size of the capture.
+    :param full_path: Path to the JSON file generated by tshark (-T json), or to a directory of such files that are
+                      merged by timestamp.
+    :param projected: Whether the file is a projected export (see merge_cap.py --projected).
+    :return: A generator of (name of the file the packet comes from, packet layers) tuples, with duplicate keys made
+             unique as in parse_object_pairs.
+    '''
+    if os.path.isdir(full_path):
+        yield from iter_merged_tshark_layers(full_path, projected=projected)
+        return
+
+    source_name = os.path.basename(full_path)
+    if projected:
+        # Fields are exported as flat lists of values, so there are no duplicate keys here
+        for packet in json_stream.iter_json_array(full_path):
+            yield source_name, projected_to_layers(packet[utils.source][utils.layers])
+        return
+
+    # Since certain json 'keys' appear multiple times in our data, we have to make them
+    # unique first (we can't use regular json.load() or we lose some data points). From:
+    # https://stackoverflow.com/questions/29321677/python-json-parser-allow-duplicate-keys
+    for packet in json_stream.iter_json_array(full_path, object_pairs_hook=parse_object_pairs):
+        yield source_name, packet[utils.source][utils.layers]
+
+
+def get_tcp_stream_number(layers):
     '''
     Extract the TCP stream id/number assigned to this packet by tshark.
-    :param pkt: A packet in tshark json format.
+    :param layers: a packet data from the _source.layers structure in tshark json format.
     :return: The TCP stream id/number assigned by tshark to this packet, or None if the value is not present in the
              packet, e.g., the packet is not a TCP segment.
     '''
-    layers = pkt[utils.source][utils.layers]
     if utils.tcp not in layers:
         return None
     tcp_section = layers[utils.tcp]
@@ -246,122 +416,136 @@ def extract_other_pkt(layers, frame_num, include_http_body=False):
     return new_packet, all_kvs
 
 
-def extract_from_tshark(full_path, data, extracted_kvs_dict, is_decrypted, include_http_body=False):
-    with open(full_path, "r") as jf:
-        # Since certain json 'keys' appear multiple times in our data, we have to make them
-        # unique first (we can't use regular json.load() or we lose some data points). From:
-        # https://stackoverflow.com/questions/29321677/python-json-parser-allow-duplicate-keys
-        decoder = json.JSONDecoder(object_pairs_hook=parse_object_pairs)
-        pcap_data = decoder.decode(jf.read())
-
-        for packet in pcap_data:
-            kv_dict = {}
-
-            layers = packet[utils.source][utils.layers]
-
-            # All captured traffic should have a frame + frame number, but check anyway
-            frame_num = " Frame: "
-            if utils.frame not in layers or utils.frame_num not in layers[utils.frame]:
-                print("WARNING: could not find frame number! Using -1...")
-                frame_num = frame_num + "-1"
-            else:
-                # Save frame number for error-reporting
-                frame_num = frame_num + layers[utils.frame][utils.frame_num]
-
-            # All captured traffic should be IP, but check anyway
-            if not utils.ip in layers:
-                print("WARNING: Non-IP traffic detected!" + frame_num)
-                continue
-
-            # For now we only care about outgoing traffic
-            src_ip = layers[utils.ip][utils.ip + ".src"]
-            dst_ip = layers[utils.ip][utils.ip + ".dst"]
-            if src_ip != utils.PCAPDROID_SRC_IP:
-                continue
-
-            # For now, only care about TCP traffic
-            if not utils.tcp in layers:
-                continue
-
-            src_port = int(layers[utils.tcp][utils.tcp + ".srcport"])
-            dst_port = int(layers[utils.tcp][utils.tcp + ".dstport"])
-
-            # Perform initialization of new_packet in application layer protocol data extraction functions:
-            # Attempt to extract application layer protocol information for each of the protocols that we are interested
-            # in until we successfully hit the protocol (or declare that the packet is not interesting if no match).
-            new_packet = None
-
-            # Check if HTTP first
-            if utils.http in layers:
-                httpv = 1
-                new_packet, kv_dict = extract_http_pkt(layers, frame_num, httpv, include_http_body=include_http_body)
-                # Keep track of decrypted connections by source port and destination IP to avoid double-counting
-                if is_decrypted:
-                    decrypted_tuples.add((src_port, dst_ip))
-
-            elif utils.http2 in layers:
-                httpv = 2
-                new_packet, kv_dict = extract_http_pkt(layers, frame_num, httpv, include_http_body=include_http_body)
-                # Keep track of decrypted connections by source port and destination IP to avoid double-counting
-                if is_decrypted:
-                    decrypted_tuples.add((src_port, dst_ip))
-            
-            # Not HTTP, so try TLS as those may carry the hostname of the server in the SNI.
-            # We skip SNI for flows which were decrypted and where we got the host name from HTTP headers
-            # NOTE: we still save SNI for non-HTTP flows that were decrypted as those do not contain a host field
-            elif utils.ssl in layers and (src_port, dst_ip) not in decrypted_tuples:
-                new_packet = extract_tls_pkt(layers)
-            
+def extract_from_tshark(full_path, data, extracted_kvs_dict, is_decrypted, include_http_body=False, projected=False, single_pass=False,
+                        device_ip=utils.PCAPDROID_SRC_IP, keys_only=False):
+    # (uid, (src port, dst IP)) of the records created from TLS packets, see single_pass below
+    tls_records = []
+
+    for packet_index, (source_name, layers) in enumerate(iter_tshark_layers(full_path, projected=projected), 1):
+        kv_dict = {}
+        is_tls_record = False
+        kv_telemetry.start_packet()
+
+        # All captured traffic should have a frame + frame number, but check anyway
+        frame_num = " Frame: "
+        if utils.frame not in layers or utils.frame_num not in layers[utils.frame]:
+            print("WARNING: could not find frame number! Using -1...")
+            frame_num = frame_num + "-1"
+            # Fall back to the position of the packet for its id
+            frame_index = packet_index
+        else:
+            # Save frame number for error-reporting
+            frame_num = frame_num + layers[utils.frame][utils.frame_num]
+            frame_index = layers[utils.frame][utils.frame_num]
+
+        # All captured traffic should be IP, but check anyway
+        if not utils.ip in layers:
+            print("WARNING: Non-IP traffic detected!" + frame_num)
+            continue
+
+        # For now we only care about outgoing traffic
+        src_ip = layers[utils.ip][utils.ip + ".src"]
+        dst_ip = layers[utils.ip][utils.ip + ".dst"]
+        if src_ip != device_ip:
+            continue
+
+        # For now, only care about TCP traffic
+        if not utils.tcp in layers:
+            continue
+
+        src_port = int(layers[utils.tcp][utils.tcp + ".srcport"])
+        dst_port = int(layers[utils.tcp][utils.tcp + ".dstport"])
+
+        # Perform initialization of new_packet in application layer protocol data extraction functions:
+        # Attempt to extract application layer protocol information for each of the protocols that we are interested
+        # in until we successfully hit the protocol (or declare that the packet is not interesting if no match).
+        new_packet = None
+
+        # Check if HTTP first
+        if utils.http in layers:
+            httpv = 1
+            new_packet, kv_dict = extract_http_pkt(layers, frame_num, httpv, include_http_body=include_http_body)
+            # Keep track of decrypted connections by source port and destination IP to avoid double-counting
+            if is_decrypted:
+                decrypted_tuples.add((src_port, dst_ip))
+
+        elif utils.http2 in layers:
+            httpv = 2
+            new_packet, kv_dict = extract_http_pkt(layers, frame_num, httpv, include_http_body=include_http_body)
+            # Keep track of decrypted connections by source port and destination IP to avoid double-counting
+            if is_decrypted:
+                decrypted_tuples.add((src_port, dst_ip))
+        
+        # Not HTTP, so try TLS as those may carry the hostname of the server in the SNI.
+        # We skip SNI for flows which were decrypted and where we got the host name from HTTP headers
+        # NOTE: we still save SNI for non-HTTP flows that were decrypted as those do not contain a host field
+        elif utils.ssl in layers and (src_port, dst_ip) not in decrypted_tuples:
+            new_packet = extract_tls_pkt(layers)
+            is_tls_record = True
+        
+        else:
+            # Packet not HTTP, so it's not interesting to us.
+            # Some TLS packets still go here, so skip these as well.
+            if not utils.ssl in layers:
+                # We are interested in websocket and irc packets.
+                if utils.websocket in layers and utils.websocketdata in layers:
+                    new_packet, kvs_arr = extract_other_pkt(layers, frame_num, include_http_body=include_http_body)
+                    kv_dict[utils.all_extracted_kvs] += kvs_arr
+                if utils.irc in layers:
+                    new_packet, kvs_arr = extract_other_pkt(layers, frame_num, include_http_body=include_http_body)
+                    kv_dict[utils.all_extracted_kvs] += kvs_arr
             else:
-                # Packet not HTTP, so it's not interesting to us.
-                # Some TLS packets still go here, so skip these as well.
-                if not utils.ssl in layers:
-                    # We are interested in websocket and irc packets.
-                    if utils.websocket in layers and utils.websocketdata in layers:
-                        new_packet, kvs_arr = extract_other_pkt(layers, frame_num, include_http_body=include_http_body)
-                        kv_dict[utils.all_extracted_kvs] += kvs_arr
-                    if utils.irc in layers:
-                        new_packet, kvs_arr = extract_other_pkt(layers, frame_num, include_http_body=include_http_body)
-                        kv_dict[utils.all_extracted_kvs] += kvs_arr
-                else:
-                    continue
-
-            if new_packet is None or kv_dict == {}:
-                new_packet = {}
-                ## don't skip - we still want to get src and destination 
-
-            # Fill our new JSON packet with TCP/IP info and other common info
-            new_packet[utils.src_ip] = src_ip
-            new_packet[utils.dst_ip] = dst_ip
-            new_packet[utils.dst_port] = dst_port
-
-            # Extract the tcp stream id/number, if any
-            tcp_stream_id = get_tcp_stream_number(packet)
-            if tcp_stream_id is not None:
-                new_packet[utils.tcpstream] = tcp_stream_id
-
-            # Extract timestamp
-            if utils.frame_ts not in layers[utils.frame]:
-                print("WARNING: could not find timestamp!" + frame_num)
                 continue
 
-            new_packet["ts"] = layers[utils.frame][utils.frame_ts]
-
-            # Create a unique key for each packet to keep consistent with ReCon
-            # Also good in case packets end up in different files
-            uid = str(uuid.uuid4()) 
-            data[uid] = new_packet
-            extracted_kvs_dict[uid] = kv_dict
+        if new_packet is None or kv_dict == {}:
+            new_packet = {}
+            ## don't skip - we still want to get src and destination 
+
+        # Fill our new JSON packet with TCP/IP info and other common info
+        new_packet[utils.src_ip] = src_ip
+        new_packet[utils.dst_ip] = dst_ip
+        new_packet[utils.dst_port] = dst_port
+
+        # Extract the tcp stream id/number, if any
+        tcp_stream_id = get_tcp_stream_number(layers)
+        if tcp_stream_id is not None:
+            new_packet[utils.tcpstream] = tcp_stream_id
+
+        # Extract timestamp
+        if utils.frame_ts not in layers[utils.frame]:
+            print("WARNING: could not find timestamp!" + frame_num)
+            continue
+
+        new_packet["ts"] = layers[utils.frame][utils.frame_ts]
+        add_template_id(new_packet, kv_dict)
+
+        # Create a unique key for each packet to keep consistent with ReCon
+        # The key only depends on the base name of the source file and the frame number, so that the outputs are the
+        # same across runs. It is only unique within one output file pair: the merged captures of all apps have the
+        # same base name, so the same frame number gets the same key in the outputs of different apps.
+        uid = make_unique(utils.make_packet_id(source_name, frame_index), data)
+        data[uid] = new_packet
+        extracted_kvs_dict[uid] = to_keys_only(kv_dict) if keys_only else kv_dict
+        kv_telemetry.end_packet(uid, source_name)
+        if is_tls_record:
+            tls_records.append((uid, (src_port, dst_ip)))
+
+    if single_pass:
+        # Encrypted and decrypted packets come from the same capture (see merge_cap.py -keylog), so the TLS packets
+        # (e.g., Client Hello with SNI) of a decrypted connection are seen before its first HTTP packet. Drop them
+        # now, as they would have been skipped if the decrypted traffic had been extracted first.
+        for uid, conn in tls_records:
+            if conn in decrypted_tuples:
+                del data[uid]
+                del extracted_kvs_dict[uid]
 
     host_dict = {}
     for k, v in data.items():
         if utils.host in v.keys():
             if v[utils.dst_ip] in host_dict.keys():
                 if host_dict[v[utils.dst_ip]] != v[utils.host]:
-                    opt1 = tldextract.extract( v[utils.host])
-                    opt2 = tldextract.extract( host_dict[v[utils.dst_ip]])
-                    sld1 = opt1.domain + "." + opt1.suffix
-                    sld2 = opt2.domain + "." + opt2.suffix
+                    sld1 = domains.get_second_level_domain(v[utils.host])
+                    sld2 = domains.get_second_level_domain(host_dict[v[utils.dst_ip]])
                     if sld1 == sld2:
                         host_dict[v[utils.dst_ip]] = sld1
                     else:
@@ -378,23 +562,21 @@ def extract_from_tshark(full_path, data, extracted_kvs_dict, is_decrypted, inclu
     return data, extracted_kvs_dict
 
 
-def write_data(data, file_out, permission):
+def write_data(data, file_out, intermediate_format=records.DEFAULT_FORMAT):
     # Write the new data
-    with open(file_out, permission) as jf:
-        jf.seek(0)
-        jf.write(json.dumps(data, sort_keys=True, indent=4))
-        jf.truncate()
+    records.write_records(data, file_out, intermediate_format)
 
 
-def extract(tshark_file_enc, tshark_file_dec, nomoads_out_file, kvs_out_file, **kwargs):
+def extract(tshark_file_enc, tshark_file_dec, nomoads_out_file, kvs_out_file, intermediate_format=records.DEFAULT_FORMAT, **kwargs):
     """
     Extracts only the needed information from provided JSON packet traces and labels them
     :param tshark_file: JSON file containing data extracted via tshark
     :param out_file: File to write results to
+    :param intermediate_format: Format of the output files (see utils/records.py)
     :return: True on success, False on failure
     """
 
-    if not (os.path.isfile(tshark_file_enc) or os.path.isfile(tshark_file_dec)):
+    if not (os.path.exists(tshark_file_enc) or os.path.exists(tshark_file_dec)):
         print("ERROR: invalid argument")
         return False
 
@@ -408,21 +590,71 @@ def extract(tshark_file_enc, tshark_file_dec, nomoads_out_file, kvs_out_file, **
     data, extracted_kvs_dict = extract_from_tshark(tshark_file_enc, data, extracted_kvs_dict, False, **kwargs)
 
     ## write nomoads json file
-    write_data(data, nomoads_out_file, "w")
+    write_data(data, nomoads_out_file, intermediate_format)
+
+    ## write outputs kvs data
+    write_data(extracted_kvs_dict, kvs_out_file, intermediate_format)
+    print_template_stats(extracted_kvs_dict)
+
+    return True
+
+
+def extract_single_pass(tshark_file, nomoads_out_file, kvs_out_file, intermediate_format=records.DEFAULT_FORMAT, **kwargs):
+    """
+    Same as extract(), but for a single JSON packet trace that holds both the decrypted and the still encrypted
+    traffic (see merge_cap.py -keylog)
+    :param tshark_file: JSON file containing data extracted via tshark with TLS keys
+    :return: True on success, False on failure
+    """
+
+    if not os.path.exists(tshark_file):
+        print("ERROR: invalid argument")
+        return False
+
+    data, extracted_kvs_dict = extract_from_tshark(tshark_file, {}, {}, True, single_pass=True, **kwargs)
+
+    ## write nomoads json file
+    write_data(data, nomoads_out_file, intermediate_format)
 
     ## write outputs kvs data
-    write_data(extracted_kvs_dict, kvs_out_file, "w")
+    write_data(extracted_kvs_dict, kvs_out_file, intermediate_format)
+    print_template_stats(extracted_kvs_dict)
 
     return True
 
 
 if __name__ == '__main__':
     ap = argparse.ArgumentParser(description="Converts tshark JSON output into NoMoAds JSON format")
-    ap.add_argument('--enc_file', required=False, help='Encrypted pcap')
-    ap.add_argument('--dec_file', required=True, help='Decrypted pcap')
+    ap.add_argument('--enc_file', required=False, help='Encrypted pcap (a JSON file, or a directory of per-file JSON files)')
+    ap.add_argument('--dec_file', required=False, help='Decrypted pcap (a JSON file, or a directory of per-file JSON files)')
+    ap.add_argument('--keylog_file', required=False, help='Single-pass pcap decrypted with TLS keys (merge_cap.py -keylog), instead of --enc_file and --dec_file')
     ap.add_argument('--nomoads_out_file', required=True, help='Output file for nomoads json')
     ap.add_argument('--kvs_out_file', required=True, help='Output file for extracted kvs')
     ap.add_argument('--include_http_body', action="store_true", help='Whether to include http body')
+    ap.add_argument('--projected', action="store_true", help='Whether the tshark JSON files were exported with merge_cap.py --projected')
+    ap.add_argument('--src_ip', default=utils.PCAPDROID_SRC_IP, help='IP address of the device whose outgoing traffic is extracted (default: ' + utils.PCAPDROID_SRC_IP + ')')
+    ap.add_argument('--keys_only', action="store_true", help='Only store the unique key paths of the extracted key-value pairs of each packet')
+    ap.add_argument('--max_kv_depth', type=int, default=0, help='Maximum nesting depth of JSON strings in JSON string values to extract key-value pairs from (default: 0, no limit)')
+    ap.add_argument('--max_kv_bytes', type=int, default=0, help='Maximum number of characters scanned for JSON in each payload (default: 0, no limit)')
+    ap.add_argument('--max_kv_pairs', type=int, default=0, help='Maximum number of key-value pairs extracted from each payload (default: 0, no limit)')
+    ap.add_argument('--kv_cost_file', help='CSV file to log the extraction cost (time, bytes scanned, pairs) of each packet to')
+    ap.add_argument('--intermediate_format', choices=records.INTERMEDIATE_FORMATS, default=records.DEFAULT_FORMAT, help='Format of the output files (default: ' + records.DEFAULT_FORMAT + ')')
     args = ap.parse_args()
 
-    extract(args.enc_file, args.dec_file, args.nomoads_out_file, args.kvs_out_file, include_http_body=args.include_http_body)
\ No newline at end of file
+    kv_limits.update(max_depth=args.max_kv_depth, max_bytes=args.max_kv_bytes, max_pairs=args.max_kv_pairs)
+    if args.kv_cost_file is not None:
+        kv_telemetry.open_log(args.kv_cost_file)
+
+    if args.keylog_file is not None:
+        extract_single_pass(args.keylog_file, args.nomoads_out_file, args.kvs_out_file, intermediate_format=args.intermediate_format,
+                            include_http_body=args.include_http_body, projected=args.projected, device_ip=args.src_ip,
+                            keys_only=args.keys_only)
+    elif args.dec_file is not None:
+        extract(args.enc_file, args.dec_file, args.nomoads_out_file, args.kvs_out_file, intermediate_format=args.intermediate_format,
+                include_http_body=args.include_http_body, projected=args.projected, device_ip=args.src_ip, keys_only=args.keys_only)
+    else:
+        ap.error("either --dec_file or --keylog_file is required")
+
+    domains.print_cache_stats()
+    kv_cache.print_cache_stats()
+    kv_telemetry.close_log()
\ No newline at end of file
@@ -4,9 +4,9 @@
 Helper functions to extract key value pairs from network traffic packets.
 '''
 
-from copy import deepcopy
 import json
 import re
+from urllib.parse import unquote, unquote_plus
 
 CSV_FIELD_KEY = 'keys'
 CSV_FIELD_PAYLOAD = 'http.file_data'
@@ -15,13 +15,87 @@ CSV_FIELD_SRC = 'source'
 CSV_FIELD_DEST = 'dest'
 CSV_FIELD_KEY_STR = "key_strings"
 
+# Keys, and brackets that can start a JSON value: "{" followed by (whitespace and) a key or "}", and "[" followed by a
+# value or "]". The other brackets (e.g., in JavaScript code, or in escaped JSON strings) are not decoded, as a failed
+# decode builds an error message that counts the lines of the text up to the failure
+JSON_CANDIDATE_RE = re.compile(r'(?:"[^"]+":|\{(?=[ \t\n\r]*["}])|\[(?=[ \t\n\r]*[\]"{\[\-0-9tfnNI]))')
+# JSON strings (possibly unterminated) and brackets, used to match the brackets outside of strings
+JSON_BRACKET_TOKEN_RE = re.compile(r'"[^"\\]*(?:\\.[^"\\]*)*"?|[{}\[\]]', re.DOTALL)
+CLOSING_BRACKETS = {"}": "{", "]": "["}
+json_decoder = json.JSONDecoder()
+# Failed decodes of bracket candidates, and length of the text, from which find_json matches the brackets of the text
+BRACKET_MATCH_MIN_FAILURES = 32
+BRACKET_MATCH_MIN_LENGTH = 4096
+
+# Names of the limits of an ExtractionBudget
+LIMIT_DEPTH = "depth"
+LIMIT_BYTES = "bytes"
+LIMIT_PAIRS = "pairs"
+
+
+class ExtractionBudget:
+    """
+    Limits on the work done to extract the key-value pairs of a payload, so that a pathological payload (e.g., deeply
+    escaped JSON strings) cannot stall the extraction. A limit of 0 means no limit. Once a limit is hit, no more pairs
+    are extracted from the payload.
+    :param max_depth: Maximum nesting depth of JSON strings found in the values of JSON strings.
+    :param max_bytes: Maximum number of characters scanned for JSON, the nested JSON strings included (the payload
+                      itself is always scanned).
+    :param max_pairs: Maximum number of key-value pairs extracted.
+    """
+
+    def __init__(self, max_depth=0, max_bytes=0, max_pairs=0):
+        self.max_depth = max_depth
+        self.max_bytes = max_bytes
+        self.max_pairs = max_pairs
+        self.bytes_scanned = 0
+        self.pairs = 0
+        self.limits_hit = set()
+
+    def scan(self, text, depth):
+        """
+        :return: True if the text can be scanned for JSON at the given depth, False if it would exceed a limit.
+        """
+        if self.limits_hit:
+            return False
+        if self.max_depth and depth > self.max_depth:
+            self.limits_hit.add(LIMIT_DEPTH)
+            return False
+        if self.max_bytes and depth > 0 and self.bytes_scanned + len(text) > self.max_bytes:
+            self.limits_hit.add(LIMIT_BYTES)
+            return False
+        self.bytes_scanned += len(text)
+        return True
+
+    def has_limits(self):
+        return bool(self.max_depth or self.max_bytes or self.max_pairs)
+
+    def emit(self):
+        """
+        :return: True if one more key-value pair can be extracted, False if it would exceed the limit.
+        """
+        if self.max_pairs and self.pairs >= self.max_pairs:
+            self.limits_hit.add(LIMIT_PAIRS)
+            return False
+        self.pairs += 1
+        return True
+
 def check_all_kv_pairs(root_obj, init_level=()):
+    """
+    Walk a decoded JSON object and yield a (path, value) tuple for every leaf value. If a dict (or its "header" dict)
+    has a "namespace", the path restarts from "<namespace>" and the "namespace" key itself is not yielded.
+    The object is not modified, so there is no need to copy it first.
+    """
+    # Ids of the dicts whose "namespace" key was already used as a path label (instead of popping the key)
+    used_namespaces = set()
+
     def handle_namespace(d):
         if isinstance(d.get("header"), dict):
             d = d["header"]
 
-        if "namespace" in d:
-            return f"<{d.pop('namespace')}>"
+        if "namespace" in d and id(d) not in used_namespaces:
+            used_namespaces.add(id(d))
+            return f"<{d['namespace']}>"
         else:
             return None
 
@@ -33,12 +107,39 @@ def check_all_kv_pairs(root_obj, init_level=()):
             if (addtional_label := handle_namespace(obj)) is not None:
                 level = (addtional_label,)  # restart path from the namespace
 
+            skip_namespace = id(obj) in used_namespaces
             for k, v in obj.items():
+                if skip_namespace and k == "namespace":
+                    continue
                 yield from go(v, level + (k,))
         else:
             yield level, obj
 
-    yield from go(deepcopy(root_obj), init_level)
+    yield from go(root_obj, init_level)
+
+
+def match_brackets(text):
+    """
+    Match the brackets of the text (outside of strings) in a single pass. A JSON object or array that starts at an
+    opening bracket can only end at the matching closing bracket, and cannot be decoded at all if there is none.
+    :return: A dict that maps the position of each opening bracket to the position after its closing bracket, or to
+             None if the bracket is never closed.
+    """
+    bracket_ends = {}
+    stack = []
+    for m in JSON_BRACKET_TOKEN_RE.finditer(text):
+        token = m[0]
+        if token[0] == '"':
+            continue
+        if token in "{[":
+            stack.append(m.start())
+            bracket_ends[m.start()] = None
+        elif stack and text[stack[-1]] == CLOSING_BRACKETS[token]:
+            bracket_ends[stack.pop()] = m.end()
+        else:
+            # None of the open brackets can be closed past a mismatched one
+            stack = []
+    return bracket_ends
 
 
 def find_json(text):
@@ -46,10 +147,13 @@ def find_json(text):
     Find JSON-like structures in the text
     Two patterns: 1) {...} or [...]; 2) "...": ...
     """
-    json_decoder = json.JSONDecoder()
     last_ending = 0
+    # The brackets are only matched once several decodes of bracket candidates failed in a large text (e.g., minified
+    # JavaScript, or unclosed brackets), as matching them costs more than a few failed decodes
+    bracket_ends = None
+    failures = 0
 
-    for m in re.finditer(r'(?:"[^"]+":|[{\[])', text):
+    for m in JSON_CANDIDATE_RE.finditer(text):
         if m.start() < last_ending:
             continue
 
@@ -60,74 +164,110 @@ def find_json(text):
             key = m[0][1:-2]
             startpos = m.end()
 
-        part = text[startpos:]
-
         try:
-            obj, endoffset = json_decoder.raw_decode(part)
-        except json.decoder.JSONDecodeError:
+            if bracket_ends is not None and startpos in bracket_ends:
+                if bracket_ends[startpos] is None:
+                    continue
+                # Only decode up to the matching bracket, so that a failed attempt does not go through (and copy)
+                # the rest of the text
+                obj, endoffset = json_decoder.raw_decode(text[startpos:bracket_ends[startpos]])
+                endpos = startpos + endoffset
+            else:
+                # Same as raw_decode(text, startpos), but without building an error message (which counts the lines of
+                # the text up to startpos) when there is no JSON value at startpos
+                obj, endpos = json_decoder.scan_once(text, startpos)
+        except (StopIteration, json.decoder.JSONDecodeError):
+            if bracket_ends is None and text[startpos:startpos + 1] in ("{", "["):
+                failures += 1
+                if failures >= BRACKET_MATCH_MIN_FAILURES and len(text) >= BRACKET_MATCH_MIN_LENGTH:
+                    bracket_ends = match_brackets(text)
             continue
 
         yield {key: obj} if key is not None else obj
-        last_ending = startpos + endoffset
-
-
-def process_ampersand_separated_text(payload):
-    """
-    Search for ampersand-separated strings in the payload. Yield key-value pairs.
-    """
-    split_text = payload.split("&")
-    json_kvs = tuple()
-    # We don't care about overwriting the value as long as we obtain the key.
-    for subtext in split_text:
-        # Usually it comes in the form of <key>=<value>.
-        kv_pair = subtext.split("=")
-        if len(kv_pair) > 1:
-            # Key and value.
-            if kv_pair[1].startswith('[') or kv_pair[1].startswith('{'):
-                # value mught be a json structure as well
-                for k, v in recursive_find_json_items(kv_pair[1]):
-                    json_kvs += ((k, v),)
-                yield kv_pair[0], kv_pair[1], json_kvs
-            else:    
-                yield kv_pair[0], kv_pair[1], '' # check if kv_pair[1] is a json structure
-        elif len(kv_pair) == 1:
-            # Only key but no value.
-            yield kv_pair[0], '', ''
-
-
-def process_semicolon_separated_text(payload):
-    """
-    Search for semicolon-separated strings in the payload. Yield key-value pairs.
-    """
-    split_text = payload.split(";")
-    json_kvs = tuple()
-    # We don't care about overwriting the value as long as we obtain the key.
-    for subtext in split_text:
-        # Usually it comes in the form of <key>=<value>.
-        kv_pair = subtext.split("=")
-        if len(kv_pair) > 1:
-            # Key and value.
-            if kv_pair[1].startswith('[') or kv_pair[1].startswith('{'):
-                # value mught be a json structure as well
-                for k, v in recursive_find_json_items(kv_pair[1]):
-                    json_kvs += ((k, v),)
-                yield kv_pair[0], kv_pair[1], json_kvs
-            else:    
-                yield kv_pair[0], kv_pair[1], '' ## check if kv_pair[1] is a json structure
-        elif len(kv_pair) == 1:
-            # Only key but no value.
-            yield kv_pair[0], '', ''
-
-
-def recursive_find_json_items(payload, init_level=()):
+        last_ending = endpos
+
+
+def process_separated_text(payload, budget=None):
+    """
+    Search for ampersand-separated and semicolon-separated strings in the payload (e.g., form-urlencoded bodies, query
+    strings, and cookies). Each <key>=<value> part yields a (key, value) pair, and a part without value a (key, '')
+    pair. A value that starts like a JSON structure, or like a percent-encoded one (e.g., %7B%22id%22...), is searched
+    for JSON as well (decoded, with "+" as a space in the ampersand-separated strings, as in query strings and form
+    bodies), and its pair is followed by the pairs of all the JSON values found so far in the same split.
+    :return: A tuple with the lists of key-value pairs of the ampersand-separated and semicolon-separated strings.
+    """
+    # Both splits often have the same JSON values (e.g., a single <key>=<JSON> part), so each value is only searched
+    # once, unless the budget has limits (the second search would then find fewer pairs, or none)
+    json_value_kvs = {} if budget is None or not budget.has_limits() else None
+    return (split_separated_text(payload, "&", budget, json_value_kvs),
+            split_separated_text(payload, ";", budget, json_value_kvs))
+
+
+def split_separated_text(payload, separator, budget=None, json_value_kvs=None):
+    """
+    Split the payload on the separator, see process_separated_text.
+    :param json_value_kvs: Optional dict that maps the JSON values already searched to their key-value pairs.
+    :return: The list of key-value pairs.
+    """
+    # Usually it comes in the form of <key>=<value>, where the value ends at the next "=", if any (and is '' if there is
+    # no "=")
+    if "{" not in payload and "[" not in payload and "%7" not in payload and "%5" not in payload:
+        # No JSON values, nor percent-encoded ones (e.g., most query strings and cookies)
+        return [(key, value.partition("=")[0]) for key, _, value in (subtext.partition("=") for subtext in payload.split(separator))]
+
+    # Query strings and form bodies encode spaces as "+", cookies do not
+    decode = unquote_plus if separator == "&" else unquote
+    kvs = []
+    json_kvs = []
+    for subtext in payload.split(separator):
+        key, _, value = subtext.partition("=")
+        value = value.partition("=")[0]
+        kvs.append((key, value))
+        value = get_json_value(value, decode)
+        if value is not None:
+            # value mught be a json structure as well
+            if json_value_kvs is None:
+                value_kvs = list(recursive_find_json_items(value, budget=budget))
+            elif value in json_value_kvs:
+                value_kvs = json_value_kvs[value]
+            else:
+                value_kvs = json_value_kvs[value] = list(recursive_find_json_items(value, budget=budget))
+            json_kvs.extend(value_kvs)
+            # The pairs of all the JSON values found so far in the payload
+            kvs.extend(json_kvs)
+    return kvs
+
+
+def get_json_value(value, decode=unquote_plus):
+    """
+    :param value: A value of an ampersand-separated or semicolon-separated string.
+    :param decode: The function that percent-decodes the value (unquote_plus, or unquote if "+" is not a space).
+    :return: The value if it starts like a JSON structure, or else the decoded value if it starts like a percent-encoded
+             JSON structure, or else None.
+    """
+    if value.startswith('[') or value.startswith('{'):
+        return value
+    if value[:3].lower() in ("%7b", "%5b"):
+        return decode(value)
+    return None
+
+
+def recursive_find_json_items(payload, init_level=(), budget=None, depth=0):
     """
     Search for JSON strings in the payload. Yield key-value pairs.
+    :param budget: Optional ExtractionBudget that limits the work done for the payload.
+    :param depth: Nesting depth of the payload in JSON string values.
     """
+    if budget is not None and not budget.scan(payload, depth):
+        return
+
     for item in find_json(payload):
         for k, v in check_all_kv_pairs(item, init_level):
+            if budget is not None and not budget.emit():
+                return
             yield k, v
 
             # Recursively search for JSON strings in all nest string values.
             if isinstance(v, str):
-                yield from recursive_find_json_items(v, init_level + k + ("~",))
+                yield from recursive_find_json_items(v, init_level + k + ("~",), budget, depth + 1)
 
@@ -5,12 +5,16 @@ Matches filter list rules against packets.
 '''
 
 import os
-from adblockparser import AdblockRules
+import hashlib
+import pickle
+from importlib import metadata
+from adblockparser import AdblockRule
 import json
 import re
 import glob
 from urllib.parse import urlsplit
 from utils import utils
+from utils import records
 
 key_referer = "referer"
 key_req_with = "x-requested-with"
@@ -33,16 +37,398 @@ re_html = re.compile("\.html?$", re.IGNORECASE)
 # The Android code also includes fonts, but based on https://adblockplus.org/en/filters#options
 # this is not a valid option in current ABP
 # re_font = re.compile("\.(?:ttf|woff)$", re.IGNORECASE)
+
+# Tokens that filter list rules are indexed by (see TokenIndexMatcher), in lowercase URLs
+url_token_re = re.compile("[a-z0-9%]+")
+rule_token_re = re.compile("[A-Za-z0-9%]+")
+
+# Version of the matchers saved by load_rule_checker, to change when the matcher classes change
+MATCHER_ARTIFACT_VERSION = 1
+
+try:
+    ADBLOCKPARSER_VERSION = metadata.version("adblockparser")
+except metadata.PackageNotFoundError:
+    ADBLOCKPARSER_VERSION = "unknown"
+
 def init_rule_checker(filter_list_file):
     """
-    Initializer an AdblockRules instance to correspond to a filter list stored in a given file.
+    Initializes a matcher to correspond to a filter list stored in a given file.
     :param filter_list_file: The path to the filter list file.
-    :return: An AdblockRules instance initialized to perform matching against the given filter list.
+    :return: A TokenIndexMatcher initialized to perform matching against the given filter list, or a HostsListMatcher
+             if the list only contains hosts (both make the same decisions as AdblockRules).
     """
     print("Reading in filter list: %s" % filter_list_file)
     with open(filter_list_file, "r") as f:
         lines = f.readlines()
-        return AdblockRules(lines)
+    hosts = read_hosts_list_rules(lines)
+    if hosts is not None:
+        print("[.] Matching %d hosts of %s with a hosts index" % (len(hosts), filter_list_file))
+        matcher = HostsListMatcher(hosts)
+    else:
+        matcher = TokenIndexMatcher(lines)
+    matcher.content_hash = hash_filter_list(lines)
+    return matcher
+
+
+def load_rule_checker(filter_list_file, artifact_dir):
+    """
+    Returns the matcher of a filter list, which is built once for the contents of the list (see init_rule_checker) and
+    saved to a file in artifact_dir, named by the hash of the contents and the versions of the matchers and of
+    adblockparser (see get_versioned_list_name). The saved matcher is loaded when first used.
+    :param filter_list_file: The path to the filter list file.
+    :param artifact_dir: The directory of the saved matchers.
+    :return: A LazyMatcher if the matcher was saved, else the matcher.
+    """
+    with open(filter_list_file, "r") as f:
+        content_hash = hash_filter_list(f)
+    artifact_path = os.path.join(artifact_dir, get_versioned_list_name(content_hash) + ".pkl")
+    if os.path.isfile(artifact_path):
+        print("[.] Reusing the saved matcher of %s: %s" % (filter_list_file, artifact_path))
+        return LazyMatcher(artifact_path, content_hash)
+
+    matcher = init_rule_checker(filter_list_file)
+    # Named by the hash of the contents the matcher was built from
+    artifact_path = os.path.join(artifact_dir, get_versioned_list_name(matcher.content_hash) + ".pkl")
+    with open(artifact_path + ".tmp", "wb") as outfile:
+        pickle.dump(matcher, outfile, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(artifact_path + ".tmp", artifact_path)
+    return matcher
+
+
+class LazyMatcher:
+    """
+    A matcher saved by load_rule_checker, which is only loaded when a URL is matched (e.g., not if the decisions of
+    all the URLs were kept from previous runs, see MultiListMatcher).
+    """
+
+    def __init__(self, artifact_path, content_hash):
+        self.artifact_path = artifact_path
+        self.content_hash = content_hash
+        self.matcher = None
+
+    def load(self):
+        if self.matcher is None:
+            with open(self.artifact_path, "rb") as infile:
+                self.matcher = pickle.load(infile)
+        return self.matcher
+
+    def should_block(self, url, options=None):
+        return self.load().should_block(url, options)
+
+    def match(self, url, folded_url, options):
+        return self.load().match(url, folded_url, options)
+
+
+def hash_filter_list(lines):
+    """
+    :param lines: The lines of a filter list.
+    :return: Hex digest of the contents of the list, which identifies the decisions of the list (see MultiListMatcher).
+    """
+    h = hashlib.blake2b(digest_size=16)
+    for line in lines:
+        h.update(line.encode("utf-8", "surrogatepass"))
+    return h.hexdigest()
+
+
+def get_versioned_list_name(content_hash):
+    """
+    :param content_hash: The content hash of a filter list (see hash_filter_list).
+    :return: A name that identifies the contents of the list and the versions of the matchers and of adblockparser, as
+             the saved matchers (see load_rule_checker) and the stored decisions are only valid for these versions.
+    """
+    return "%d-%s-%s" % (MATCHER_ARTIFACT_VERSION, ADBLOCKPARSER_VERSION, content_hash)
+
+
+def get_decision_store_hash(content_hash):
+    """
+    :param content_hash: The content hash of a filter list (see hash_filter_list), or None.
+    :return: The hash that the decisions of the list are stored by in a BlockDecisionStore, which also identifies the
+             versions of the matchers and of adblockparser (so that decisions are not reused once the matching changes),
+             or None if content_hash is None.
+    """
+    if content_hash is None:
+        return None
+    text = get_versioned_list_name(content_hash)
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=16).hexdigest()
+
+
+def read_hosts_list_rules(lines):
+    """
+    Reads the rules of a hosts list (e.g., "0.0.0.0 ads.example.com" or "ads.example.com" lines). AdblockRules turns
+    each of these lines into a case-insensitive regex for the literal line, which matches anywhere in the URL.
+    :param lines: The lines of the filter list.
+    :return: The literal rules of the list, in lowercase, or None if the list has rules that are not plain literals
+             (options, exceptions, wildcards, anchors, regexes, non-ASCII characters).
+    """
+    hosts = set()
+    for line in lines:
+        rule = line.strip()
+        # Same comments and element hiding rules as AdblockRule, which are ignored when matching URLs
+        if not rule or rule.startswith("!") or rule.startswith("[Adblock"):
+            continue
+        if "$" in rule or rule.startswith("@@") or not rule.isascii():
+            return None
+        if "##" in rule or "#@#" in rule:
+            continue
+        if any(c in rule for c in "^*|") or (rule.startswith("/") and rule.endswith("/")):
+            return None
+        hosts.add(rule.lower())
+    return hosts
+
+
+# Maps the characters that case-insensitive regexes match to ASCII letters to those letters (see get_case_folding_table)
+case_folding_table = None
+
+
+def get_case_folding_table():
+    """
+    The rules of a hosts list are ASCII, and AdblockRules matches them with case-insensitive regexes, for which a few
+    non-ASCII characters (e.g., the Kelvin sign) match ASCII letters. Lowercasing the URL with str.lower would turn
+    other characters into ASCII letters (e.g., U+0130 into "i" and a combining dot), so non-ASCII URLs are lowercased
+    with a table instead.
+    :return: A str.translate table for uppercase ASCII letters and the non-ASCII characters that match ASCII letters.
+    """
+    global case_folding_table
+    if case_folding_table is None:
+        letters = "abcdefghijklmnopqrstuvwxyz"
+        case_folding_table = {ord(c.upper()): c for c in letters}
+        non_ascii = "".join(chr(i) for i in range(128, 0x110000) if not 0xD800 <= i < 0xE000)
+        for c in set(re.findall("[a-z]", non_ascii, re.IGNORECASE)):
+            case_folding_table[ord(c)] = next(l for l in letters if re.match(l, c, re.IGNORECASE))
+    return case_folding_table
+
+
+def fold_url_case(url):
+    # Lowercase a URL for matching, as case-insensitive regexes would (see get_case_folding_table)
+    if url.isascii():
+        return url.lower()
+    return url.translate(get_case_folding_table())
+
+
+class HostsListMatcher:
+    """
+    Matches the rules of a hosts list (see read_hosts_list_rules) against URLs, with the same decisions as AdblockRules.
+    A rule matches where the URL contains it. The dots of a rule with a.m.b labels (m being zero or more labels) must be
+    dots of the URL, so the rules are indexed by m and b: for each pair of labels of the URL, the labels between them
+    are looked up as m, the prefixes of the right label as b, and the suffixes of the left label are checked against
+    the a of the rules found. A URL with n labels takes up to n^2 pairs (few in practice, as most m are empty), instead
+    of trying every rule at each position of the URL. The few rules without dots are matched with a regex.
+    """
+
+    def __init__(self, hosts):
+        """
+        :param hosts: The literal rules of the list, in lowercase (see read_hosts_list_rules).
+        """
+        # Hash of the filter list (see init_rule_checker)
+        self.content_hash = None
+        # m -> b -> set of a
+        self.index = {}
+        # Label prefixes of the m in the index, to stop looking up longer m
+        self.middle_prefixes = set()
+        chars = set(".")
+        words = []
+        for host in hosts:
+            if "." not in host:
+                words.append(host)
+                continue
+            labels = host.split(".")
+            self.index.setdefault(".".join(labels[1:-1]), {}).setdefault(labels[-1], set()).add(labels[0])
+            for i in range(2, len(labels)):
+                self.middle_prefixes.add(".".join(labels[1:i]))
+            chars.update(host)
+        # Rules can only match within runs of the characters of the rules
+        self.run_re = re.compile("[" + re.escape("".join(sorted(chars))) + "]+")
+        self.words_re = re.compile("|".join(re.escape(word) for word in sorted(words))) if words else None
+
+    def should_block(self, url, options=None):
+        return self.match(url, fold_url_case(url), options)
+
+    def match(self, url, folded_url, options):
+        # Same as should_block, for a URL that was already lowercased with fold_url_case (see MultiListMatcher)
+        if self.words_re is not None and self.words_re.search(folded_url):
+            return True
+        for run in self.run_re.findall(folded_url):
+            labels = run.split(".")
+            for left in range(len(labels) - 1):
+                for right in range(left + 1, len(labels)):
+                    middle = ".".join(labels[left + 1:right])
+                    if middle and middle not in self.middle_prefixes:
+                        break
+                    if self.has_match(middle, labels[left], labels[right]):
+                        return True
+        return False
+
+    def has_match(self, middle, left_label, right_label):
+        # If a rule a.middle.b matches, with a a suffix of the left label and b a prefix of the right label
+        by_last_label = self.index.get(middle)
+        if by_last_label is None:
+            return False
+        for i in range(len(right_label) + 1):
+            first_labels = by_last_label.get(right_label[:i])
+            if first_labels is None:
+                continue
+            if len(first_labels) <= len(left_label):
+                if any(left_label.endswith(first) for first in first_labels):
+                    return True
+            elif any(left_label[j:] in first_labels for j in range(len(left_label) + 1)):
+                return True
+        return False
+
+
+def get_rule_tokens(rule_text):
+    """
+    Finds the tokens of a rule that are tokens of any URL it matches (see url_token_re): the runs of letters, digits,
+    and % of the rule, between characters that URL tokens cannot contain (e.g., "/", ".", the "^" separator), or the
+    "|" and "||" anchors. For example, "||ads.example.com^" has the tokens ads, example, and com, while "ad_" has none
+    ("ad" could be the end of a longer token in the URL).
+    :param rule_text: The text of the rule, without "@@" and options (AdblockRule.rule_text).
+    :return: The tokens, in lowercase.
+    """
+    if rule_text.startswith("/") and rule_text.endswith("/"):
+        # Regex rule
+        return []
+    text = rule_text
+    start_anchored = text.startswith("|")
+    text = text[2:] if text.startswith("||") else text[1:] if start_anchored else text
+    end_anchored = text.endswith("|")
+    if end_anchored:
+        text = text[:-1]
+    if "|" in text:
+        # AdblockRule.rule_to_regex escapes other "|" together with the next character, skip these (rare) rules
+        return []
+
+    def is_boundary(c):
+        # ASCII characters other than letters, digits, and % (which are escaped as literals, or are separators), except
+        # for the * wildcard
+        return c.isascii() and c != "*" and not rule_token_re.match(c)
+
+    tokens = []
+    for m in rule_token_re.finditer(text):
+        start, end = m.span()
+        if (is_boundary(text[start - 1]) if start > 0 else start_anchored) and \
+                (is_boundary(text[end]) if end < len(text) else end_anchored):
+            tokens.append(m.group().lower())
+    return tokens
+
+
+class TokenIndex:
+    """
+    The blacklist or whitelist rules of a TokenIndexMatcher. Each rule is indexed by one of its tokens (see
+    get_rule_tokens), and the rules without tokens by None. The rules without options are matched with a combined
+    case-insensitive regex per token, as in AdblockRules, and the others with AdblockRule.match_url.
+    """
+
+    def __init__(self):
+        # token -> list of regexes of the rules without options, and compiled regexes (compiled when first used)
+        self.regexes = {}
+        self.compiled = {}
+        # token -> rules with options, and domain -> rules that require the domain (as in AdblockRules._domain_index)
+        self.rules_with_options = {}
+        self.domain_rules = {}
+
+    def add(self, rule, token):
+        if not rule.options:
+            self.regexes.setdefault(token, []).append(rule.regex)
+        elif "domain" in rule.options and any(rule.options["domain"].values()):
+            for domain, required in rule.options["domain"].items():
+                if required:
+                    self.domain_rules.setdefault(domain, []).append(rule)
+        else:
+            self.rules_with_options.setdefault(token, []).append(rule)
+
+    def __getstate__(self):
+        # The compiled regexes are not saved (see load_rule_checker), unpickling compiles them all again, which takes
+        # longer than compiling the regexes of the tokens of the URLs when first used
+        state = self.__dict__.copy()
+        state["compiled"] = {}
+        return state
+
+    def get_regex(self, token):
+        regex = self.compiled.get(token)
+        if regex is None and token in self.regexes:
+            regex = re.compile("|".join(self.regexes[token]), re.IGNORECASE)
+            self.compiled[token] = regex
+        return regex
+
+    def matches(self, url, options, tokens):
+        '''
+        Same as AdblockRules._matches, for the rules of the tokens of the URL.
+        :param url: The URL.
+        :param options: The options of the URL (see get_options).
+        :param tokens: The tokens of the URL (see TokenIndexMatcher.get_url_tokens).
+        :return: True if a rule matches the URL.
+        '''
+        rules = []
+        for token in tokens:
+            regex = self.get_regex(token)
+            if regex is not None and regex.search(url):
+                return True
+            rules.extend(self.rules_with_options.get(token, ()))
+        if "domain" in options and self.domain_rules:
+            for domain in get_domain_variants(options["domain"]):
+                rules.extend(self.domain_rules.get(domain, ()))
+        return any(rule.match_url(url, options) for rule in rules if rule.matching_supported(options))
+
+
+def get_domain_variants(domain):
+    # Same as adblockparser's _domain_variants: the domain and its parent domains, except for the top-level domain
+    parts = domain.split(".")
+    if len(parts) == 1:
+        return parts
+    return [".".join(parts[-i:]) for i in range(len(parts), 1, -1)]
+
+
+class TokenIndexMatcher:
+    """
+    Matches filter list rules against URLs, with the same decisions as AdblockRules. AdblockRules searches a regex that
+    combines all the rules without options, and tries all the rules with options, for each URL. Instead, each rule is
+    indexed by its rarest token (among the tokens of the rules), so only the rules of the tokens of a URL are tried.
+    """
+
+    def __init__(self, lines):
+        """
+        :param lines: The lines of the filter list.
+        """
+        # Hash of the filter list (see init_rule_checker)
+        self.content_hash = None
+        # Same rules as AdblockRules (without the rules that have unsupported options)
+        supported_options = dict((opt, True) for opt in AdblockRule.BINARY_OPTIONS + ["domain"])
+        rules = []
+        for line in lines:
+            rule = AdblockRule(line)
+            if (rule.regex or rule.options) and rule.matching_supported(supported_options):
+                rules.append(rule)
+
+        rule_tokens = [get_rule_tokens(rule.rule_text) for rule in rules]
+        token_counts = {}
+        for tokens in rule_tokens:
+            for token in set(tokens):
+                token_counts[token] = token_counts.get(token, 0) + 1
+
+        self.blacklist = TokenIndex()
+        self.whitelist = TokenIndex()
+        for rule, tokens in zip(rules, rule_tokens):
+            # The rarest token (the longest one, for tokens that are as rare)
+            token = min(tokens, key=lambda t: (token_counts[t], -len(t))) if tokens else None
+            (self.whitelist if rule.is_exception else self.blacklist).add(rule, token)
+
+    @staticmethod
+    def get_url_tokens(folded_url):
+        # The tokens of the URL (lowercased with fold_url_case), and None for the rules without tokens
+        tokens = set(url_token_re.findall(folded_url))
+        tokens.add(None)
+        return tokens
+
+    def should_block(self, url, options=None):
+        return self.match(url, fold_url_case(url), options)
+
+    def match(self, url, folded_url, options):
+        # Same as should_block, for a URL that was already lowercased with fold_url_case (see MultiListMatcher)
+        options = options or {}
+        tokens = self.get_url_tokens(folded_url)
+        if self.whitelist.matches(url, options, tokens):
+            return False
+        return self.blacklist.matches(url, options, tokens)
 
 
 def get_content_type(url_parsed):
@@ -146,7 +532,7 @@ def get_url_and_options(pkt_nomoads_json):
 def get_block_decision(ruleset, pkt_nomoads_json, url, options):
     """
     Given a single packet in NoMoAds JSON format, return if the given filter list blocks that packet.
-    :param ruleset: an AdblockRules instance that has been initialized with a given set of rules.
+    :param ruleset: A matcher (see init_rule_checker) that has been initialized with a given set of rules.
     :param pkt_nomoads_json: A single packet in NoMoAds JSON format.
     :return: True if the ruleset would block the packet, False otherwise.
     """
@@ -161,36 +547,32 @@ def get_block_decision(ruleset, pkt_nomoads_json, url, options):
 def read_nomoads_json(nomoads_json_file):
     """
     Reads a json file in NoMoAds format into memory.
-    :param nomoads_json_file: The full path to the NoMoAds json file.
+    :param nomoads_json_file: The full path to the NoMoAds json file (in any of the formats of utils/records.py).
     :return: The in-memory representation of the json file.
     """
-    with open(nomoads_json_file, "r") as jf:
-        return json.load(jf)
+    return records.read_records(nomoads_json_file)
 
 
 def read_and_annotate_nomoads_json(ruleset, nomoads_json_file, filter_list_name):
     """
-    Opens a JSON file that contains packets in NoMoAds format, and annotates each packet with the given AdblockRules'
+    Opens a JSON file that contains packets in NoMoAds format, and annotates each packet with the given matcher's
     block decision. This is merely a utility function that handles reading the json file into memory on behalf of the
     caller and then internally delegates to annotate_nomoads_json.
-    :param ruleset: An AdblockRules instance that determines if each individual packet should be blocked or not.
+    :param ruleset: A matcher (see init_rule_checker) that determines if each individual packet should be blocked or not.
     :param nomoads_json_file: A JSON file with packets in NoMoAds format.
     :param filter_list_name: The key that will point to the block decision in the annotated json.
     :return: The original JSON, annotated with blocking decision and filter list name.
     """
-    with open(nomoads_json_file, "r") as jf:
-        decoder = json.JSONDecoder()
-        root_obj = decoder.decode(jf.read())
-        return annotate_nomoads_json(ruleset, root_obj, filter_list_name)
+    return annotate_nomoads_json(ruleset, read_nomoads_json(nomoads_json_file), filter_list_name)
 
 
 block_decision_cache = dict()
 
 def annotate_nomoads_json(ruleset, nomoads_json, filter_list_name):
     """
-    Given an in-memory representation of a NoMoAds json file, annotates each packet with the given AdblockRules' block
+    Given an in-memory representation of a NoMoAds json file, annotates each packet with the given matcher's block
     decision. The filter_list_name parameter defines the key that will point to the block decision.
-    :param ruleset: An AdblockRules instance that determines if each individual packet should be blocked or not.
+    :param ruleset: A matcher (see init_rule_checker) that determines if each individual packet should be blocked or not.
     :param nomoads_json: An in-memory representation of a NoMoAds json file.
     :param filter_list_name: The key that will point to the block decision in the annotated json.
     :return: The original JSON, annotated with block decision.
@@ -220,20 +602,100 @@ def annotate_nomoads_json(ruleset, nomoads_json, filter_list_name):
     return annotated
 
 
-def write_annotated_nomoads_json(data, file_out):
+def write_annotated_nomoads_json(data, file_out, intermediate_format=records.DEFAULT_FORMAT):
     """
     Write annotated NoMoAds JSON to a file.
     :param data: The annotated NoMoAds JSON.
     :param file_out: The file to output the annotated NoMoAds JSON to.
+    :param intermediate_format: Format of the output file (see utils/records.py).
     """
-    with open(file_out, "w") as jf:
-        jf.seek(0)
-        jf.write(json.dumps(data, sort_keys=True, indent=4))
-        jf.truncate()
+    records.write_records(data, file_out, intermediate_format)
 
 
 
-def fl_matcher_controller(nomoads_dirs, fl_matchers, out_dir_name):
+class MultiListMatcher:
+    """
+    Matches packets against all the filter lists at once: the URL and options of a packet are computed once, and the
+    decisions of the lists are returned as a bitmask (bit i is set if list i blocks the packet), which is cached by URL
+    and options. The decisions of the lists with a content hash (see init_rule_checker) can also be kept across runs,
+    in a BlockDecisionStore (see get_decision_store_hash).
+    """
+
+    def __init__(self, fl_matchers, decision_store=None):
+        '''
+        :param fl_matchers: List of (filter list name, matcher) tuples, where the matcher is a TokenIndexMatcher, a
+                            HostsListMatcher, or an AdblockRules instance (e.g., from an older saved matchers file).
+        :param decision_store: A BlockDecisionStore (see utils/block_decision_store.py), or None.
+        '''
+        self.fl_names = [fl_name for fl_name, _ in fl_matchers]
+        self.matchers = [matcher for _, matcher in fl_matchers]
+        self.decision_cache = {}
+        self.decision_store = decision_store
+        self.list_hashes = [get_decision_store_hash(getattr(matcher, "content_hash", None)) for matcher in self.matchers]
+        self.stored_hashes = set(h for h in self.list_hashes if h is not None)
+
+    def get_decisions(self, url, options):
+        '''
+        :param url: The full URL of the packet (see get_url_and_options).
+        :param options: The options of the URL.
+        :return: The bitmask of the decisions of the filter lists.
+        '''
+        key = (url, tuple(sorted(options.items())))
+        decisions = self.decision_cache.get(key)
+        if decisions is None:
+            decisions = 0
+            stored, new_decisions = {}, {}
+            if self.decision_store is not None and self.stored_hashes:
+                url_key = self.decision_store.make_url_key(url, options)
+                stored = self.decision_store.get_decisions(url_key, self.stored_hashes)
+            folded_url = fold_url_case(url)
+            for i, matcher in enumerate(self.matchers):
+                list_hash = self.list_hashes[i]
+                if list_hash in stored:
+                    blocked = stored[list_hash]
+                else:
+                    if isinstance(matcher, (TokenIndexMatcher, HostsListMatcher, LazyMatcher)):
+                        blocked = matcher.match(url, folded_url, options)
+                    else:
+                        blocked = matcher.should_block(url, options)
+                    if list_hash is not None:
+                        new_decisions[list_hash] = blocked
+                if blocked:
+                    decisions |= 1 << i
+            if new_decisions and self.decision_store is not None:
+                self.decision_store.add_decisions(url_key, new_decisions)
+            self.decision_cache[key] = decisions
+        return decisions
+
+    def annotate(self, nomoads_json):
+        '''
+        Annotates each packet with the block decision of each filter list (under the name of the list), and with the
+        overall block decision (1 if at least one list blocks the packet, as in compare_results.py).
+        :param nomoads_json: An in-memory representation of a NoMoAds json file (annotated in place).
+        :return: The annotated JSON.
+        '''
+        for pkt in nomoads_json.values():
+            # We always return False if there is no "host" in the packet
+            decisions = 0
+            if utils.json_key_host in pkt:
+                decisions = self.get_decisions(*get_url_and_options(pkt))
+            for i, fl_name in enumerate(self.fl_names):
+                pkt[fl_name] = (decisions >> i) & 1
+            pkt[utils.json_key_overall_block_decision] = 1 if decisions else 0
+        return nomoads_json
+
+
+def fl_matcher_controller(nomoads_dirs, fl_matchers, out_dir_name, intermediate_format=records.DEFAULT_FORMAT):
+    '''
+    Matches the NoMoAds json files of the given directories against all the filter lists, and writes the annotated
+    files to a subdirectory of each directory.
+    :param nomoads_dirs: The directories with *-nomoads.json files.
+    :param fl_matchers: List of (filter list name, matcher) tuples, or a MultiListMatcher (which keeps the decisions
+                        of the URLs across calls).
+    :param out_dir_name: Name of the output subdirectory.
+    :param intermediate_format: Format of the output files (see utils/records.py).
+    '''
+    multi_matcher = fl_matchers if isinstance(fl_matchers, MultiListMatcher) else MultiListMatcher(fl_matchers)
     # Match each input json file against each filter list
     for valid_dir in nomoads_dirs:
         print("[.] Processing: ", valid_dir)
@@ -247,13 +709,12 @@ def fl_matcher_controller(nomoads_dirs, fl_matchers, out_dir_name):
                 continue
             # Load json file into memory.
             nomoads_json = read_nomoads_json(nomoads_path)
-            # Perform rule matching for all filter lists.
-            for fl_tup in fl_matchers:
-                nomoads_json = annotate_nomoads_json(fl_tup[1], nomoads_json, fl_tup[0])
+            # Perform rule matching for all filter lists, in a single pass over the packets.
+            nomoads_json = multi_matcher.annotate(nomoads_json)
 
             # make the output directory
             fl_result_dir = os.path.join(valid_dir, out_dir_name) # Roblox/1/filters_matching_results
             if not os.path.isdir(fl_result_dir):
                 os.makedirs(fl_result_dir)
             # Json has now been annotated with blocking decisions for all filter lists. Write result to output dir.
-            write_annotated_nomoads_json(nomoads_json, fl_result_dir + os.sep + os.path.basename(nomoads_path))
+            write_annotated_nomoads_json(nomoads_json, fl_result_dir + os.sep + os.path.basename(nomoads_path), intermediate_format)
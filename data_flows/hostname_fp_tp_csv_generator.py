@@ -6,8 +6,8 @@ Label destinations from csv files with party labeling (first, third, etc).
 
 import argparse
 import sys
-import tldextract
 import unicodecsv as csv
+from utils import domains
 
 
 class DeviceAppInfo:
@@ -75,7 +75,7 @@ def _is_first_party(sld, package_name, current_app, host_name):
     package_name_tokens = package_name.split(".")
     package_name_tokens = [x.lower() for x in package_name_tokens if x.lower() not in IGNORE_PACKAGE_TOKENS and len(x.strip()) > 2]
 
-    dest_domain_parsed = tldextract.extract(host_name)
+    dest_domain_parsed = domains.extract(host_name)
 
     # extract the eSLD for comparison
     # if it's hosted on a cloud service, take the subdomain instead
@@ -87,7 +87,7 @@ def _is_first_party(sld, package_name, current_app, host_name):
 
     # check privacy policy url first
     if current_app.policy_url and current_app.policy_url != "N/A":
-        policy_domain_parsed = tldextract.extract(current_app.policy_url)
+        policy_domain_parsed = domains.extract(current_app.policy_url)
         if policy_domain_parsed.registered_domain == domain_cmp:
             print("First party due to privacy url %s, package name %s, hostname %s" %
                   (current_app.policy_url, package_name, host_name))
@@ -331,3 +331,5 @@ if __name__ == '__main__':
 
                 # write row
                 csv_writer.writerow(data_row)
+
+    domains.print_cache_stats()
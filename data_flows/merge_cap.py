@@ -5,19 +5,258 @@ Use this script to merge encrypted/decrypted PCAP files into one
 """
 
 import os, sys
+import argparse
+import hashlib
+import json
+import tempfile
 
-from subprocess import call
 from subprocess import check_call
+from subprocess import check_output
+from concurrent.futures import ThreadPoolExecutor
+from utils import utils
 
 ENC = "ENCRYPTED_"
 DEC = "DECRYPTED_"
+KEYLOG = "KEYLOG_" # TLS key log files (SSLKEYLOGFILE format) for the ENCRYPTED_ files, used in -keylog mode
 
+# Each merged PCAP and tshark JSON file gets a stamp file holding the key of the inputs it was generated from
+CACHE_KEY_SUFFIX = ".cache_key"
+HASH_CHUNK_SIZE = 1 << 20
 
-def merge_in_dir(encdec, dir_path):
+# Pre-filtered copies of the PCAP files are written to a temporary directory with this prefix
+PREFILTER_DIR_PREFIX = ".prefilter-"
+
+# Fields read by extract_from_tshark.py, the only ones exported in projected mode (-T json -e <field>).
+# Protocol names (e.g., "http", "tls") are exported as well so that the reader knows which layers are present.
+PROJECTED_FIELDS = [
+    "frame.number",
+    "frame.time_epoch",
+    "ip.src",
+    "ip.dst",
+    "tcp.srcport",
+    "tcp.dstport",
+    "tcp.stream",
+    "http",
+    "http.request.line",
+    "http.request.method",
+    "http.request.uri",
+    "http.file_data",
+    "http2",
+    "http2.header.count",
+    "http2.header.name",
+    "http2.header.value",
+    "http2.request.full_uri",
+    "http2.file_data",
+    "tls",
+    "tls.handshake.extensions_server_name",
+    "websocket",
+    "websocket.payload.text",
+    "data-text-lines",
+    "irc",
+    "irc.request",
+    "irc.response",
+]
+
+
+def get_projected_display_filter(src_ip=utils.PCAPDROID_SRC_IP):
+    # Only outgoing TCP traffic is used by extract_from_tshark.py
+    return "ip.src == " + src_ip + " && tcp"
+
+
+def get_prefilter(src_ip=utils.PCAPDROID_SRC_IP):
+    '''
+    Capture (BPF) filter applied to the PCAP files before dissection. Only the TCP traffic of the device is kept, in both
+    directions: extract_from_tshark.py only exports outgoing packets, but tshark needs the server's side of the TCP
+    streams to dissect them (e.g. the 101 Switching Protocols response before the websocket messages, and the TLS
+    handshake for decryption).
+    '''
+    return "tcp and host " + src_ip
+
+
+def prefilter_pcaps(pcap_files, out_dir, bpf_filter):
+    '''
+    Apply a capture filter to PCAP files with tcpdump, which is much cheaper than letting tshark dissect the packets
+    that extract_from_tshark.py drops anyway.
+    :return: The paths of the filtered PCAP files, in the same order.
+    '''
+    filtered_files = []
+    bytes_in, bytes_out = 0, 0
+    for pcap_file in pcap_files:
+        filtered_file = os.path.join(out_dir, os.path.basename(pcap_file))
+        check_call(["tcpdump", "-r", pcap_file, "-w", filtered_file, bpf_filter])
+        bytes_in += os.path.getsize(pcap_file)
+        bytes_out += os.path.getsize(filtered_file)
+        filtered_files.append(filtered_file)
+
+    saved_pct = 100.0 * (bytes_in - bytes_out) / bytes_in if bytes_in > 0 else 0.0
+    print("[.] Pre-filter '" + bpf_filter + "' kept " + str(bytes_out) + " of " + str(bytes_in) + " bytes (saved "
+          + str(bytes_in - bytes_out) + " bytes, " + "%.1f" % saved_pct + "%)")
+    return filtered_files
+
+
+def get_valid_tshark_fields(fields):
+    # tshark refuses to run if one of the -e fields is unknown to the installed version, so drop those
+    output = check_output(["tshark", "-G", "fields"], universal_newlines=True)
+    known_fields = set()
+    for line in output.splitlines():
+        columns = line.split("\t")
+        if len(columns) > 2:
+            known_fields.add(columns[2])
+
+    valid_fields = []
+    for field in fields:
+        if field in known_fields:
+            valid_fields.append(field)
+        else:
+            print("WARNING: tshark does not know the field '" + field + "', skipping it in the projected export")
+    return valid_fields
+
+
+def hash_files(file_paths):
+    '''
+    Hash the names and contents of a set of files, independently of the order in which they are listed.
+    '''
+    files_hash = hashlib.sha256()
+    for file_path in sorted(file_paths):
+        files_hash.update(os.path.basename(file_path).encode() + b"\0")
+        with open(file_path, "rb") as f:
+            for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+                files_hash.update(chunk)
+        files_hash.update(b"\0")
+    return files_hash.hexdigest()
+
+
+def get_tool_version(tool):
+    # The first line holds the version, e.g., "TShark (Wireshark) 3.6.2 (Git v3.6.2 packaged as 3.6.2-2)"
+    return check_output([tool, "--version"], universal_newlines=True).splitlines()[0]
+
+
+def get_cache_key(*parts):
+    return hashlib.sha256(json.dumps(parts).encode()).hexdigest()
+
+
+def is_cached(out_path, cache_key):
+    '''
+    Check whether out_path exists and was generated from the inputs described by cache_key.
+    '''
+    stamp_path = out_path + CACHE_KEY_SUFFIX
+    if not os.path.isfile(out_path) or not os.path.isfile(stamp_path):
+        return False
+    with open(stamp_path, "r") as f:
+        return f.read().strip() == cache_key
+
+
+def invalidate_cache(out_path):
+    # Remove the stamp before regenerating out_path, so that a partial output is never reused
+    stamp_path = out_path + CACHE_KEY_SUFFIX
+    if os.path.isfile(stamp_path):
+        os.remove(stamp_path)
+
+
+def write_cache_key(out_path, cache_key):
+    with open(out_path + CACHE_KEY_SUFFIX, "w") as f:
+        f.write(cache_key + "\n")
+
+
+def merge_keylog_files(dir_path, out_file):
+    '''
+    Concatenate the TLS key log files (KEYLOG_*) of a directory into one file that can be passed to tshark.
+    :return: The path of the combined key log file, or None if the directory has no key log files.
+    '''
+    keylog_files = sorted(fn for fn in os.listdir(dir_path) if fn.startswith(KEYLOG))
+    if len(keylog_files) == 0:
+        return None
+
+    with open(out_file, "wb") as out:
+        for fn in keylog_files:
+            with open(os.path.join(dir_path, fn), "rb") as f:
+                keylog = f.read()
+            out.write(keylog)
+            if not keylog.endswith(b"\n"):
+                out.write(b"\n")
+    print("[.] Combined " + str(len(keylog_files)) + " TLS key log files into " + out_file)
+    return os.path.abspath(out_file)
+
+
+def get_tshark_output_path(dir_path, encdec, per_file=False):
+    '''
+    Path of the tshark JSON output for a PCAP directory: a file, or a directory holding one JSON file per PCAP file
+    when dissecting per file.
+    '''
+    baseDir = os.path.basename(os.path.realpath(dir_path))
+    if encdec == '-enc':
+        name = baseDir + "-ENC-out"
+    elif encdec == '-keylog':
+        name = baseDir + "-KEYLOG-out"
+    else:
+        name = baseDir + "-DEC-out"
+    if per_file:
+        return os.path.join(dir_path, name + "-files")
+    return os.path.join(dir_path, name + ".json")
+
+
+def run_tshark(pcap_file, json_file, tshark_options, keys_hash, force=False, bpf_filter=None):
+    '''
+    Export a PCAP file to JSON with tshark, unless json_file is already up to date.
+    :param bpf_filter: If set, the PCAP file is pre-filtered with this capture filter before dissection.
+    '''
+    cmd = ["tshark"] + tshark_options + ["-r", pcap_file]
+
+    # The JSON file depends on the input PCAP files, the tshark version, and the tshark and pre-filter options
+    tshark_key = get_cache_key(hash_files([pcap_file]), keys_hash, get_tool_version("tshark"), cmd, bpf_filter)
+    if not force and is_cached(json_file, tshark_key):
+        print("[.] " + json_file + " is up to date, skipping tshark")
+        return
+
+    invalidate_cache(json_file)
+    if bpf_filter is None:
+        with open(json_file, "wb") as jf:
+            check_call(cmd, stdout=jf)
+    else:
+        with tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(pcap_file)), prefix=PREFILTER_DIR_PREFIX) as tmp_dir:
+            cmd[-1] = prefilter_pcaps([pcap_file], tmp_dir, bpf_filter)[0]
+            with open(json_file, "wb") as jf:
+                check_call(cmd, stdout=jf)
+    write_cache_key(json_file, tshark_key)
+
+    print("Saved " + json_file)
+
+
+def dissect_per_file(files_to_dissect, out_dir, tshark_options, keys_hash, force=False, jobs=None, bpf_filter=None):
+    '''
+    Export each PCAP file to its own JSON file with tshark, in parallel, instead of merging them first.
+    extract_from_tshark.py merges the packets of these files by timestamp when reading the directory.
+    '''
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+
+    json_files = {}
+    for fn in files_to_dissect:
+        json_files[os.path.join(out_dir, fn + ".json")] = fn
+
+    # Remove the outputs of PCAP files that are no longer in the directory
+    for fn in os.listdir(out_dir):
+        out_path = os.path.join(out_dir, fn)
+        if out_path not in json_files and not (fn.endswith(CACHE_KEY_SUFFIX) and out_path[:-len(CACHE_KEY_SUFFIX)] in json_files):
+            os.remove(out_path)
+
+    # tshark runs in subprocesses, so threads are enough to keep all cores busy
+    with ThreadPoolExecutor(max_workers=jobs or os.cpu_count() or 1) as executor:
+        futures = [executor.submit(run_tshark, pcap_file, json_file, tshark_options, keys_hash, force, bpf_filter) for json_file, pcap_file in json_files.items()]
+        for future in futures:
+            future.result()
+
+    print("[.] Dissected " + str(len(files_to_dissect)) + " files into " + out_dir)
+
+
+def merge_in_dir(encdec, dir_path, projected=False, force=False, keylog_file=None, per_file=False, jobs=None,
+                 src_ip=utils.PCAPDROID_SRC_IP, prefilter=False):
     dir_path = os.path.abspath(dir_path)
+    if keylog_file is not None:
+        keylog_file = os.path.abspath(keylog_file)
 
-    if encdec != "-enc" and encdec != "-dec":
-        print('ERROR: incorrect argument passed for enc/dec')
+    if encdec != "-enc" and encdec != "-dec" and encdec != "-keylog":
+        print('ERROR: incorrect argument passed for enc/dec/keylog')
         sys.exit(-1)
 
     if not os.path.isdir(dir_path):
@@ -31,44 +270,91 @@ def merge_in_dir(encdec, dir_path):
 
     files_to_merge = []
     for fn in os.listdir(dir_path):
-        if encdec == '-enc' and fn.startswith(ENC) and \
+        if (encdec == '-enc' or encdec == '-keylog') and fn.startswith(ENC) and \
             fn.find(DEC) == -1:
             files_to_merge.append(fn)
         elif encdec == '-dec' and fn.startswith(DEC):
             files_to_merge.append(fn)
 
     baseDir = os.path.basename(os.path.realpath(dir_path))
-    if encdec == '-enc':
-        outFile = baseDir + "-ENC-out.pcapng"
-    else:
-        outFile = baseDir + "-DEC-out.pcapng"
-    cmd = ["mergecap", "-w", outFile]
-    cmd += files_to_merge
-
-    call(cmd)
-    print("[.] Merged " + str(len(files_to_merge)) + " files into " + outFile)
-
-    if encdec == '-enc':
-        jsonFile = baseDir + "-ENC-out.json"
-    else:
-        jsonFile = baseDir + "-DEC-out.json"
 
-    cmd = ["tshark",
+    tshark_options = [
            "-o", "tcp.analyze_sequence_numbers:TRUE",
            "-o", "tcp.desegment_tcp_streams:TRUE",
            "-o", "http.desegment_body:TRUE",
-           "-r", outFile, "-T", "json"]
+           "-T", "json"]
+
+    keys_hash = None
+    if encdec == '-keylog':
+        # Single pass over the encrypted capture: tshark decrypts the TLS connections for which it has keys, the
+        # others only show up as TLS (with SNI in their Client Hello)
+        if keylog_file is None:
+            keylog_file = merge_keylog_files(dir_path, baseDir + "-KEYLOG-keys.txt")
+        if keylog_file is None or not os.path.isfile(keylog_file):
+            print("ERROR: no TLS key log file (" + KEYLOG + "*) found in " + dir_path)
+            sys.exit(-1)
+        keys_hash = hash_files([keylog_file])
+        tshark_options = ["-o", "tls.keylog_file:" + keylog_file] + tshark_options
+
+    if projected:
+        # Only export outgoing TCP packets and the fields that extract_from_tshark.py reads
+        projection = ["-Y", get_projected_display_filter(src_ip)]
+        for field in get_valid_tshark_fields(PROJECTED_FIELDS):
+            projection += ["-e", field]
+        tshark_options = projection + tshark_options
 
-    with open(jsonFile, "wb") as jf:
-        check_call(cmd, stdout=jf)
+    bpf_filter = None
+    if prefilter:
+        # Drop the packets that are not used before dissection (both directions of the TCP streams are kept)
+        bpf_filter = get_prefilter(src_ip)
+
+    if per_file:
+        # Skip mergecap: dissect every PCAP file on its own, so that a directory can use more than one core
+        dissect_per_file(files_to_merge, get_tshark_output_path(dir_path, encdec, per_file=True), tshark_options, keys_hash,
+                         force=force, jobs=jobs, bpf_filter=bpf_filter)
+        return
+
+    if encdec == '-enc':
+        outFile = baseDir + "-ENC-out.pcapng"
+    elif encdec == '-keylog':
+        outFile = baseDir + "-KEYLOG-out.pcapng"
+    else:
+        outFile = baseDir + "-DEC-out.pcapng"
+    # The merged PCAP only depends on the input PCAP files, the pre-filter, and the mergecap version
+    merge_key = get_cache_key(encdec, hash_files(files_to_merge), get_tool_version("mergecap"), bpf_filter)
+    if not force and is_cached(outFile, merge_key):
+        print("[.] " + outFile + " is up to date, skipping mergecap")
+    else:
+        invalidate_cache(outFile)
+        cmd = ["mergecap", "-w", outFile]
+        if bpf_filter is None:
+            cmd += files_to_merge
+            check_call(cmd)
+        else:
+            with tempfile.TemporaryDirectory(dir=dir_path, prefix=PREFILTER_DIR_PREFIX) as tmp_dir:
+                cmd += prefilter_pcaps(files_to_merge, tmp_dir, bpf_filter)
+                check_call(cmd)
+        print("[.] Merged " + str(len(files_to_merge)) + " files into " + outFile)
+        write_cache_key(outFile, merge_key)
 
-    print("Saved " + jsonFile)
+    run_tshark(outFile, os.path.basename(get_tshark_output_path(dir_path, encdec)), tshark_options, keys_hash, force=force)
 
 
 if __name__ == '__main__':
-    if len(sys.argv) != 3 or not (sys.argv[1] == '-dec' or sys.argv[1] == '-enc'):
-        print("ERROR: incorrect number of arguments or wrong arguments. Correct usage:")
-        print("\t$ python merge_cap.py [-dec | -enc] PATH_TO_PCAP_DIRECTORY")
-        sys.exit(1)
+    ap = argparse.ArgumentParser(description="Merges encrypted/decrypted PCAP files in a directory and exports them to JSON using tshark")
+    encdec_group = ap.add_mutually_exclusive_group(required=True)
+    encdec_group.add_argument('-dec', dest='encdec', action='store_const', const='-dec', help='Merge the decrypted (' + DEC + ') PCAP files')
+    encdec_group.add_argument('-enc', dest='encdec', action='store_const', const='-enc', help='Merge the encrypted (' + ENC + ') PCAP files')
+    encdec_group.add_argument('-keylog', dest='encdec', action='store_const', const='-keylog', help='Merge the encrypted (' + ENC + ') PCAP files and decrypt them in the same pass using the TLS key log files (' + KEYLOG + '*)')
+    ap.add_argument('dir_path', help='Path to the PCAP directory')
+    ap.add_argument('--projected', action="store_true", help='Only export outgoing TCP packets and the fields read by extract_from_tshark.py (use --projected there as well)')
+    ap.add_argument('--force', action="store_true", help='Regenerate the merged PCAP and JSON files even if their inputs did not change')
+    ap.add_argument('--keylog_file', required=False, help='With -keylog, use this TLS key log file instead of the ' + KEYLOG + '* files in the directory')
+    ap.add_argument('--per_file', action="store_true", help='Skip mergecap and dissect every PCAP file on its own, in parallel, into a directory of JSON files')
+    ap.add_argument('--jobs', type=int, default=None, help='With --per_file, the number of parallel tshark processes (default: number of cores)')
+    ap.add_argument('--prefilter', action="store_true", help='Drop the packets that are not used (non-TCP, or not to or from --src_ip) with tcpdump before dissection')
+    ap.add_argument('--src_ip', default=utils.PCAPDROID_SRC_IP, help='IP address of the device whose outgoing traffic is analyzed (default: ' + utils.PCAPDROID_SRC_IP + ')')
+    args = ap.parse_args()
 
-    merge_in_dir(sys.argv[1], sys.argv[2])
+    merge_in_dir(args.encdec, args.dir_path, projected=args.projected, force=args.force, keylog_file=args.keylog_file,
+                 per_file=args.per_file, jobs=args.jobs, src_ip=args.src_ip, prefilter=args.prefilter)
@@ -14,15 +14,19 @@ import os
 import subprocess
 import shutil
 import pandas as pd
-import pickle
-from utils.utils import DIR_DELIMITER
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from utils.utils import DIR_DELIMITER, PCAPDROID_SRC_IP
+from utils.records import INTERMEDIATE_FORMATS, DEFAULT_FORMAT
 from pandasql import sqldf
-from filter_list_checker_mult_dirs import init_rule_checker, fl_matcher_controller
+from filter_list_checker_mult_dirs import load_rule_checker, fl_matcher_controller, MultiListMatcher
+from merge_cap import get_tshark_output_path
+from utils.block_decision_store import BlockDecisionStore, BLOCK_DECISIONS_MAX_ENTRIES
 pysqldf = lambda q: sqldf(q, globals())
 
 # Filter list result directory
 FL_RESULT_DIR = "filters_matching_results"
 INTER_DATA_DIR = 'inter_data_files'
+FL_MATCHERS_DIR = 'filter_list_matchers' # compiled filter list matchers, by hash of the list contents (in INTER_DATA_DIR)
 
 # Filter lists per platform
 WEBSITE_FL = [
@@ -66,6 +70,29 @@ MOBILE_FL = [
 TEMP_OUTPUT_NAME = "temp_output"
 CSV_TMP_NAME = "csv_files"
 OUTPUTS_DIR_NAME = "outputs"
+
+# Rough memory needed by a mergecap/tshark job, used to bound the number of parallel jobs
+PCAP_JOB_MIN_MEMORY = 512 * 1024 * 1024
+PCAP_JOB_MEMORY_FACTOR = 10 # tshark keeps state for every packet, so memory grows with the size of the PCAP files
+
+# Default options passed on to merge_cap.py and extract_from_tshark.py
+PCAP_OPTIONS = {
+    "projected_export": False, # only export the packets and fields needed for extraction
+    "force": False, # redo mergecap/tshark even if the PCAP files did not change
+    "single_pass_tls": False, # decrypt the ENCRYPTED_ files with their TLS key log files in one pass (no DECRYPTED_ files)
+    "per_file": False, # skip mergecap and dissect each PCAP file on its own, in parallel
+    "prefilter": False, # drop unused packets with a capture filter (tcpdump) before dissection
+    "src_ip": PCAPDROID_SRC_IP, # IP address of the device whose outgoing traffic is analyzed
+    "intermediate_format": DEFAULT_FORMAT, # format of the NoMoAds and extracted key-value pairs files (see utils/records.py)
+    "keys_only": False, # only store the unique key paths in the extracted key-value pairs files
+    "max_kv_depth": 0, # limits on the key-value pair extraction of each payload, 0 for no limit
+    "max_kv_bytes": 0,
+    "max_kv_pairs": 0,
+    "kv_cost_log": False, # log the extraction cost of each packet to a -kv_cost.csv file next to the extracted key-value pairs file
+    "har_workers": None, # number of processes that convert the HAR files of all the websites in parallel (None for the number of cores)
+    "block_decision_cache": INTER_DATA_DIR + os.sep + "block_decisions.sqlite", # filter list decisions kept across runs (None to disable)
+    "max_block_decisions": BLOCK_DECISIONS_MAX_ENTRIES # maximum number of decisions in the cache
+}
               
 
 
@@ -89,42 +116,39 @@ def prepare_filter_lists_dir(platform):
     for fl in plat_fl:
         src_file_path = os.path.join(fl_path, fl)
         dest_file_path = os.path.join(plat_fl_path, fl)
-        shutil.copy(src_file_path, dest_file_path)
-
-    # Create filter list matching object for this platform we have prepared the lists for
-    fl_save_data_path = INTER_DATA_DIR + os.sep + f"{plat_fl_dir}_save_data.pkl"
-    if os.path.isfile(fl_save_data_path):
-        print(f"[.] Reusing saved filter lists matching object: {fl_save_data_path}")
-        # use this as the filter list fl_matchers instead of creating it again each time
-        with open(fl_save_data_path, "rb") as infile:
-            fl_matchers = pickle.load(infile)
-
-    else:
-        # Prepare a filter list matcher for each filter list
-        # List will contain a tuple for each filter list, with the first element being the name and the second element the matcher object
-        fl_matchers = []
-        for fl_file in os.listdir(plat_fl_dir):
-            if "DS_Store" in fl_file:
-                continue
-            fl_path_file = plat_fl_dir + "/" + fl_file
-            ext_start = fl_file.rfind(".")
-            if ext_start < 0:
-                print("WARNING: skipping filter list file '" + fl_file +
-                    "' as the filename does not contain a file extension.")
+        # Only copy the lists that changed (copy2 keeps the modification time)
+        src_stat = os.stat(src_file_path)
+        if os.path.isfile(dest_file_path):
+            dest_stat = os.stat(dest_file_path)
+            if (src_stat.st_size, src_stat.st_mtime_ns) == (dest_stat.st_size, dest_stat.st_mtime_ns):
                 continue
-            # Name of filter list becomes filename minus file extension
-            fl_name = fl_file[0:ext_start]
-            if len(fl_file) > 0:
-                try:
-                    fl_matchers.append((fl_name, init_rule_checker(fl_path_file)))
-                except Exception as e:
-                    print("Could not parse rule file: %s" % fl_path_file)
-                    print(e)
-
-            ## save filter list matcher object to reuse
-            with open(fl_save_data_path, "wb") as outfile:
-                pickle.dump(fl_matchers, outfile)
-    
+        shutil.copy2(src_file_path, dest_file_path)
+
+    # Prepare a filter list matcher for each filter list
+    # List will contain a tuple for each filter list, with the first element being the name and the second element the matcher object
+    # The matchers are saved in FL_MATCHERS_DIR by the hash of the contents of each list, so only the lists that changed are built again
+    fl_matchers_path = INTER_DATA_DIR + os.sep + FL_MATCHERS_DIR
+    if not os.path.isdir(fl_matchers_path):
+        os.makedirs(fl_matchers_path)
+    fl_matchers = []
+    for fl_file in sorted(os.listdir(plat_fl_dir)):
+        if "DS_Store" in fl_file:
+            continue
+        fl_path_file = plat_fl_dir + "/" + fl_file
+        ext_start = fl_file.rfind(".")
+        if ext_start < 0:
+            print("WARNING: skipping filter list file '" + fl_file +
+                "' as the filename does not contain a file extension.")
+            continue
+        # Name of filter list becomes filename minus file extension
+        fl_name = fl_file[0:ext_start]
+        if len(fl_file) > 0:
+            try:
+                fl_matchers.append((fl_name, load_rule_checker(fl_path_file, fl_matchers_path)))
+            except Exception as e:
+                print("Could not parse rule file: %s" % fl_path_file)
+                print(e)
+
     return plat_fl_dir, fl_matchers
 
 
@@ -203,19 +227,69 @@ def csv_processing(csv_platform_apk_dir, apk_dir_paths, apk_dir_tmp, platform, f
 
     
 
-def website_har_processor(platform, apk_dir_path, apk_dir, trace_dir, trace_dir_path, reprocess_har_flag):
+def get_kv_extraction_options(kv_cost_file, pcap_options=PCAP_OPTIONS):
+    # Options of the key-value pair extraction, shared by convert_har.py and extract_from_tshark.py (kv_cost_file can be
+    # None if the extraction cost files are passed separately)
+    options = ["--intermediate_format", pcap_options["intermediate_format"],
+               "--max_kv_depth", str(pcap_options["max_kv_depth"]),
+               "--max_kv_bytes", str(pcap_options["max_kv_bytes"]),
+               "--max_kv_pairs", str(pcap_options["max_kv_pairs"])]
+    if pcap_options["keys_only"]:
+        options.append("--keys_only")
+    if pcap_options["kv_cost_log"] and kv_cost_file is not None:
+        options += ["--kv_cost_file", kv_cost_file]
+    return options
+
+
+def get_har_worker_options(pcap_options=PCAP_OPTIONS):
+    # Number of processes used by convert_har.py, which defaults to the number of cores
+    if pcap_options["har_workers"] is None:
+        return []
+    return ["--workers", str(pcap_options["har_workers"])]
+
+
+def get_convert_har_cmd(har_jobs, pcap_options=PCAP_OPTIONS):
+    '''
+    :param har_jobs: The websites to convert, as (HAR directory, output file name, trace directory name, extraction cost
+                     file) tuples.
+    :return: The convert_har.py command that converts the HAR files of all the websites on a single pool of processes.
+    '''
+    cmd = ["python3", "convert_har.py"]
+    for har_dir, data_out_file_name, trace_dir, kv_cost_file in har_jobs:
+        cmd += ["--har_dir", har_dir,
+                "--data_out_file_name", data_out_file_name, #i.e., roblox-out-nomoads.json
+                "--trace_select", trace_dir]   ## trace type select dir name, since they have different structures for processing
+        if pcap_options["kv_cost_log"]:
+            cmd += ["--kv_cost_file", kv_cost_file]
+    cmd.append("--show_progress")  #uncomment to show the prints/progress bars for convert_har.py
+    return cmd + get_har_worker_options(pcap_options) + get_kv_extraction_options(None, pcap_options)
+
+
+def run_har_jobs(platform, har_jobs, pcap_options=PCAP_OPTIONS):
+    # Convert the HAR files of all the websites gathered by website_har_processor() with one convert_har.py process, so
+    # that its pool of worker processes (and their caches of extracted key-value pairs) is shared by all the websites
+    if len(har_jobs) == 0:
+        return
+    print(f"[+] {platform}: Converting HAR files of {len(har_jobs)} websites and creating unified JSON files...\n")
+    subprocess.check_call(get_convert_har_cmd(har_jobs, pcap_options))
+
+
+def website_har_processor(platform, apk_dir_path, apk_dir, trace_dir, trace_dir_path, reprocess_har_flag, pcap_options=PCAP_OPTIONS, har_jobs=None):
     # Website-specific pipeline:
     # 1) Convert HAR files for each website to NoMoAds/OVRseen-style JSON and produce a unified JSON file
+    # If a har_jobs list is passed, the website is added to it to be converted later by run_har_jobs() instead.
 
     apk_dir_path_tuples_to_append = []
     if reprocess_har_flag:
-        print(f"[+] {platform}: Converting HAR files and creating a unified JSON file...\n")
-        ret = subprocess.check_call(["python3", "convert_har.py",
-            "--har_dir", os.path.join(apk_dir_path),
-            "--data_out_file_name", os.path.join(apk_dir + "-out-nomoads.json"), #i.e., roblox-out-nomoads.json
-            "--trace_select", trace_dir,   ## trace type select dir name, since they have different structures for processing
-            "--show_progress",  #uncomment to show the prints/progress bars for convert_har.py
-            ]) 
+        # The extraction cost of all the HAR files of the website is logged to the outputs directory
+        kv_cost_file = os.path.join(apk_dir_path, OUTPUTS_DIR_NAME, apk_dir + "-kv_cost.csv")
+        if pcap_options["kv_cost_log"]:
+            os.makedirs(os.path.dirname(kv_cost_file), exist_ok=True)
+        har_job = (apk_dir_path, apk_dir + "-out-nomoads.json", trace_dir, kv_cost_file)
+        if har_jobs is None:
+            run_har_jobs(platform, [har_job], pcap_options)
+        else:
+            har_jobs.append(har_job)
 
     if trace_dir != "logged_out_trace":
         apk_dir_age_cat_paths = [(apk_dir_path + os.sep + i) for i in os.listdir(apk_dir_path) if i != '.DS_Store' and i != FL_RESULT_DIR and i != CSV_TMP_NAME and i != OUTPUTS_DIR_NAME]
@@ -228,11 +302,169 @@ def website_har_processor(platform, apk_dir_path, apk_dir, trace_dir, trace_dir_
 
 
 
-def mobile_pcap_processor(trace_dir, apk_dir_path, apk_dir, platform, trace_dir_path, reprocess_pcap_flag):
+def get_merge_cap_cmd(encdec, pcap_dir_path, pcap_options=PCAP_OPTIONS, jobs=None):
+    '''
+    :param jobs: With per_file, the number of parallel tshark processes of merge_cap.py (default: number of cores).
+    '''
+    cmd = ["python3", "merge_cap.py", encdec, pcap_dir_path]
+    if pcap_options["projected_export"]:
+        cmd.append("--projected")
+    if pcap_options["force"]:
+        cmd.append("--force")
+    if pcap_options["per_file"]:
+        cmd.append("--per_file")
+        if jobs:
+            cmd += ["--jobs", str(jobs)]
+    if pcap_options["prefilter"]:
+        cmd.append("--prefilter")
+    cmd += ["--src_ip", pcap_options["src_ip"]]
+    return cmd
+
+
+def get_extract_from_tshark_cmd(enc_file, dec_file, keylog_file, nomoads_out_file, kvs_out_file, pcap_options=PCAP_OPTIONS):
+    cmd = ["python3", "extract_from_tshark.py"]
+    if pcap_options["single_pass_tls"]:
+        cmd += ["--keylog_file", keylog_file]
+    else:
+        cmd += ["--enc_file", enc_file, "--dec_file", dec_file]
+    cmd += [
+        "--nomoads_out_file", nomoads_out_file,
+        "--kvs_out_file", kvs_out_file,
+        "--include_http_body"
+        ]
+    if pcap_options["projected_export"]:
+        cmd.append("--projected")
+    cmd += ["--src_ip", pcap_options["src_ip"]]
+    cmd += get_kv_extraction_options(kvs_out_file.replace('-extracted_kv_pairs.json', '-kv_cost.csv'), pcap_options)
+    return cmd
+
+
+def make_pcap_job(platform, pcap_dir_path, extract_cmd, pcap_options=PCAP_OPTIONS):
+    '''
+    Gather what is needed to turn the PCAP files of one directory into a unified JSON file. The commands of a job must
+    run in order, but jobs of different directories are independent of each other.
+    :return: A dict with the directory, the size of its PCAP files (to estimate memory use), and the arguments of the
+             commands (see get_pcap_job_commands).
+    '''
+    input_bytes = sum(os.path.getsize(os.path.join(pcap_dir_path, i)) for i in os.listdir(pcap_dir_path) if 'CRYPTED' in i)
+    return {"dir_path": pcap_dir_path, "input_bytes": input_bytes, "platform": platform, "extract_cmd": extract_cmd,
+            "pcap_options": pcap_options}
+
+
+def get_pcap_job_commands(pcap_job, jobs=None):
+    '''
+    :param pcap_job: A PCAP job (see make_pcap_job).
+    :param jobs: With per_file, the number of parallel tshark processes of the job (see get_merge_cap_cmd).
+    :return: The (message, command) list of the job.
+    '''
+    platform, pcap_dir_path, pcap_options = pcap_job["platform"], pcap_job["dir_path"], pcap_job["pcap_options"]
+    if pcap_options["single_pass_tls"]:
+        # A single tshark pass over the encrypted PCAP files, decrypted with the TLS key log files
+        commands = [
+            (f"[+] {platform}: Merging encrypted PCAP files and creating a decrypted JSON file using tshark and TLS keys for {pcap_dir_path}...",
+                get_merge_cap_cmd("-keylog", pcap_dir_path, pcap_options, jobs))
+        ]
+    else:
+        commands = [
+            (f"[+] {platform}: Merging decrypted PCAP files and creating a JSON file using tshark for {pcap_dir_path}...",
+                get_merge_cap_cmd("-dec", pcap_dir_path, pcap_options, jobs)),
+            (f"\n[+] {platform}: Merging encrypted PCAP files and creating a JSON file using tshark for {pcap_dir_path}...",
+                get_merge_cap_cmd("-enc", pcap_dir_path, pcap_options, jobs))
+        ]
+    # 3) Produce a unified JSON file
+    commands.append((f"[+] {platform}: Creating a unified JSON file...\n", pcap_job["extract_cmd"]))
+    return commands
+
+
+def run_pcap_job(pcap_job, capture_output=True, jobs=None):
+    '''
+    Run the commands of a PCAP job one after another.
+    :param capture_output: Buffer the output of the commands and return it, so that parallel jobs do not interleave their logs.
+    :param jobs: With per_file, the number of parallel tshark processes of the job (see get_merge_cap_cmd).
+    :return: The output of the commands if capture_output is set.
+    '''
+    output = []
+    for message, cmd in get_pcap_job_commands(pcap_job, jobs):
+        if not capture_output:
+            print(message)
+            subprocess.check_call(cmd)
+            continue
+
+        output.append(message)
+        ret = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+        output.append(ret.stdout)
+        if ret.returncode != 0:
+            raise subprocess.CalledProcessError(ret.returncode, cmd, output="\n".join(output))
+    return "\n".join(output)
+
+
+def get_available_memory():
+    # Prefer MemAvailable, which (unlike free memory) includes page cache that can be reclaimed
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+def get_pcap_worker_count(pcap_jobs, max_workers=None):
+    '''
+    Size the worker pool to the number of cores, limited by the memory that the largest job is expected to need.
+    '''
+    workers = min(os.cpu_count() or 1, len(pcap_jobs))
+    if max_workers:
+        workers = min(workers, max_workers)
+
+    available_memory = get_available_memory()
+    if available_memory is not None:
+        largest_input = max(job["input_bytes"] for job in pcap_jobs)
+        job_memory = max(PCAP_JOB_MIN_MEMORY, largest_input * PCAP_JOB_MEMORY_FACTOR)
+        workers = min(workers, available_memory // job_memory)
+
+    return max(1, workers)
+
+
+def run_pcap_jobs(pcap_jobs, max_workers=None):
+    '''
+    Run independent PCAP jobs (mergecap/tshark/extraction for one directory each) on a bounded pool of workers.
+    The work happens in subprocesses, so threads are enough to keep the pool busy.
+    '''
+    if len(pcap_jobs) == 0:
+        return
+
+    workers = get_pcap_worker_count(pcap_jobs, max_workers)
+    # With per_file, merge_cap.py runs its own pool of tshark processes: share the cores among the jobs
+    tshark_jobs = max(1, (os.cpu_count() or 1) // workers)
+    print(f"[+] Processing PCAP files of {len(pcap_jobs)} directories using {workers} workers...")
+
+    failed_job = None
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        future_to_job = {executor.submit(run_pcap_job, job, True, tshark_jobs): job for job in pcap_jobs}
+        for future in as_completed(future_to_job):
+            try:
+                print(future.result())
+            except subprocess.CalledProcessError as e:
+                print(e.output)
+                print(f"### ERROR: processing PCAP files failed for {future_to_job[future]['dir_path']}")
+                failed_job = e
+
+    # Same behavior as the sequential pipeline, which stops on the first failed command
+    if failed_job is not None:
+        raise failed_job
+
+
+def mobile_pcap_processor(trace_dir, apk_dir_path, apk_dir, platform, trace_dir_path, reprocess_pcap_flag, pcap_options=PCAP_OPTIONS, pcap_jobs=None):
     # The pipeline for all other platforms
     # 1) Merge PCAP files for each app into one PCAP file for encrypted traffic and
     #    one PCAP file for decrypted traffic.
     # 2) Produce tshark JSON files, each for encrypted and decrypted traffic PCAP files
+    # If a pcap_jobs list is passed, these steps are added to it to be run later by run_pcap_jobs() instead.
     
     apk_dir_path_tuples_to_append = []
     if trace_dir == "logged_out_trace":
@@ -240,25 +472,23 @@ def mobile_pcap_processor(trace_dir, apk_dir_path, apk_dir, platform, trace_dir_
         apk_dir_trace_path = trace_dir_path + os.sep + apk_dir
         if len(items) != 0:
             if reprocess_pcap_flag:
-                print(f"[+] {platform}: Merging decrypted PCAP files and creating a JSON file using tshark...")
-                ret = subprocess.check_call(["python3", "merge_cap.py", "-dec", apk_dir_path])
-
-                print(f"\n[+] {platform}: Merging encrypted PCAP files and creating a JSON file using tshark...")
-                ret = subprocess.check_call(["python3", "merge_cap.py", "-enc", apk_dir_path])
-
-                # 3) Produce a unified JSON file 
-                print(f"[+] {platform}: Creating a unified JSON file...\n")
                 outputs_dir_path = os.path.join(apk_dir_path, OUTPUTS_DIR_NAME)
                 if not os.path.isdir(outputs_dir_path):
                     print(f"\nMaking new directory: {outputs_dir_path}\n")
                     os.makedirs(outputs_dir_path, exist_ok=True)
-                ret = subprocess.check_call(["python3", "extract_from_tshark.py",
-                    "--enc_file", os.path.join(apk_dir_path, apk_dir + "-ENC-out.json"),
-                    "--dec_file", os.path.join(apk_dir_path, apk_dir + "-DEC-out.json"),
-                    "--nomoads_out_file", os.path.join(apk_dir_path, apk_dir + "-out-nomoads.json"),
-                    "--kvs_out_file", os.path.join(outputs_dir_path, apk_dir + '-extracted_kv_pairs.json'), ##write the extracted json to the outputs dir
-                    "--include_http_body"
-                    ])
+                extract_cmd = get_extract_from_tshark_cmd(
+                    get_tshark_output_path(apk_dir_path, "-enc", pcap_options["per_file"]),
+                    get_tshark_output_path(apk_dir_path, "-dec", pcap_options["per_file"]),
+                    get_tshark_output_path(apk_dir_path, "-keylog", pcap_options["per_file"]),
+                    os.path.join(apk_dir_path, apk_dir + "-out-nomoads.json"),
+                    os.path.join(outputs_dir_path, apk_dir + '-extracted_kv_pairs.json'), ##write the extracted json to the outputs dir
+                    pcap_options
+                    )
+                pcap_job = make_pcap_job(platform, apk_dir_path, extract_cmd, pcap_options)
+                if pcap_jobs is None:
+                    run_pcap_job(pcap_job, capture_output=False)
+                else:
+                    pcap_jobs.append(pcap_job)
             apk_dir_path_tuples_to_append.append(([apk_dir_trace_path], apk_dir))
     else:
         ## logged in / full trace - go one dir further to account for age directories
@@ -282,25 +512,23 @@ def mobile_pcap_processor(trace_dir, apk_dir_path, apk_dir, platform, trace_dir_
             if (len(pcap_file_paths) > 0):  ##may not have files for some yet
                 flag = 1 #found something
                 if reprocess_pcap_flag: 
-                    print(f"[+] {platform}: Merging decrypted PCAP files and creating a JSON file using tshark for {pcap_file_dir_path}...")
-                    ret = subprocess.check_call(["python3", "merge_cap.py", "-dec", pcap_file_dir_path])
-
-                    print(f"\n[+] {platform}: Merging encrypted PCAP files and creating a JSON file using tshark for {pcap_file_dir_path}...")
-                    ret = subprocess.check_call(["python3", "merge_cap.py", "-enc", pcap_file_dir_path])
-
-                    # 3) Produce a unified JSON file 
-                    print(f"[+] {platform}: Creating a unified JSON file...\n")
                     outputs_dir_path = os.path.join(apk_dir_path, OUTPUTS_DIR_NAME)
                     if not os.path.isdir(outputs_dir_path):
                         print(f"\nMaking new directory: {outputs_dir_path}\n")
                         os.makedirs(outputs_dir_path, exist_ok=True)
-                    ret = subprocess.check_call(["python3", "extract_from_tshark.py",
-                        "--enc_file", os.path.join(pcap_file_dir_path, age_category_dir + "-ENC-out.json"),
-                        "--dec_file", os.path.join(pcap_file_dir_path, age_category_dir + '-DEC-out.json'),
-                        "--nomoads_out_file", os.path.join(pcap_file_dir_path, app_name + '-' + age_category_dir + "-out-nomoads.json"),
-                        "--kvs_out_file", os.path.join(outputs_dir_path, app_name + '-' + age_category_dir + '-extracted_kv_pairs.json'), ##write the extracted json to the outputs dir
-                        "--include_http_body"
-                        ])
+                    extract_cmd = get_extract_from_tshark_cmd(
+                        get_tshark_output_path(pcap_file_dir_path, "-enc", pcap_options["per_file"]),
+                        get_tshark_output_path(pcap_file_dir_path, "-dec", pcap_options["per_file"]),
+                        get_tshark_output_path(pcap_file_dir_path, "-keylog", pcap_options["per_file"]),
+                        os.path.join(pcap_file_dir_path, app_name + '-' + age_category_dir + "-out-nomoads.json"),
+                        os.path.join(outputs_dir_path, app_name + '-' + age_category_dir + '-extracted_kv_pairs.json'), ##write the extracted json to the outputs dir
+                        pcap_options
+                        )
+                    pcap_job = make_pcap_job(platform, pcap_file_dir_path, extract_cmd, pcap_options)
+                    if pcap_jobs is None:
+                        run_pcap_job(pcap_job, capture_output=False)
+                    else:
+                        pcap_jobs.append(pcap_job)
         if flag == 1:
             apk_dir_age_cat_paths = [(apk_dir_path + os.sep + i) for i in os.listdir(apk_dir_path) if i != '.DS_Store' and i != FL_RESULT_DIR and i != CSV_TMP_NAME and i != OUTPUTS_DIR_NAME]
             apk_dir_path_tuples_to_append.append((apk_dir_age_cat_paths, app_name))
@@ -308,7 +536,7 @@ def mobile_pcap_processor(trace_dir, apk_dir_path, apk_dir, platform, trace_dir_
     return apk_dir_path_tuples_to_append
 
 
-def controller(dataset_root_abs_dir, platform_csvs_abs_dir, trace_select, trace_types, select_platform, reprocess_har_flag, reprocess_pcap_flag):
+def controller(dataset_root_abs_dir, platform_csvs_abs_dir, trace_select, trace_types, select_platform, reprocess_har_flag, reprocess_pcap_flag, pcap_options=PCAP_OPTIONS, max_workers=None):
     ## Iterate over APK subdirectories (i.e., website, mobile) that contain the PCAP/HAR files and call the necessary scripts
     for platform in os.listdir(dataset_root_abs_dir):
         
@@ -320,6 +548,8 @@ def controller(dataset_root_abs_dir, platform_csvs_abs_dir, trace_select, trace_
             continue
 
         apk_dir_path_tuple = []
+        pcap_jobs = [] # mergecap/tshark jobs, run in parallel once all directories have been gathered
+        har_jobs = [] # websites whose HAR files are converted together once all directories have been gathered
         app_store_dir = os.path.join(dataset_root_abs_dir, platform)  # i.e., website, mobile
         
         print(f"\n[+] Processing data from: {platform}\n")
@@ -351,14 +581,14 @@ def controller(dataset_root_abs_dir, platform_csvs_abs_dir, trace_select, trace_
                     ## Website platform
                     if platform == 'website' and (select_platform == "website" or select_platform == 'all'):    
                         print(f"[+] {platform}: Begin the pipeline for app {apk_dir} and trace {trace_dir}...\n")
-                        tuples_to_append = website_har_processor(platform, apk_dir_path, apk_dir, trace_dir, trace_dir_path, reprocess_har_flag)
+                        tuples_to_append = website_har_processor(platform, apk_dir_path, apk_dir, trace_dir, trace_dir_path, reprocess_har_flag, pcap_options, har_jobs)
                         for i in tuples_to_append:
                             apk_dir_path_tuple.append(i)
 
                     ## Mobile platform
                     elif platform == 'mobile' and (select_platform == 'mobile' or select_platform == 'all'):
                         print(f"[+] {platform}: Begin the pipeline for app {apk_dir} and trace {trace_dir}...\n")
-                        tuples_to_append = mobile_pcap_processor(trace_dir, apk_dir_path, apk_dir, platform, trace_dir_path, reprocess_pcap_flag)
+                        tuples_to_append = mobile_pcap_processor(trace_dir, apk_dir_path, apk_dir, platform, trace_dir_path, reprocess_pcap_flag, pcap_options, pcap_jobs)
                         for i in tuples_to_append:
                             apk_dir_path_tuple.append(i)
 
@@ -392,30 +622,44 @@ def controller(dataset_root_abs_dir, platform_csvs_abs_dir, trace_select, trace_
                         ## Website platform
                         if platform == 'website' and (select_platform == 'website' or select_platform == 'all'):
                             print(f"[+] {platform}: Begin the pipeline for app {apk_dir} and trace {trace_dir}...\n")
-                            tuples_to_append = website_har_processor(platform, apk_dir_path, apk_dir, trace_dir, trace_dir_path, reprocess_har_flag)
+                            tuples_to_append = website_har_processor(platform, apk_dir_path, apk_dir, trace_dir, trace_dir_path, reprocess_har_flag, pcap_options, har_jobs)
                             for i in tuples_to_append:
                                 apk_dir_path_tuple.append(i)
 
                         ## Mobile platform
                         elif platform == 'mobile' and (select_platform == 'mobile' or select_platform == 'all'):
                             print(f"[+] {platform}: Begin the pipeline for app {apk_dir} and trace {trace_dir}...\n")
-                            tuples_to_append = mobile_pcap_processor(trace_select_dir_name, apk_dir_path, apk_dir, platform, trace_dir_path, reprocess_pcap_flag)
+                            tuples_to_append = mobile_pcap_processor(trace_select_dir_name, apk_dir_path, apk_dir, platform, trace_dir_path, reprocess_pcap_flag, pcap_options, pcap_jobs)
                             for i in tuples_to_append:
                                 apk_dir_path_tuple.append(i)
 
                         else:
                             print("### Unexpected platform type. Please add to pipeline.\n")
 
+        # Convert the HAR files of the websites gathered in previous step, all the files are converted on one pool
+        run_har_jobs(platform, har_jobs, pcap_options)
+
+        # Run the PCAP jobs gathered in previous step, directories are processed in parallel
+        run_pcap_jobs(pcap_jobs, max_workers)
+
         # Gather the apk dir paths gathered in previous step into a list
         apk_dir_paths_only = [x for x, _ in apk_dir_path_tuple]
 
         # 4) Run the unified JSON files (for each age category if applicable) through the filter-list matching script
         print(f"[+] {platform}: Running the unified JSON files and matching the entries against filter lists...")
         fl_dir, fl_matchers = prepare_filter_lists_dir(platform) ## Gathers filter lists needed for this platform and checks if pkl obj has been created already with fl_matchers object
+        decision_store = None
+        if pcap_options["block_decision_cache"]:
+            ## Decisions of previous runs (for the same filter list contents)
+            decision_store = BlockDecisionStore(pcap_options["block_decision_cache"], pcap_options["max_block_decisions"])
+        multi_matcher = MultiListMatcher(fl_matchers, decision_store) ## Matches all the lists in one pass, and keeps the decisions of the URLs seen for all apps
         for apk_dir_paths_by_apk in apk_dir_paths_only: # Apply filter lists to each input, don't open and reopen the object each time
-            fl_matcher_controller(apk_dir_paths_by_apk, fl_matchers, FL_RESULT_DIR)
+            fl_matcher_controller(apk_dir_paths_by_apk, multi_matcher, FL_RESULT_DIR, pcap_options["intermediate_format"])
             ## Filter list matching results are saved to platform > apkdir > filters_matching_results > ...
             print(f"[+] {platform}: Filter lists matching results are saved in {FL_RESULT_DIR} for {DIR_DELIMITER.join(apk_dir_paths_by_apk)}...\n")
+        if decision_store is not None:
+            decision_store.close()
+            decision_store.print_stats()
 
 
         # 5) Finally, produce a CSV file that contains the flow of traffic for further processing. This will be a CSV per apk_dir per age category in a platform stored in fl_result_dir. (e.g., ATS analyses, policy analyses, etc.) 
@@ -463,6 +707,23 @@ if __name__ == '__main__':
     ap.add_argument('--process_pcap', required=False, action="store_true", help='select whether to reprocess the pcap files or not (yes or no)')
     ap.add_argument('--select_trace_type', required=True, type=str, help='enter the specific website network trace type you want to process (all, full, logged_in, logged_out)')
     ap.add_argument('--select_platform', required=True, type=str, help='enter the specific platform you want to process (website, mobile, both)')
+    ap.add_argument('--max_workers', required=False, type=int, default=None, help='maximum number of PCAP directories processed in parallel (default: based on the number of cores and available memory)')
+    ap.add_argument('--projected_export', required=False, action="store_true", help='only export the packets and fields needed for extraction from the PCAP files with tshark (smaller and faster)')
+    ap.add_argument('--single_pass_tls', required=False, action="store_true", help='decrypt the ENCRYPTED_ PCAP files with their KEYLOG_ TLS key log files in a single tshark pass instead of using the DECRYPTED_ files')
+    ap.add_argument('--per_file_pcap', required=False, action="store_true", help='skip mergecap and dissect each PCAP file on its own with tshark, in parallel (the records are merged by timestamp during extraction)')
+    ap.add_argument('--prefilter_pcap', required=False, action="store_true", help='drop non-TCP packets, and packets not to or from the source IP, with a capture filter (tcpdump) before dissecting the PCAP files with tshark')
+    ap.add_argument('--src_ip', required=False, type=str, default=PCAPDROID_SRC_IP, help='IP address of the device whose outgoing traffic is analyzed (default: PCAPdroid\'s ' + PCAPDROID_SRC_IP + ')')
+    ap.add_argument('--intermediate_format', required=False, choices=INTERMEDIATE_FORMATS, default=DEFAULT_FORMAT, help='format of the NoMoAds and extracted key-value pairs files: pretty-printed JSON, JSON lines, or gzip-compressed JSON lines (default: ' + DEFAULT_FORMAT + ')')
+    ap.add_argument('--keys_only', required=False, action="store_true", help='only store the unique key paths (no values) in the extracted key-value pairs files, which is all that construct_data_flows.py needs')
+    ap.add_argument('--max_kv_depth', required=False, type=int, default=0, help='maximum nesting depth of JSON strings in JSON string values to extract key-value pairs from (default: 0, no limit)')
+    ap.add_argument('--max_kv_bytes', required=False, type=int, default=0, help='maximum number of characters scanned for JSON in each payload (URL, headers, body) of a packet (default: 0, no limit)')
+    ap.add_argument('--max_kv_pairs', required=False, type=int, default=0, help='maximum number of key-value pairs extracted from each payload of a packet (default: 0, no limit)')
+    ap.add_argument('--kv_cost_log', required=False, action="store_true", help='log the key-value pair extraction cost (time, bytes scanned, pairs) of each packet to -kv_cost.csv files in the outputs directories')
+    ap.add_argument('--har_workers', required=False, type=int, default=None, help='number of processes that convert the HAR files of all the websites in parallel (default: number of cores)')
+    ap.add_argument('--force_pcap', required=False, action="store_true", help='with --process_pcap, redo mergecap/tshark even for directories whose PCAP files did not change')
+    ap.add_argument('--block_decision_cache', required=False, type=str, default=PCAP_OPTIONS["block_decision_cache"], help='SQLite file that keeps the filter list decisions across runs, by filter list contents, URL, and options (default: ' + PCAP_OPTIONS["block_decision_cache"] + ')')
+    ap.add_argument('--no_block_decision_cache', required=False, action="store_true", help='do not keep the filter list decisions across runs')
+    ap.add_argument('--max_block_decisions', required=False, type=int, default=BLOCK_DECISIONS_MAX_ENTRIES, help='maximum number of decisions in the block decision cache, the least recently used are evicted (default: ' + str(BLOCK_DECISIONS_MAX_ENTRIES) + ')')
 
     args = ap.parse_args()
 
@@ -471,6 +732,24 @@ if __name__ == '__main__':
     platform_csvs_abs_dir = os.path.abspath(args.platform_csvs_dir)
     reprocess_har_flag = args.process_har
     reprocess_pcap_flag = args.process_pcap
+    pcap_options = {
+        "projected_export": args.projected_export,
+        "force": args.force_pcap,
+        "single_pass_tls": args.single_pass_tls,
+        "per_file": args.per_file_pcap,
+        "prefilter": args.prefilter_pcap,
+        "src_ip": args.src_ip,
+        "intermediate_format": args.intermediate_format,
+        "keys_only": args.keys_only,
+        "max_kv_depth": args.max_kv_depth,
+        "max_kv_bytes": args.max_kv_bytes,
+        "max_kv_pairs": args.max_kv_pairs,
+        "kv_cost_log": args.kv_cost_log,
+        "har_workers": args.har_workers,
+        "block_decision_cache": None if args.no_block_decision_cache else args.block_decision_cache,
+        "max_block_decisions": args.max_block_decisions
+    }
+    max_workers = args.max_workers
     select_platform = args.select_platform
     trace_select = args.select_trace_type
     trace_types = {  ## arg string to dir name in website platform
@@ -484,7 +763,7 @@ if __name__ == '__main__':
         os.makedirs(INTER_DATA_DIR)
 
     if select_platform == 'both':
-        controller(dataset_root_abs_dir, platform_csvs_abs_dir, trace_select, trace_types, 'website', reprocess_har_flag, reprocess_pcap_flag)
-        controller(dataset_root_abs_dir, platform_csvs_abs_dir, trace_select, trace_types, 'mobile', reprocess_har_flag, reprocess_pcap_flag)
+        controller(dataset_root_abs_dir, platform_csvs_abs_dir, trace_select, trace_types, 'website', reprocess_har_flag, reprocess_pcap_flag, pcap_options, max_workers)
+        controller(dataset_root_abs_dir, platform_csvs_abs_dir, trace_select, trace_types, 'mobile', reprocess_har_flag, reprocess_pcap_flag, pcap_options, max_workers)
     else:
-        controller(dataset_root_abs_dir, platform_csvs_abs_dir, trace_select, trace_types, select_platform, reprocess_har_flag, reprocess_pcap_flag)
\ No newline at end of file
+        controller(dataset_root_abs_dir, platform_csvs_abs_dir, trace_select, trace_types, select_platform, reprocess_har_flag, reprocess_pcap_flag, pcap_options, max_workers)
\ No newline at end of file
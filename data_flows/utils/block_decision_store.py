@@ -0,0 +1,137 @@
+#!/usr/bin/python
+
+'''
+Persistent cache of the block decisions of the filter lists, shared by the runs of process_pcaps.py (and by the platforms
+and traces of a run). The decisions are stored in a SQLite database, keyed by the hash of the contents of the filter
+list (so that the decisions of a list are not used anymore once the list changes) and a digest of the URL and options
+that were matched (see filter_list_checker_mult_dirs.MultiListMatcher).
+'''
+
+import hashlib
+import json
+import sqlite3
+
+# Maximum number of decisions kept in the database (about 100 bytes each), the least recently used are evicted
+BLOCK_DECISIONS_MAX_ENTRIES = 2000000
+# Number of new decisions (and decisions to mark as used) that are buffered before being written to the database
+WRITE_BATCH_SIZE = 10000
+
+
+class BlockDecisionStore:
+    """
+    SQLite table of (URL key, filter list hash) -> block decision. Each time the store is opened is a new run, and each
+    decision records the last run that used it: when the store is closed, the decisions used the longest ago are
+    evicted, down to max_entries.
+    """
+
+    def __init__(self, path, max_entries=BLOCK_DECISIONS_MAX_ENTRIES):
+        self.path = path
+        self.max_entries = max_entries
+        self.conn = sqlite3.connect(path)
+        self.conn.executescript('''
+            CREATE TABLE IF NOT EXISTS decisions (
+                url_key BLOB NOT NULL,
+                list_hash TEXT NOT NULL,
+                blocked INTEGER NOT NULL,
+                used INTEGER NOT NULL,
+                PRIMARY KEY (url_key, list_hash)
+            ) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS decisions_used ON decisions (used);
+            CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value INTEGER NOT NULL);
+        ''')
+        with self.conn:
+            row = self.conn.execute("SELECT value FROM meta WHERE name = 'run'").fetchone()
+            self.run = (row[0] if row is not None else 0) + 1
+            self.conn.execute("INSERT OR REPLACE INTO meta VALUES ('run', ?)", (self.run,))
+        self.new_decisions = []
+        self.used_decisions = []
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+
+    @staticmethod
+    def make_url_key(url, options):
+        '''
+        :param url: The URL that was matched.
+        :param options: The options it was matched with (see filter_list_checker_mult_dirs.get_options).
+        :return: Digest of the URL and options.
+        '''
+        text = url + "\n" + json.dumps(sorted(options.items()))
+        return hashlib.blake2b(text.encode("utf-8", "surrogatepass"), digest_size=16).digest()
+
+    def get_decisions(self, url_key, list_hashes):
+        '''
+        :param url_key: The key of the URL and options (see make_url_key).
+        :param list_hashes: The hashes of the filter lists.
+        :return: A dict with the stored decisions (True if the URL is blocked) of the lists, by list hash.
+        '''
+        decisions = {}
+        for list_hash, blocked, used in self.conn.execute(
+                "SELECT list_hash, blocked, used FROM decisions WHERE url_key = ?", (url_key,)):
+            if list_hash in list_hashes:
+                decisions[list_hash] = bool(blocked)
+                if used != self.run:
+                    self.used_decisions.append((self.run, url_key, list_hash))
+        self.hits += len(decisions)
+        self.misses += len(list_hashes) - len(decisions)
+        if len(self.used_decisions) >= WRITE_BATCH_SIZE:
+            self.flush()
+        return decisions
+
+    def add_decisions(self, url_key, decisions):
+        '''
+        :param url_key: The key of the URL and options (see make_url_key).
+        :param decisions: A dict with the decisions of the lists, by list hash.
+        '''
+        self.new_decisions.extend((url_key, list_hash, int(blocked), self.run) for list_hash, blocked in decisions.items())
+        if len(self.new_decisions) >= WRITE_BATCH_SIZE:
+            self.flush()
+
+    def flush(self):
+        # Write the buffered decisions to the database
+        with self.conn:
+            self.conn.executemany("INSERT OR REPLACE INTO decisions VALUES (?, ?, ?, ?)", self.new_decisions)
+            self.conn.executemany("UPDATE decisions SET used = ? WHERE url_key = ? AND list_hash = ?", self.used_decisions)
+        self.new_decisions = []
+        self.used_decisions = []
+
+    def count(self):
+        return self.conn.execute("SELECT COUNT(*) FROM decisions").fetchone()[0]
+
+    def evict(self):
+        # Remove the decisions used the longest ago, down to max_entries
+        excess = self.count() - self.max_entries
+        if excess <= 0:
+            return
+        with self.conn:
+            self.conn.execute('''
+                DELETE FROM decisions WHERE (url_key, list_hash) IN
+                    (SELECT url_key, list_hash FROM decisions ORDER BY used LIMIT ?)
+            ''', (excess,))
+        self.evicted += excess
+
+    def close(self):
+        self.flush()
+        self.evict()
+        self.conn.close()
+        self.conn = None
+
+    def get_stats(self):
+        '''
+        :return: A dict with the hits and misses (one per filter list and URL), hit rate, decisions evicted, and number of
+                 decisions in the database (if the store is still open).
+        '''
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups > 0 else 0.0,
+            "evicted": self.evicted,
+            "entries": self.count() if self.conn is not None else None,
+            "max_entries": self.max_entries
+        }
+
+    def print_stats(self):
+        stats = self.get_stats()
+        print("[.] Block decision cache %s: %d hits, %d misses (hit rate %.1f%%), %d decisions evicted (max %d)" %
+              (self.path, stats["hits"], stats["misses"], 100.0 * stats["hit_rate"], stats["evicted"], stats["max_entries"]))
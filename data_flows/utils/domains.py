@@ -0,0 +1,55 @@
+#!/usr/bin/python
+
+'''
+Shared registered-domain resolution for the pipeline scripts. Results are memoized in a bounded LRU cache, since the
+same hostnames come up over and over again in the traffic of an app.
+'''
+
+import functools
+import tldextract
+
+# Number of distinct hostnames/URLs whose results are kept in memory
+DOMAIN_CACHE_SIZE = 1 << 16
+
+# Use the Public Suffix List snapshot that ships with tldextract: no network fetch at startup and no cache directory,
+# so that results do not depend on when (or whether) the latest list could be downloaded
+_extractor = tldextract.TLDExtract(suffix_list_urls=(), cache_dir=False)
+
+
+@functools.lru_cache(maxsize=DOMAIN_CACHE_SIZE)
+def extract(hostname):
+    '''
+    Split a hostname or URL into subdomain, domain, and public suffix.
+    :param hostname: A hostname or a URL.
+    :return: A tldextract ExtractResult (immutable, so it can be shared between callers).
+    '''
+    return _extractor(hostname)
+
+
+def get_second_level_domain(hostname):
+    '''
+    :return: The domain and public suffix of hostname, e.g., "example.co.uk" for "a.b.example.co.uk".
+    '''
+    url_tld = extract(hostname)
+    return url_tld.domain + "." + url_tld.suffix
+
+
+def get_cache_stats():
+    '''
+    :return: A dict with the hits, misses, hit rate, and size of the domain resolution cache.
+    '''
+    info = extract.cache_info()
+    lookups = info.hits + info.misses
+    return {
+        "hits": info.hits,
+        "misses": info.misses,
+        "hit_rate": info.hits / lookups if lookups > 0 else 0.0,
+        "size": info.currsize,
+        "max_size": info.maxsize
+    }
+
+
+def print_cache_stats():
+    stats = get_cache_stats()
+    print("[.] Domain resolution cache: %d hits, %d misses (hit rate %.1f%%), %d/%d entries" %
+          (stats["hits"], stats["misses"], 100.0 * stats["hit_rate"], stats["size"], stats["max_size"]))
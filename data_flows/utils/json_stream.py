@@ -0,0 +1,229 @@
+#!/usr/bin/python
+
+'''
+Helpers to incrementally read large JSON files (e.g., tshark JSON output, HAR files) without loading the whole
+document into memory.
+'''
+
+import json
+import re
+
+READ_CHUNK_SIZE = 1 << 20  # 1 MiB
+WHITESPACE_RE = re.compile(r'[ \t\n\r]*')
+NUMBER_CHARS_RE = re.compile(r'[0-9.eE+-]*')
+# Characters skipped by skip_value outside of strings
+SKIP_OTHER_RE = re.compile(r'[^"{}\[\]]*')
+
+
+class JSONStreamReader:
+    """
+    Buffered reader over a text file object that decodes one JSON value at a time.
+    Only the unread part of the current chunk, plus whatever is needed to complete the value
+    being decoded, is kept in memory.
+    """
+
+    def __init__(self, fp, object_pairs_hook=None, chunk_size=READ_CHUNK_SIZE):
+        self.fp = fp
+        self.decoder = json.JSONDecoder(object_pairs_hook=object_pairs_hook)
+        self.chunk_size = chunk_size
+        self.buf = ""
+        self.pos = 0
+        self.eof = False
+
+    def _fill(self, size):
+        # Drop the part of the buffer that was already consumed and append the next chunk of the file
+        chunk = self.fp.read(size)
+        if not chunk:
+            self.eof = True
+            return False
+        self.buf = self.buf[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self):
+        """
+        Skip whitespace and return the next character without consuming it.
+        :return: The next non-whitespace character, or an empty string at the end of the file.
+        """
+        while True:
+            self.pos = WHITESPACE_RE.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self._fill(self.chunk_size):
+                return ""
+
+    def consume(self, expected):
+        """
+        Consume the next non-whitespace character, which must be the expected one.
+        """
+        found = self.peek()
+        if found != expected:
+            raise ValueError("Expected '%s' but found '%s' in JSON stream" % (expected, found))
+        self.pos += 1
+
+    def decode_value(self):
+        """
+        Decode the next JSON value, reading more of the file until the value is complete.
+        :return: The decoded value.
+        """
+        self.peek()
+        read_size = self.chunk_size
+        while True:
+            try:
+                obj, end = self.decoder.raw_decode(self.buf, self.pos)
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+                # The value is most likely cut off at the end of the buffer, so read more and retry.
+                # The read size doubles on every retry so that a large value is only re-parsed a
+                # logarithmic number of times.
+                self._fill(read_size)
+                read_size *= 2
+                continue
+
+            # A value that ends at the end of the buffer, or only followed by number characters, may be a truncated
+            # number (e.g., "-2." of "-2.5e10")
+            if not self.eof and NUMBER_CHARS_RE.match(self.buf, end).end() == len(self.buf):
+                self._fill(read_size)
+                read_size *= 2
+                continue
+
+            self.pos = end
+            return obj
+
+    def skip_value(self):
+        """
+        Skip the next JSON value without decoding it. Only a chunk of the file is kept in memory at a time, however
+        large the value is (e.g., the response bodies in a HAR file). The skipped value is not validated.
+        """
+        found = self.peek()
+        if found not in ('{', '[', '"'):
+            # A number, true, false, or null
+            self.decode_value()
+            return
+
+        depth = 0
+        in_string = False
+        while True:
+            if self.pos >= len(self.buf) and not self._fill(self.chunk_size):
+                raise ValueError("Unexpected end of JSON stream")
+            if in_string:
+                # Find the closing quote, skipping the escaped characters (str.find is much faster than a regex on the
+                # long strings, e.g., base64-encoded bodies)
+                buf = self.buf
+                quote = buf.find('"', self.pos)
+                end = quote if quote >= 0 else len(buf)
+                escape = buf.find('\\', self.pos, end)
+                while escape >= 0 and escape + 1 < len(buf):
+                    if escape + 1 == quote:
+                        quote = buf.find('"', quote + 1)
+                        end = quote if quote >= 0 else len(buf)
+                    escape = buf.find('\\', escape + 2, end)
+                if escape >= 0:
+                    # Escape at the end of the buffer, read its escaped character
+                    self.pos = escape
+                    if not self._fill(self.chunk_size):
+                        raise ValueError("Unexpected end of JSON stream")
+                    continue
+                self.pos = end
+                if self.pos == len(buf):
+                    continue
+                self.pos += 1
+                in_string = False
+                if depth == 0:
+                    return
+            else:
+                self.pos = SKIP_OTHER_RE.match(self.buf, self.pos).end()
+                if self.pos == len(self.buf):
+                    continue
+                found = self.buf[self.pos]
+                self.pos += 1
+                if found == '"':
+                    in_string = True
+                elif found in "{[":
+                    depth += 1
+                else:
+                    depth -= 1
+                    if depth == 0:
+                        return
+
+    def iter_array_items(self):
+        """
+        Iterate over the elements of the JSON array that starts at the current position, without reading them: the
+        caller must read each element (e.g., with decode_value, skip_value, or iter_object_keys) before the next one.
+        An empty file is treated as an empty array.
+        :return: A generator of the index of each element.
+        """
+        if self.peek() == "":
+            return
+        self.consume("[")
+        if self.peek() == "]":
+            self.pos += 1
+            return
+
+        index = 0
+        while True:
+            yield index
+            index += 1
+            found = self.peek()
+            if found == ",":
+                self.pos += 1
+            elif found == "]":
+                self.pos += 1
+                return
+            else:
+                raise ValueError("Expected ',' or ']' but found '%s' in JSON array" % found)
+
+    def iter_array(self):
+        """
+        Yield the elements of the JSON array that starts at the current position, one at a time.
+        An empty file is treated as an empty array.
+        """
+        for _ in self.iter_array_items():
+            yield self.decode_value()
+
+    def iter_object_keys(self):
+        """
+        Iterate over the keys of the JSON object that starts at the current position, without reading the values: the
+        caller must read the value of each key (e.g., with decode_value, skip_value, or iter_array_items) before the
+        next key. An empty file is treated as an empty object.
+        :return: A generator of the keys.
+        """
+        if self.peek() == "":
+            return
+        self.consume("{")
+        if self.peek() == "}":
+            self.pos += 1
+            return
+
+        while True:
+            key = self.decode_value()
+            self.consume(":")
+            yield key
+            found = self.peek()
+            if found == ",":
+                self.pos += 1
+            elif found == "}":
+                self.pos += 1
+                return
+            else:
+                raise ValueError("Expected ',' or '}' but found '%s' in JSON object" % found)
+
+    def iter_object(self):
+        """
+        Yield the (key, value) pairs of the JSON object that starts at the current position, one at a time.
+        An empty file is treated as an empty object.
+        """
+        for key in self.iter_object_keys():
+            yield key, self.decode_value()
+
+
+def iter_json_array(full_path, object_pairs_hook=None, encoding=None):
+    """
+    Incrementally read a file that holds a top-level JSON array and yield its elements one at a time.
+    :param full_path: Path to the JSON file.
+    :param object_pairs_hook: Passed on to json.JSONDecoder (e.g., to handle duplicate keys).
+    :param encoding: Text encoding used to open the file.
+    """
+    with open(full_path, "r", encoding=encoding) as jf:
+        yield from JSONStreamReader(jf, object_pairs_hook=object_pairs_hook).iter_array()
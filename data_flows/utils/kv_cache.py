@@ -0,0 +1,113 @@
+#!/usr/bin/python
+
+'''
+Memoization of the key-value pairs extracted from payloads (URLs, headers, bodies). The same header blobs, query strings,
+and SDK telemetry bodies repeat thousands of times in a trace, so the pairs are kept in a bounded LRU cache, keyed by a
+digest of the payload (the payloads themselves are not kept).
+'''
+
+import hashlib
+from collections import OrderedDict
+
+# Approximate memory used by the cache (see estimate_size), and by a single entry
+KV_CACHE_MAX_BYTES = 128 * 1024 * 1024
+KV_CACHE_MAX_ENTRY_BYTES = 1024 * 1024
+# Rough memory used by an entry (key, OrderedDict node, list) and by each pair (tuple, path tuple, and references)
+ENTRY_OVERHEAD_BYTES = 200
+PAIR_OVERHEAD_BYTES = 150
+
+
+class KVCache:
+    """
+    LRU cache that maps the digest of a payload to the key-value pairs extracted from it. The least recently used entries
+    are evicted once the estimated size of the entries exceeds max_bytes.
+    """
+
+    def __init__(self, max_bytes=KV_CACHE_MAX_BYTES, max_entry_bytes=KV_CACHE_MAX_ENTRY_BYTES):
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_entry_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+
+    @staticmethod
+    def digest(payload):
+        return hashlib.blake2b(payload.encode("utf-8", "surrogatepass"), digest_size=16).digest()
+
+    @staticmethod
+    def estimate_size(payload, pairs):
+        # The pairs are made of parts of the payload, so its length is a (cheap) estimate of their size
+        return ENTRY_OVERHEAD_BYTES + PAIR_OVERHEAD_BYTES * len(pairs) + len(payload)
+
+    def get_or_extract(self, payload, extract):
+        '''
+        :param payload: The payload string.
+        :param extract: Function that extracts the key-value pairs from the payload, called on a cache miss.
+        :return: A new list with the key-value pairs of the payload.
+        '''
+        key = self.digest(payload)
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            self.bytes_saved += len(payload)
+            # Return a copy, so that callers cannot modify the cached pairs
+            return list(entry[0])
+
+        self.misses += 1
+        pairs = extract(payload)
+        entry_size = self.estimate_size(payload, pairs)
+        if entry_size <= self.max_entry_bytes:
+            self.entries[key] = (tuple(pairs), entry_size)
+            self.size += entry_size
+            while self.size > self.max_bytes:
+                _, (_, evicted_size) = self.entries.popitem(last=False)
+                self.size -= evicted_size
+        return pairs
+
+    def add_counts(self, hits=0, misses=0, bytes_saved=0):
+        # Add the lookups of a cache in another process (e.g., a worker process of convert_har.py) to the stats
+        self.hits += hits
+        self.misses += misses
+        self.bytes_saved += bytes_saved
+
+    def get_stats(self):
+        '''
+        :return: A dict with the hits, misses, hit rate, payload bytes that were not parsed again (including the lookups
+                 added with add_counts), and size of the cache (of this process only).
+        '''
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups > 0 else 0.0,
+            "bytes_saved": self.bytes_saved,
+            "entries": len(self.entries),
+            "size": self.size,
+            "max_size": self.max_bytes
+        }
+
+
+# Cache shared by the HAR and tshark extraction (see convert_har.extract_kv_pairs)
+_cache = KVCache()
+
+
+def get_or_extract(payload, extract):
+    return _cache.get_or_extract(payload, extract)
+
+
+def add_cache_counts(hits=0, misses=0, bytes_saved=0):
+    _cache.add_counts(hits, misses, bytes_saved)
+
+
+def get_cache_stats():
+    return _cache.get_stats()
+
+
+def print_cache_stats():
+    stats = get_cache_stats()
+    print("[.] Key-value extraction cache: %d hits, %d misses (hit rate %.1f%%), %.1f MB of payloads not parsed again, %d entries (~%.1f/%.1f MiB)" %
+          (stats["hits"], stats["misses"], 100.0 * stats["hit_rate"], stats["bytes_saved"] / 1e6, stats["entries"],
+           stats["size"] / (1 << 20), stats["max_size"] / (1 << 20)))
@@ -0,0 +1,138 @@
+#!/usr/bin/python
+
+'''
+Per-packet cost of the key-value pair extraction (time, bytes scanned, pairs), logged to a CSV side file to find the
+packets that dominate the run time (and set the extraction limits, see extract_key_val_pairs.ExtractionBudget).
+Nothing is recorded unless a log file was opened with open_log(), or rows are buffered with open_buffer() (in worker
+processes, which send their rows back to the process that writes the log, see write_rows()).
+'''
+
+import csv
+import time
+
+COST_LOG_HEADER = ["pkt_id", "source", "time_s", "payload_bytes", "bytes_scanned", "pairs", "cache_hits", "limits_hit"]
+
+_log_file = None
+_log_writer = None
+_buffered_rows = None
+_packet_cost = None
+_summary = {"packets": 0, "time_s": 0.0, "limited_packets": 0}
+
+
+def open_log(path):
+    '''
+    Start logging the cost of each packet to a CSV file, with a new summary (see close_log).
+    :param path: Path of the CSV file (overwritten).
+    '''
+    global _log_file, _log_writer
+    _summary.update(packets=0, time_s=0.0, limited_packets=0)
+    _log_file = open(path, "w", newline="")
+    _log_writer = csv.writer(_log_file)
+    _log_writer.writerow(COST_LOG_HEADER)
+
+
+def open_buffer():
+    # Keep the rows in memory instead of writing them, until take_rows() is called. A forked worker process inherits the
+    # log file of its parent, which it must not write to (see flush_log)
+    global _log_file, _log_writer, _buffered_rows
+    _log_file, _log_writer = None, None
+    _buffered_rows = []
+
+
+def flush_log():
+    # Write out the rows buffered by the log file, before forking worker processes that would otherwise inherit them
+    if _log_file is not None:
+        _log_file.flush()
+
+
+def take_rows():
+    '''
+    :return: The rows buffered since the last call (see open_buffer), or an empty list if rows are not buffered.
+    '''
+    global _buffered_rows
+    if _buffered_rows is None:
+        return []
+    rows, _buffered_rows = _buffered_rows, []
+    return rows
+
+
+def write_rows(rows):
+    '''
+    Log rows buffered by another process (see open_buffer), and add them to the summary.
+    :param rows: The rows, as returned by take_rows().
+    '''
+    if _log_writer is None:
+        return
+    _log_writer.writerows(rows)
+    for row in rows:
+        _add_to_summary(float(row[2]), row[7])
+
+
+def is_enabled():
+    return _log_writer is not None or _buffered_rows is not None
+
+
+def start_packet():
+    # Reset the cost of the current packet, before its payloads are extracted
+    global _packet_cost
+    if is_enabled():
+        _packet_cost = {"start": time.perf_counter(), "payload_bytes": 0, "bytes_scanned": 0, "pairs": 0,
+                        "cache_hits": 0, "limits_hit": set()}
+
+
+def add_payload_cost(payload, pairs, budget=None):
+    '''
+    Add the cost of a payload to the current packet.
+    :param payload: The payload that was extracted.
+    :param pairs: The key-value pairs extracted from it.
+    :param budget: The ExtractionBudget used for the payload, or None if the pairs came from the cache (in which case
+                   no bytes were scanned, and the limits hit are only reported for the first packet with the payload).
+    '''
+    if _packet_cost is None:
+        return
+    _packet_cost["payload_bytes"] += len(payload)
+    _packet_cost["pairs"] += len(pairs)
+    if budget is None:
+        _packet_cost["cache_hits"] += 1
+    else:
+        _packet_cost["bytes_scanned"] += budget.bytes_scanned
+        _packet_cost["limits_hit"].update(budget.limits_hit)
+
+
+def end_packet(pkt_id, source):
+    '''
+    Log the cost of the current packet.
+    :param pkt_id: The id of the packet in the output files.
+    :param source: Name of the file the packet comes from.
+    '''
+    global _packet_cost
+    if _packet_cost is None:
+        return
+    elapsed = time.perf_counter() - _packet_cost["start"]
+    limits_hit = ";".join(sorted(_packet_cost["limits_hit"]))
+    row = [pkt_id, source, "%.6f" % elapsed, _packet_cost["payload_bytes"], _packet_cost["bytes_scanned"],
+           _packet_cost["pairs"], _packet_cost["cache_hits"], limits_hit]
+    if _log_writer is not None:
+        _log_writer.writerow(row)
+        _add_to_summary(elapsed, limits_hit)
+    else:
+        _buffered_rows.append(row)
+    _packet_cost = None
+
+
+def _add_to_summary(elapsed, limits_hit):
+    _summary["packets"] += 1
+    _summary["time_s"] += elapsed
+    if limits_hit:
+        _summary["limited_packets"] += 1
+
+
+def close_log():
+    # Close the log file and print a summary
+    global _log_file, _log_writer
+    if _log_file is None:
+        return
+    _log_file.close()
+    _log_file, _log_writer = None, None
+    print("[.] Key-value extraction cost: %d packets, %.1f s, %d packets hit an extraction limit" %
+          (_summary["packets"], _summary["time_s"], _summary["limited_packets"]))
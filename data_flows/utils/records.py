@@ -0,0 +1,90 @@
+#!/usr/bin/python
+
+'''
+Reading and writing of the intermediate files of the pipeline (NoMoAds JSON, extracted key-value pairs), which all map
+a packet id to a record. Three formats are supported:
+- "json": a single pretty-printed JSON object (the original format, easy to read but slow to write and load).
+- "jsonl": one compact [id, record] JSON array per line, which can be written and read one record at a time.
+- "jsonl.gz": the same, gzip-compressed.
+Readers detect the format from the file contents, so file names do not change with the format.
+'''
+
+import gzip
+import json
+from utils import json_stream
+
+FORMAT_JSON = "json"
+FORMAT_JSONL = "jsonl"
+FORMAT_JSONL_GZ = "jsonl.gz"
+INTERMEDIATE_FORMATS = [FORMAT_JSON, FORMAT_JSONL, FORMAT_JSONL_GZ]
+DEFAULT_FORMAT = FORMAT_JSON
+
+GZIP_MAGIC = b"\x1f\x8b"
+GZIP_COMPRESS_LEVEL = 6
+
+
+def write_records(data, file_out, fmt=DEFAULT_FORMAT):
+    '''
+    Write a dict of records to a file.
+    :param data: A dict (or any iterable of (id, record) tuples for the JSONL formats).
+    :param file_out: Path of the output file.
+    :param fmt: One of INTERMEDIATE_FORMATS.
+    '''
+    if fmt == FORMAT_JSON:
+        with open(file_out, "w") as jf:
+            jf.write(json.dumps(data, sort_keys=True, indent=4))
+        return
+
+    if fmt == FORMAT_JSONL:
+        out = open(file_out, "w")
+    elif fmt == FORMAT_JSONL_GZ:
+        out = gzip.open(file_out, "wt", compresslevel=GZIP_COMPRESS_LEVEL)
+    else:
+        raise ValueError("Unknown intermediate format: %s (expected one of %s)" % (fmt, INTERMEDIATE_FORMATS))
+
+    items = data.items() if isinstance(data, dict) else data
+    with out:
+        for key, record in items:
+            out.write(json.dumps([key, record], sort_keys=True, separators=(",", ":")))
+            out.write("\n")
+
+
+def detect_format(full_path):
+    '''
+    :return: The format of an intermediate file (see INTERMEDIATE_FORMATS), FORMAT_JSON for an empty file.
+    '''
+    with open(full_path, "rb") as f:
+        if f.read(2) == GZIP_MAGIC:
+            return FORMAT_JSONL_GZ
+    with open(full_path, "r") as f:
+        # A JSON object starts with "{", and a JSONL record with "["
+        if json_stream.JSONStreamReader(f).peek() == "[":
+            return FORMAT_JSONL
+    return FORMAT_JSON
+
+
+def iter_records(full_path):
+    '''
+    Incrementally read an intermediate file, in any of the supported formats.
+    :param full_path: Path to the file.
+    :return: A generator of (id, record) tuples, in file order.
+    '''
+    fmt = detect_format(full_path)
+    if fmt == FORMAT_JSON:
+        with open(full_path, "r") as jf:
+            yield from json_stream.JSONStreamReader(jf).iter_object()
+        return
+
+    with (gzip.open(full_path, "rt") if fmt == FORMAT_JSONL_GZ else open(full_path, "r")) as f:
+        for line in f:
+            if line.strip():
+                key, record = json.loads(line)
+                yield key, record
+
+
+def read_records(full_path):
+    '''
+    Read a whole intermediate file into memory.
+    :return: A dict that maps the ids to their records.
+    '''
+    return dict(iter_records(full_path))
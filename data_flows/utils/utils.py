@@ -13,6 +13,8 @@
 # See the LICENSE.md file along with DiffAudit for more details.
 
 import os
+import json
+import hashlib
 
 # Global variables used by other scripts
 GENERAL_FILE_NAME = 'general.json'
@@ -37,6 +39,7 @@ json_key_uri = 'uri'
 json_key_headers = 'headers'
 json_key_dst_port = "dst_port"
 json_key_dst_ip = 'dst_ip'
+json_key_overall_block_decision = "overall_block_decision" # 1 if at least one filter list blocks the packet
 
 # Headers for CSV files
 hAdLibs = 'ad_libraries'
@@ -98,6 +101,8 @@ extracted_kvs_payload = "extracted_kvs_payload"
 extracted_kvs_header = "extracted_kvs_header"
 extracted_kvs_url = "extracted_kvs_url"
 all_extracted_kvs = "all_extracted_kvs"
+extracted_keys = "extracted_keys" # only the unique key paths of all_extracted_kvs (--keys_only)
+template_id = "template_id" # shape of the request: host, path, and set of key paths (see make_template_id)
 
 ssl = "tls"
 
@@ -154,6 +159,34 @@ MANUAL_ORGS = {
 }
 
 
+def make_packet_id(source_name, index):
+    '''
+    Build a stable, compact id for a packet/HAR entry, so that re-running the pipeline on the same inputs produces the
+    same ids (and the same outputs). The ids are only unique within the outputs of one directory (e.g., the merged
+    captures of all the apps have the same base name), not across apps or traces.
+    :param source_name: Path or name of the file the packet comes from, only its base name is used.
+    :param index: The frame number of the packet, or the index of the HAR entry, in that file.
+    :return: The id, e.g., "1f0e3dad-1532" (short digest of the file name, and the index).
+    '''
+    source_digest = hashlib.blake2b(os.path.basename(source_name).encode("utf-8"), digest_size=4).hexdigest()
+    return source_digest + "-" + str(index)
+
+
+def make_template_id(host, uri, key_paths):
+    '''
+    Fingerprint the shape of a request, so that requests that only differ in their values (e.g., the thousands of events
+    sent by an analytics SDK) can be processed once.
+    :param host: The host of the request.
+    :param uri: The URI of the request, its query string is ignored (its keys are in the key paths).
+    :param key_paths: The key paths of the key-value pairs extracted from the request (tuples or lists), in any order.
+    :return: The template id, a short digest of the host, path, and set of key paths.
+    '''
+    path = (uri or "").split("?", 1)[0]
+    keys = sorted(set(json.dumps(list(key_path)) for key_path in key_paths))
+    shape = json.dumps([host or "", path, keys])
+    return hashlib.blake2b(shape.encode("utf-8", "surrogatepass"), digest_size=8).hexdigest()
+
+
 def readable_dir(prospective_dir):
     if not os.path.isdir(prospective_dir):
         raise Exception("readable_dir:{0} is not a valid path".format(prospective_dir))